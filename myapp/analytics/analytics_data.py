@@ -6,6 +6,8 @@ import time
 from datetime import datetime
 from collections import Counter
 
+from myapp.core.utils import normalize_query
+
 
 class AnalyticsData:
     """
@@ -36,6 +38,13 @@ class AnalyticsData:
     # each row is a dict
     requests = [] 
 
+    # -------------------------
+    # Queries Table
+    # -------------------------
+    # key = query (lowercase, single spaces), value = number of searches that found products / found nothing
+    query_counts = Counter()
+    zero_hit_queries = Counter()
+
 
 
     def create_session(self, session_id, user_agent, user_ip, agent, ip_country, ip_city):
@@ -85,6 +94,19 @@ class AnalyticsData:
         })
 
 
+    # count a searched query: returns the normalised query if it was counted in query_counts (the counts the
+    # autocomplete suggestions are made of), None otherwise
+    def log_query(self, query, total_hits):
+        query = normalize_query(query)
+        if not query:
+            return None
+        if total_hits > 0:
+            self.query_counts[query] += 1
+            return query
+        self.zero_hit_queries[query] += 1
+        return None
+
+
     def update_dwell_time(self, doc_id):
         for click in self.clicks:
             if click["doc_id"] == doc_id:
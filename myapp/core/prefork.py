@@ -0,0 +1,70 @@
+import gc
+import os
+import signal
+import socket
+
+from werkzeug.serving import make_server
+
+
+def serve(app, host, port, workers):
+    """
+    Serve a WSGI app with `workers` pre-forked processes (Unix only).
+
+    Everything the app loads at import time (index, corpus store, models) is loaded once in the parent process before
+    forking, and the workers share it: the index and corpus arrays are views on read-only memory maps, so their pages
+    live once in the OS page cache whatever the number of workers, and the remaining Python objects are shared
+    copy-on-write (gc.freeze() keeps the garbage collector from touching, and so copying, the pages of the objects
+    created before the fork). Each worker then only adds its own interpreter state, caches and request data.
+
+    The parent opens the listening socket, the workers accept connections on it (the kernel spreads them), and a
+    worker that dies is replaced. SIGINT / SIGTERM stop the workers and the parent.
+    Whatever the app keeps in memory per process (e.g. caches) is per worker.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+
+    gc.collect()
+    gc.freeze()  # objects loaded so far go to the permanent generation: never scanned, so their pages stay shared
+
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            server = make_server(host, port, app, threaded=False, fd=sock.fileno())
+            print("Worker {} serving on http://{}:{}/".format(os.getpid(), host, port))
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for _ in range(workers):
+        spawn()
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not stopping:
+            print("Worker {} exited with status {}, starting a new one".format(pid, status))
+            spawn()
+    sock.close()
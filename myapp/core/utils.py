@@ -1,4 +1,5 @@
 import datetime
+import re
 from random import random
 
 from faker import Faker
@@ -15,3 +16,8 @@ def get_random_date_in(start, end):
     return start + datetime.timedelta(
         # Get a random amount of seconds between `start` and `end`
         seconds=random.randint(0, int((end - start).total_seconds())), )
+
+
+def normalize_query(query):
+    """Lowercase a query and collapse its white space (the form in which queries are counted and suggested)."""
+    return re.sub(r'\s+', ' ', query.lower()).strip()
@@ -1,10 +1,95 @@
+import hashlib
+import json
 import os
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
 from groq import Groq
 from dotenv import load_dotenv
+
+from myapp.core.cache import LRUCache
 load_dotenv()  # take environment variables from .env
 
 
+class GroqBackend:
+    """
+    Chat completions with the Groq API. One client is created on first use and reused by every request (and thread),
+    so its HTTP connection pool is kept alive between generations instead of opening a new connection each time.
+    """
+
+    def __init__(self, api_key=None, model=None, timeout=10.0, max_retries=1):
+        self.api_key = api_key or os.environ.get("GROQ_API_KEY")
+        self.model = model or os.environ.get("GROQ_MODEL", "llama-3.1-8b-instant")
+        self.timeout = timeout  # seconds
+        self.max_retries = max_retries
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = Groq(api_key=self.api_key, timeout=self.timeout, max_retries=self.max_retries)
+            return self._client
+
+    def complete(self, prompt):
+        chat_completion = self.client.chat.completions.create(
+            messages=[
+                {
+                    "role": "user",
+                    "content": prompt,
+                }
+            ],
+            model=self.model,
+        )
+        return chat_completion.choices[0].message.content
+
+
+class StubBackend:
+    """
+    Offline backend for development and benchmarks: waits `latency` seconds (like an LLM call) and recommends the
+    first retrieved product.
+    """
+
+    model = "stub"
+
+    def __init__(self, latency=0.5):
+        self.latency = latency
+
+    def complete(self, prompt):
+        time.sleep(self.latency)
+        products = prompt.split("## Retrieved Products:")[1].split("## User Request:")[0].strip().splitlines()
+        if not products or not products[0].strip():
+            return "There are no good products that fit the request based on the retrieved results."
+        return "- Best Product: {}\n- Why: it is the best ranked result for the request.".format(products[0].strip()[2:])
+
+
+def backend_from_env():
+    """Return the backend chosen by RAG_BACKEND ("groq", the default, or "stub") with its settings from the environment."""
+    if os.environ.get("RAG_BACKEND", "groq") == "stub":
+        return StubBackend(latency=float(os.environ.get("RAG_STUB_LATENCY", 0.5)))
+    return GroqBackend(timeout=float(os.environ.get("GROQ_TIMEOUT", 10)), max_retries=int(os.environ.get("GROQ_MAX_RETRIES", 1)))
+
+
 class RAGGenerator:
+    """
+    Generates the AI summary of the results of a search.
+
+    generate_response blocks until the summary is ready. The web app uses submit instead, which starts the
+    generation in a pool of background threads and returns a job id right away, so the results page does not wait for
+    the LLM; the summary is then fetched with poll (see the /rag/<job_id> endpoint). The job id is derived from the
+    query, the retrieved pids and the model, so submitting the same generation again returns the same job.
+    Finished jobs are kept for `job_ttl` seconds, except failed ones: submitting them again starts a new generation.
+
+    Responses are cached (LRU, bounded by cache_entries, expiring after cache_ttl seconds) on the normalised query, the
+    ordered pids given to the LLM and the model, so repeated searches don't pay an LLM round trip. Concurrent
+    identical generations are coalesced (single flight): one calls the LLM and the others wait for its response.
+    If cache_file is given, responses are also appended to it and loaded again at startup (the file is shared by the
+    server processes); it is compacted to the entries that still fit in the cache (not expired, newest response of
+    each key) at startup and whenever it grows past twice the cache size. Failed generations are not cached. stats() reports the hit rate and the number of LLM calls.
+    """
 
     PROMPT_TEMPLATE = """
         You are an expert product advisor helping users choose the best option from retrieved e-commerce products.
@@ -30,22 +115,76 @@ class RAGGenerator:
         - Alternative (optional): ...
     """
 
+    DEFAULT_ANSWER = "RAG is not available. Check your credentials (.env file) or account limits."
+
+    def __init__(self, backend=None, workers=None, job_ttl=600, cache_entries=None, cache_ttl=None, cache_file=None):
+        self.backend = backend or backend_from_env()
+        self.executor = ThreadPoolExecutor(max_workers=workers or int(os.environ.get("RAG_WORKERS", 4)),
+                                           thread_name_prefix="rag")
+        self.jobs = LRUCache(max_entries=10000, ttl=job_ttl)  # job id -> Future
+        self._submit_lock = threading.Lock()
+
+        if cache_ttl is None and os.environ.get("RAG_CACHE_TTL"):
+            cache_ttl = float(os.environ["RAG_CACHE_TTL"])
+        self.cache = LRUCache(max_entries=cache_entries or int(os.environ.get("RAG_CACHE_ENTRIES", 1000)), ttl=cache_ttl)
+        self.cache_file = cache_file or os.environ.get("RAG_CACHE_FILE")
+        self._in_flight = {}  # cache key -> Future of the generation in progress
+        self._flight_lock = threading.Lock()
+        self.generations = 0  # LLM calls
+        self.coalesced = 0  # requests that waited for an identical generation in progress
+        self.errors = 0
+        self._file_lock = threading.Lock()
+        self._file_lines = 0  # lines of cache_file: it is compacted when they are more than twice the cache size
+        if self.cache_file:
+            self._load_cache_file()
+
     def generate_response(self, user_query: str, retrieved_results: list, top_N: int = 20) -> dict:
         """
-        Generate a response using the retrieved search results. 
+        Generate a response using the retrieved search results.
         Returns:
             dict: Contains the generated suggestion and the quality evaluation.
         """
-        DEFAULT_ANSWER = "RAG is not available. Check your credentials (.env file) or account limits."
+        retrieved_results = retrieved_results[:top_N]
+        key = self.cache_key(user_query, retrieved_results)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        with self._flight_lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+
+        response, error = self.DEFAULT_ANSWER, None
         try:
-            client = Groq(
-                api_key=os.environ.get("GROQ_API_KEY"),
-            )
-            model_name = os.environ.get("GROQ_MODEL", "llama-3.1-8b-instant")
+            response, ok = self._generate(user_query, retrieved_results)
+            if ok:
+                self.cache.put(key, response)
+                self._persist(key, response)
+            return response
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            with self._flight_lock:
+                del self._in_flight[key]
+            # the followers wait on the future: complete it whatever happened
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(response)
 
+    def _generate(self, user_query, retrieved_results):
+        """Call the LLM. Returns (response, True), or (DEFAULT_ANSWER, False) if the generation failed."""
+        try:
             # Format the retrieved results for the prompt
             formatted_results = "\n".join(
-                [f"- PID: {res.pid}, Title: {res.title}" for res in retrieved_results[:top_N]]
+                [f"- PID: {res.pid}, Title: {res.title}" for res in retrieved_results]
             )
 
             prompt = self.PROMPT_TEMPLATE.format(
@@ -53,18 +192,142 @@ class RAGGenerator:
                 user_query=user_query
             )
 
-            chat_completion = client.chat.completions.create(
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt,
-                    }
-                ],
-                model=model_name,
-            )
-
-            generation = chat_completion.choices[0].message.content
-            return generation
+            self.generations += 1
+            generation = self.backend.complete(prompt)
+            return generation, True
         except Exception as e:
             print(f"Error during RAG generation: {e}")
-            return DEFAULT_ANSWER
+            self.errors += 1
+            return self.DEFAULT_ANSWER, False
+
+    def cache_key(self, user_query, retrieved_results):
+        """(model, normalised query, ordered pids) of a generation."""
+        query = re.sub(r"\s+", " ", user_query.strip().lower())
+        return self.backend.model, query, tuple(res.pid for res in retrieved_results)
+
+    def _persist(self, key, response):
+        if not self.cache_file:
+            return
+        line = json.dumps({"key": [key[0], key[1], list(key[2])], "response": response, "time": time.time()})
+        with self._file_lock:
+            with open(self.cache_file, "a", encoding="utf-8") as f:  # one write per line, so processes don't interleave
+                f.write(line + "\n")
+            self._file_lines += 1
+            if self._file_lines > 2 * self.cache.max_entries:
+                self._compact_cache_file()
+
+    def _read_cache_file(self):
+        """
+        Return the entries of cache_file that have not expired, the newest response of every key only, oldest first,
+        and the number of lines of the file.
+        """
+        entries = {}
+        lines = 0
+        now = time.time()
+        with open(self.cache_file, encoding="utf-8") as f:
+            for line in f:
+                lines += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # line cut short by a crash
+                if self.cache.ttl is not None and entry["time"] + self.cache.ttl < now:
+                    continue
+                model, query, pids = entry["key"]
+                key = (model, query, tuple(pids))
+                entries.pop(key, None)  # a newer response of the key moves it to the end
+                entries[key] = entry
+        # only the newest entries fit in the cache
+        return list(entries.items())[-self.cache.max_entries:], lines
+
+    def _compact_cache_file(self):
+        """
+        Rewrite cache_file with only the entries _read_cache_file keeps, so it does not grow without bound. The new
+        file replaces the old one atomically; a response appended by another process meanwhile can be lost (it is
+        only a cache).
+        """
+        entries, _ = self._read_cache_file()
+        path = "{}.{}.tmp".format(self.cache_file, os.getpid())
+        with open(path, "w", encoding="utf-8") as f:
+            for _, entry in entries:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(path, self.cache_file)
+        self._file_lines = len(entries)
+
+    def _load_cache_file(self):
+        """
+        Load the responses saved in cache_file that have not expired (the newest ones last, so they are kept), and
+        compact the file if most of its lines are expired or replaced.
+        """
+        if not os.path.exists(self.cache_file):
+            return
+        entries, lines = self._read_cache_file()
+        for key, entry in entries:
+            self.cache.put(key, entry["response"])
+        self._file_lines = lines
+        if lines > 2 * max(len(entries), 1):
+            with self._file_lock:
+                self._compact_cache_file()
+
+    def stats(self):
+        """Hit rate of the response cache and number of LLM calls (for /healthz)."""
+        stats = self.cache.stats()
+        stats.update({"generations": self.generations, "coalesced": self.coalesced, "errors": self.errors,
+                      "in_flight": len(self._in_flight)})
+        return stats
+
+    def job_id(self, user_query, retrieved_results, top_N=20):
+        model, query, pids = self.cache_key(user_query, retrieved_results[:top_N])
+        return hashlib.sha1("\n".join((model, query) + pids).encode()).hexdigest()
+
+    def submit(self, user_query, retrieved_results, top_N=20):
+        """
+        Start generating the response in the background (unless the same job exists and did not fail) and return its
+        job id. A job that failed is replaced, so submitting the same search again retries the generation.
+        """
+        job_id = self.job_id(user_query, retrieved_results, top_N)
+        with self._submit_lock:
+            job = self.jobs.get(job_id)
+            if job is None or self.failed(job):
+                self.jobs.put(job_id, self.executor.submit(self.generate_response, user_query, list(retrieved_results[:top_N]), top_N))
+        return job_id
+
+    def failed(self, future):
+        """Return True if a job is finished and fell back to DEFAULT_ANSWER (or raised)."""
+        if not future.done():
+            return False
+        return future.exception() is not None or future.result() == self.DEFAULT_ANSWER
+
+    def poll(self, job_id, wait=0):
+        """
+        Return the state of a job: {"status": "done", "response": ...}, {"status": "pending"} or None if the job is
+        unknown (expired, or started by another server process). Waits up to `wait` seconds for it to finish.
+        """
+        future = self.jobs.get(job_id)
+        if future is None:
+            return None
+        try:
+            return {"status": "done", "response": future.result(timeout=wait)}
+        except TimeoutError:
+            return {"status": "pending"}
+        except Exception as e:
+            print(f"Error during RAG generation (job {job_id}): {e}")
+            return {"status": "done", "response": self.DEFAULT_ANSWER}
+
+
+if __name__ == "__main__":
+    # offline benchmark: time to hand a generation off to the background pool vs. time until it is done
+    from types import SimpleNamespace
+
+    generator = RAGGenerator(backend=StubBackend(latency=0.5), workers=4)
+    results = [SimpleNamespace(pid=f"P{i:04d}", title=f"Product {i}") for i in range(20)]
+    start = time.perf_counter()
+    job_ids = [generator.submit(f"query {i}", results) for i in range(40)]
+    submitted = time.perf_counter() - start
+    for job_id in job_ids:
+        generator.poll(job_id, wait=60)
+    print("40 generations: submitted in {:.1f} ms, all done after {:.2f} s".format(submitted * 1000, time.perf_counter() - start))
+    start = time.perf_counter()
+    for i in range(40):
+        generator.generate_response(f"Query  {i} ", results)  # same normalised queries: served from the cache
+    print("40 repeated generations in {:.1f} ms, cache: {}".format((time.perf_counter() - start) * 1000, generator.stats()))
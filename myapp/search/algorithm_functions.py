@@ -1,263 +1,213 @@
-import math
-import string
+import functools
 from nltk.corpus import stopwords
 from nltk.stem import PorterStemmer
 import re
 import numpy as np
-from collections import defaultdict
-import collections
-from numpy import linalg as la
+from .positions import proximity_scores
+from .rankers import max_score, select_top_k, top_k
 
-def build_terms(text):
+class Analyzer:
+    """
+    Text analysis pipeline used to index products and to parse queries: lowercase, keep only letters and spaces,
+    tokenize, remove stop words and words shorter than 3 characters, and apply Porter stemming.
 
-    #check that the text is a string
-    if not isinstance(text, str):
-        return []
+    The stop words and the stemmer are loaded once (on first use) and the stems are memoised in a bounded LRU cache
+    keyed by the surface token, since the same few thousand words are stemmed again and again.
+    """
 
-    #keep only any word character or spaces (remove special characters and numbers) (includes removing punctuation marks)
-    text = re.sub(r'[^a-z\s]', '', text.lower()) 
+    NON_LETTERS = re.compile(r'[^a-z\s]')
 
-    #tokenize text to a list of tokens
-    tokens = text.split()
+    def __init__(self, stem_cache_size=100000):
+        self.stem_cache_size = stem_cache_size
+        self.stop_words = None
+        self.stem = None
 
-    #remove stop words
-    stop_words = set(stopwords.words('english'))
-    text = [word for word in tokens if word not in stop_words and len(word) > 2] #keep only words of length 3 minimum
+    def _load(self):
+        self.stop_words = frozenset(stopwords.words('english'))
+        self.stem = functools.lru_cache(maxsize=self.stem_cache_size)(PorterStemmer().stem)
 
-    #apply stemming
-    stemmer = PorterStemmer()
-    text=[stemmer.stem(word) for word in text]
+    def analyze(self, text):
+        """Return the list of terms of a text (an empty list if it is not a string)."""
 
-    return text
+        #check that the text is a string
+        if not isinstance(text, str):
+            return []
+        if self.stop_words is None:
+            self._load()
 
+        #keep only any word character or spaces (remove special characters and numbers) (includes removing punctuation marks)
+        tokens = self.NON_LETTERS.sub('', text.lower()).split()
 
-def create_index_tfidf(products_df, num_products):
-    """
-    Implement the inverted index and compute tf, df and idf
+        #remove stop words, keep only words of length 3 minimum and apply stemming
+        stop_words, stem = self.stop_words, self.stem
+        return [stem(word) for word in tokens if word not in stop_words and len(word) > 2]
 
-    Argument:
-    lines -- collection of Wikipedia articles
-    num_documents -- total number of documents
+    def tokens(self, text):
+        """Return the words of a text that analyze() keeps, before stemming (the surface forms of its terms)."""
+        if not isinstance(text, str):
+            return []
+        if self.stop_words is None:
+            self._load()
+        stop_words = self.stop_words
+        return [word for word in self.NON_LETTERS.sub('', text.lower()).split() if word not in stop_words and len(word) > 2]
 
-    Returns:
-    index - the inverted index (implemented through a Python dictionary) containing terms as keys and the corresponding
-    list of document these keys appears in (and the positions) as values.
-    tf - normalized term frequency for each term in each document
-    df - number of documents each term appear in
-    idf - inverse document frequency of each term
-    """
+    def analyze_many(self, texts):
+        """Return the list of terms of every text of a batch (used to index many products at once)."""
+        analyze = self.analyze
+        return [analyze(text) for text in texts]
 
-    index = defaultdict(lambda: defaultdict(lambda: 0))
-    tf = defaultdict(list)  #term frequencies of terms in documents (documents in the same order as in the main index)
-    df = defaultdict(int)  #document frequencies of terms in the corpus
-    title_index = defaultdict(str)
-    desc_index = defaultdict(str)
-    idf = defaultdict(float)
+    def cache_info(self):
+        """Return the hits/misses/size of the stem cache."""
+        return self.stem.cache_info() if self.stem is not None else None
 
-    for _, line in products_df.iterrows():
 
-        pid = line['pid']
-        terms = line['title_clean'] + line['description_clean']
+# shared analyzer, so stop words and cached stems are reused by every index build and query
+ANALYZER = Analyzer()
 
-        title = line['title']
-        desc = line['description']
-        title_index[pid] = title  ## we do not need to apply get terms to title because it used only to print titles and not in the index
-        desc_index[pid] = desc
-
-        current_product_terms = defaultdict(lambda: 0)
-        for term in terms:
-            current_product_terms[term] += 1
-            index[term][pid] += 1
 
+def build_terms(text):
+    """
+    Return the list of (stemmed) terms of a text. See Analyzer.
+    """
+    return ANALYZER.analyze(text)
 
-        # normalize term frequencies
-        # Compute the denominator to normalize term frequencies (formula 2 above)
-        # norm is the same for all terms of a document.
-        norm = 0
-        for freq in current_product_terms.values():
-            # posting will contain the list of positions for current term in current document.
-            # posting ==> [current_doc, [list of positions]]
-            # you can use it to infer the frequency of current term.
-            norm += freq ** 2
-        norm = math.sqrt(norm)
 
-        #calculate the tf(dividing the term frequency by the above computed norm) and df weights
-        for term, freq in current_product_terms.items():
-            # append the tf for current term (tf = term frequency in current doc/norm)
-            tf[term].append(np.round(freq / norm, 4)) ## SEE formula (1) above
-            #increment the document frequency of current term (number of documents containing the current term)
-            df[term] += 1 # increment DF for current term
+# "a phrase" or "terms close together"~slop
+# the slop is capped so that a window stays narrower than the gap between the fields of a product (see FIELD_GAP)
+MAX_SLOP = 100
+PHRASE = re.compile(r'"([^"]*)"(?:~(\d+))?')
 
 
-    # Compute IDF following the formula (3) above. HINT: use np.log
-    # Note: It is computed later after we know the df.
-    for term in df:
-        idf[term] = np.round(np.log(float(num_products / df[term])), 4)
+def parse_query(text):
+    """
+    Return the terms of a query and its phrase / proximity operators, as a list of (tuple of terms, slop).
+    "slim fit jeans" is a phrase (slop 0); "slim jeans"~3 asks for the terms within 3 extra positions of each other
+    (at most MAX_SLOP). The terms of the operators are also part of the query terms (they are scored like the others).
+    """
+    phrases = []
+    for match in PHRASE.finditer(text):
+        phrase_terms = tuple(ANALYZER.analyze(match.group(1)))
+        if len(phrase_terms) > 1:
+            phrases.append((phrase_terms, min(int(match.group(2) or 0), MAX_SLOP)))
+    return ANALYZER.analyze(PHRASE.sub(lambda match: " " + match.group(1) + " ", text)), phrases
 
 
-    return index, tf, df, idf, title_index, desc_index
+def _sort_scores(index, doc_ids, scores, k=None):
+    """
+    Sort the scored products by decreasing score (ties keep the doc id order) and translate doc ids into pids.
+    If k is given, only the k best products are selected (argpartition) and sorted.
+    """
+    doc_ids, scores = select_top_k(doc_ids, scores, k)
+    result_products = [index.pid(doc_id) for doc_id in doc_ids]
+    products_scores = list(zip(result_products, scores.tolist()))
+    return result_products, products_scores
 
 
-def rank_products_tfidf(terms, pids, index, idf, tf, title_index):
+def rank_products_tfidf(terms, doc_ids, ranker, k=None):
     """
     Perform the ranking of the results of a search based on the tf-idf weights
 
     Argument:
     terms -- list of query terms
-    pids -- list of products, to rank, matching the query
-    index -- inverted index data structure
-    idf -- inverted document frequencies
-    tf -- term frequencies
-    title_index -- mapping between page id and page title
+    doc_ids -- sorted array of doc ids of the products, to rank, matching the query
+    ranker -- TfidfRanker over the compact inverted index
+    k -- if given, only the k best products are returned
 
     Returns:
-    Print the list of ranked product
+    the list of ranked pids and the list of (pid, score) pairs
     """
 
-    # I'm interested only on the element of the productVector corresponding to the query terms
-    # The remaining elements would become 0 when multiplied to the query_vector
-    products_vectors = defaultdict(lambda: [0] * len(terms)) # I call doc_vectors[k] for a nonexistent key k, the key-value pair (k,[0]*len(terms)) will be automatically added to the dictionary
-    query_vector = [0] * len(terms)
-
-    # compute the norm for the query tf
-    query_terms_count = collections.Counter(terms)  # get the frequency of each term in the query.
-    query_norm = la.norm(list(query_terms_count.values()))
-
-    for termIndex, term in enumerate(terms):  #termIndex is the index of the term in the query
-        if term not in index:
-            continue
-
-        ## Compute tf*idf(normalize TF as done with products)
-        query_vector[termIndex] = query_terms_count[term] / query_norm * idf[term]
-
-        # Generate product_vectors for matching products
-        for pid_index, pid in enumerate(index[term].keys()):
-            # Example of pid_index, pid
-            # 0 JEAFNHERP6UHRQKH
-            # 1 JEAFNHERJGTGQ4GP
-
-            #tf[term][0] will contain the tf of the term "term" in the product JEAFNHERP6UHRQKH 
-            if pid in pids:
-                products_vectors[pid][termIndex] = tf[term][pid_index] * idf[term]  
-
-    # Calculate the score of each product
-    # compute the cosine similarity between queyVector and each productVector:
-
-    products_scores = [[product, np.dot(curProdVec, query_vector)] for product, curProdVec in products_vectors.items()]
-    products_scores.sort(reverse=True)
-    result_products = [x[1] for x in products_scores]
-    #print product titles instead if product id's
-    #result_products=[ title_index[x] for x in result_products ]
-    if len(result_products) == 0:
-        print("No results found, try again")
-        # query = input()
-        # products = search_tf_idf(query, index)
-    #print ('\n'.join(result_products), '\n')
-    return result_products, products_scores
+    doc_ids = np.asarray(doc_ids, dtype=np.int32)
+    # the product vectors only matter on the query terms: score = sum of tf*idf*query weight over the query terms
+    scores = ranker.score(terms)[doc_ids]
 
+    return _sort_scores(ranker.index, doc_ids, scores, k)
 
 
-def create_index_bm25(products_df, num_products):
+def rank_queries_tfidf(queries, ranker, k):
     """
-    Implement the inverted index and compute tf, df and idf
+    Rank a batch of queries (OR semantics) with the tf-idf weights: all the queries are scored with a single sparse
+    matrix product and the k best products of each query are selected with argpartition.
 
     Argument:
-    lines -- collection of Wikipedia articles
-    num_documents -- total number of documents
+    queries -- list of queries, each one a list of query terms
+    ranker -- TfidfRanker over the compact inverted index
+    k -- number of products to return per query
 
     Returns:
-    index - the inverted index (implemented through a Python dictionary) containing terms as keys and the corresponding
-    list of document these keys appears in (and the positions) as values.
-    tf - normalized term frequency for each term in each document
-    df - number of documents each term appear in
-    idf - inverse document frequency of each term
+    for every query, the list of ranked pids and the list of (pid, score) pairs
     """
 
-    index = defaultdict(lambda: defaultdict(lambda: 0))
-    tf = defaultdict(dict)  # term raw frequencies: tf[term][pid] = freq
-    df = defaultdict(int)  # document frequencies of terms in the corpus
-    title_index = defaultdict(str)
-    desc_index = defaultdict(str)
-    idf = defaultdict(float)
-    doc_len = defaultdict(float) # dict of pid and document length
+    results = []
+    for doc_ids, scores in ranker.top_k_batch(queries, k):
+        result_products = [ranker.index.pid(doc_id) for doc_id in doc_ids]
+        results.append((result_products, list(zip(result_products, scores.tolist()))))
+    return results
+
 
-    for _, line in products_df.iterrows():
+def rank_products_bm25(terms, doc_ids, ranker, k=None):
+    """
+    Perform the ranking of the results of a search based on the BM25 weights
 
-        pid = line['pid']
-        terms = line['title_clean'] + line['description_clean']
+    Argument:
+    terms -- list of query terms
+    doc_ids -- sorted array of doc ids of the products, to rank, matching the query
+    ranker -- BM25Ranker (compact index + length normalisation of every product precomputed at build time)
+    k -- if given, only the k best products are returned
 
-        title = line['title']
-        desc = line['description']
-        title_index[pid] = title  ## we do not need to apply get terms to title because it used only to print titles and not in the index
-        desc_index[pid] = desc
+    Returns:
+    the list of ranked pids and the list of (pid, score) pairs
+    """
 
-        doc_len[pid] = len(terms) # (product length after removing stopwords)
+    doc_ids = np.asarray(doc_ids, dtype=np.int32)
+    rsv_product = ranker.score(terms)[doc_ids]
 
-        current_product_terms = defaultdict(lambda: 0)
-        for term in terms:
-            current_product_terms[term] += 1
-            index[term][pid] += 1
+    return _sort_scores(ranker.index, doc_ids, rsv_product, k)
 
-        # term raw frequencies 
-        for term, freq in current_product_terms.items():
-            tf[term][pid] = freq 
-            #increment the document frequency of current term (number of documents containing the current term)
-            df[term] += 1 # increment DF for current term
 
+def rank_products_bm25_proximity(terms, doc_ids, ranker, k=None):
+    """
+    Rank products with BM25 plus a term proximity score (query terms close to each other in the product rank higher,
+    see positions.proximity_scores). Only the positions of the candidates are read.
 
-    # Compute IDF 
-    for term in df:
-        idf[term] = np.round(np.log(float(num_products / df[term])), 4)
+    Returns:
+    the list of ranked pids and the list of (pid, score) pairs
+    """
 
-    L_ave = 0
-    for pid in doc_len.keys():
-        L_ave += doc_len[pid]
-    L_ave /= len(doc_len)
+    doc_ids = np.asarray(doc_ids, dtype=np.int32)
+    term_weights = [(term_id, ranker.index.idf[term_id]) for term_id, _ in ranker.query_weights(terms)]
+    scores = ranker.score(terms)[doc_ids] + proximity_scores(ranker.index, term_weights, doc_ids)
 
-    return index, tf, df, idf, title_index, desc_index, doc_len, L_ave
+    return _sort_scores(ranker.index, doc_ids, scores, k)
 
 
-def rank_products_bm25(terms, pids, index, idf, tf, doc_len, L_ave, k1, b):
+def top_k_products(terms, ranker, k, mask=None):
     """
-    Perform the ranking of the results of a search based on the tf-idf weights
+    Return the k best products containing at least one of the query terms (OR query), using MaxScore pruning so
+    products that cannot enter the top k are never fully scored. If mask is given, only the products where it is
+    True are candidates (structured filters).
 
-    Argument:
-    terms -- list of query terms
-    pids -- list of products, to rank, matching the query
-    index -- inverted index data structure
-    idf -- inverted document frequencies
-    tf -- term raw frequencies for a given product
-    doc_len -- dictionary of product id: length of title + description
-    L_ave -- average length of all products
+    Returns:
+    the list of ranked pids and the list of (pid, score) pairs
+    """
+
+    doc_ids, scores = top_k(ranker, terms, k, mask)
+
+    return _sort_scores(ranker.index, doc_ids, scores, k)
+
+
+def rank_products_ourscore(query, doc_ids, scores, ranker, reranker, k=None, highest=None):
+    """
+    Re-rank the candidates of a first stage for the query terms (their doc ids and BM25 scores) with "our score": the
+    BM25 score blended with the rating, discount, price and availability of the products (see reranker.FeatureReranker).
+    highest is the highest BM25 score of the query (max_score of the ranker if not given).
 
     Returns:
-    Print the list of ranked product
+    the list of ranked pids and the list of (pid, score) pairs
     """
 
-    rsv_product = defaultdict(float)
-    
-    for pid in pids:
-        for termIndex, term in enumerate(terms):  #termIndex is the index of the term in the query
-            if term not in index:
-                continue
-            
-            tf_ij = tf[term].get(pid, 0)  # <-- SAFE TF lookup
-
-            if tf_ij == 0:
-                continue  # term not in this product → skip
-
-            # Calculate the score of each product
-            # sum for term in query: idf * formula
-            numerator = (k1 + 1) * tf_ij
-            denominator = k1 * ((1 - b) + b *(doc_len[pid]/L_ave)) + tf_ij
-            rsv_product[pid] += idf[term] * numerator / denominator
-    
-    sorted_rsv = sorted(rsv_product.items(), key=lambda x: x[1], reverse=True)
-
-    result_products = [x[0] for x in sorted_rsv]
-    #products_scores = [x[1] for x in sorted_rsv]
-    if len(sorted_rsv) == 0:
-        print("No results found, try again")
-
-    return result_products, sorted_rsv
+    doc_ids = np.asarray(doc_ids, dtype=np.int32)
+    order = np.argsort(doc_ids)  # ties keep the doc id order, like the other rankings
+    doc_ids, scores = doc_ids[order], np.asarray(scores)[order]
 
+    return _sort_scores(ranker.index, doc_ids, reranker.rerank(doc_ids, scores, highest if highest is not None else max_score(ranker, query)), k)
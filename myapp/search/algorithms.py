@@ -1,143 +1,347 @@
-import pandas as pd
-from .algorithm_functions import build_terms, create_index_tfidf, create_index_bm25, rank_products_tfidf, rank_products_bm25#, rank_products_ourscore
-import dill
+import numpy as np
+from .algorithm_functions import ANALYZER, _sort_scores, parse_query, rank_products_tfidf, rank_products_bm25, rank_products_bm25_proximity, top_k_products, rank_products_ourscore
+from .compact_index import CompactIndex
+from .positions import match_phrases
+from .rankers import BM25Ranker, TfidfRanker, combined_max_score, top_k
+from .postings import intersect_postings, union_size
+from .corpus_store import CORPUS_FILE
+from .dense import DENSE_FILE, MODELS as DENSE_MODELS
+from .registry import IndexRegistry
+import collections
+import heapq
+import multiprocessing
 import os
+import time
 from dotenv import load_dotenv
 load_dotenv()  # take environment variables from .env
 
-# so index is read only once
-TFIDF_INDEX = None
-BM25_INDEX = None
-
-def build_tfidf_index(corpus):
-    """
-    Convert corpus (dict of Document objects) into a DataFrame
-    and build the TF-IDF inverted index.
-    """
-    products = []
-    for pid, doc in corpus.items():
-        products.append({
-            "pid": pid,
-            "title": doc.title,
-            "description": doc.description,
-            "title_clean": build_terms(doc.title),
-            "description_clean": build_terms(doc.description)
-        })
-
-    df = pd.DataFrame(products)
-    num_products = len(df)
-
-    index, tf, dfreq, idf, title_index, desc_index = create_index_tfidf(df, num_products)
-
-    return {
-        "index": index,
-        "tf": tf,
-        "df": dfreq,
-        "idf": idf,
-        "title_index": title_index,
-        "desc_index": desc_index,
-        "df": df
-    }
+# binary index file written by build_index.py (see index_file.py)
+INDEX_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "products_index.bin")
+
+# number of best BM25 products re-ranked with the proximity score by 'bm25-prox'
+PROXIMITY_DEPTH = 100
+
+# number of best BM25 products (first stage) re-ranked with the product features by 'our-score'
+RERANK_DEPTH = 100
+
+# number of products returned by the dense algorithms when no k is given
+DENSE_DEPTH = 1000
+
+# index (and corpus store) used by search_in_corpus, loaded by the web app at startup (see IndexRegistry)
+REGISTRY = IndexRegistry(INDEX_FILE, CORPUS_FILE, DENSE_FILE)
+
+def _index_chunk(chunk, positions=False):
+    """
+    Worker of build_indexes: tokenise a slice of the corpus (list of (pid, title, description)) and index it
+    (with the positions of the terms if positions is True).
+    """
+    pids, titles, descriptions = zip(*chunk)
+    title_terms = ANALYZER.analyze_many(titles)
+    description_terms = ANALYZER.analyze_many(descriptions)
+    # title and description are separate fields: phrases and proximity windows don't match across them
+    return CompactIndex.from_documents(zip(pids, zip(title_terms, description_terms)), positions=positions)
+
+
+def index_documents(documents, positions=False):
+    """
+    Tokenise and index a (small) list of Document objects in the current process, e.g. the products of an
+    incremental update (see segments.py).
+    """
+    if not documents:
+        return CompactIndex.from_documents([], positions=positions)
+    return _index_chunk([(doc.pid, doc.title, doc.description) for doc in documents], positions)
+
+
+def _chunks(documents, chunk_size):
+    """Group an iterable of Document objects into lists of (pid, title, description) of chunk_size products."""
+    chunk = []
+    for doc in documents:
+        chunk.append((doc.pid, doc.title, doc.description))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def build_indexes(corpus, workers=None, chunk_size=2000, positions=None):
+    """
+    Build the compact index of the corpus and the TF-IDF and BM25 rankers in a single pass. The corpus is a dict of
+    Document objects or any iterable of Documents, e.g. a generator streaming them from the products file.
+
+    Every product is tokenised once: the corpus is split in chunks that a pool of worker processes tokenise and
+    index in parallel, and the partial indexes are merged (in corpus order) into one compact index. Both models are
+    computed from these same postings. Progress is reported in products per second.
+    The corpus is consumed lazily: at most two chunks per worker are read ahead of the indexing, so only the
+    partial indexes (and not the products) accumulate in memory.
+    On platforms without fork (Windows) the build runs in a single process.
+    The positions of the terms are indexed too (for phrase and proximity queries) unless positions is False or the
+    INDEX_POSITIONS environment variable is 0.
+    """
+    if workers is None:
+        workers = int(os.getenv("INDEX_WORKERS", os.cpu_count() or 1))
+    if positions is None:
+        positions = os.getenv("INDEX_POSITIONS", "1") != "0"
+    documents = corpus.values() if isinstance(corpus, dict) else corpus
+    total = "/{}".format(len(corpus)) if hasattr(corpus, "__len__") else ""
+
+    start = time.time()
+    indexed = 0
+    parts = []
 
-def build_bm25_index(corpus):
-    """
-    Convert corpus (dict of Document objects) into a DataFrame
-    and build the TF-IDF inverted index.
-    """
-    products = []
-    for pid, doc in corpus.items():
-        products.append({
-            "pid": pid,
-            "title": doc.title,
-            "description": doc.description,
-            "title_clean": build_terms(doc.title),
-            "description_clean": build_terms(doc.description)
-        })
-
-    df = pd.DataFrame(products)
-    num_products = len(df)
-
-    index, tf, df, idf, title_index, desc_index, doc_len, L_ave = create_index_bm25(df, num_products)
-
-    return {
-        "index": index,
-        "tf": tf,
-        "df": df,
-        "idf": idf,
-        "title_index": title_index,
-        "desc_index": desc_index,
-        "df": df,
-        "doc_len": doc_len,
-        "L_ave": L_ave
+    def progress(part):
+        nonlocal indexed
+        parts.append(part)
+        indexed += part.num_docs
+        elapsed = time.time() - start
+        print("Indexed {}{} products ({:.0f} products/s)".format(indexed, total, indexed / elapsed if elapsed else 0))
+
+    chunks = _chunks(documents, chunk_size)
+    if workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_index_chunk, (chunk, positions)))
+                if len(pending) == 2 * workers:
+                    progress(pending.popleft().get())  # results are taken in submission (corpus) order
+            while pending:
+                progress(pending.popleft().get())
+    else:
+        for chunk in chunks:
+            progress(_index_chunk(chunk, positions))
+
+    index = CompactIndex.merge(parts) if parts else CompactIndex.from_documents([])
+
+    # both models are computed from the same postings
+    rankers = {
+        "tfidf": TfidfRanker(index),  # tf-idf weights and per-term score upper bounds precomputed once here
+        "bm25": BM25Ranker(index, k1=1.2, b=0.75),  # length normalisation precomputed once here
     }
+    return index, rankers
 
-def search_in_corpus(algorithm, query, corpus):
-    global TFIDF_INDEX
-    global BM25_INDEX
-    # If first call → build the TF-IDF index
-    if TFIDF_INDEX is None and (algorithm=='tfidf' or algorithm=='tfidf-or'):
-        print("Opening TF-IDF index...")
-        full_path = os.path.realpath(__file__)
-        path, filename = os.path.split(full_path)
-        file_path = path + "/tfidf_index.dill"
-
-        with open(file_path, "rb") as f:
-            TFIDF_INDEX = dill.load(f)
-        print("TF-IDF index opened.")
-    
-    elif BM25_INDEX is None and (algorithm=='bm25' or algorithm=='bm25-or'): 
-        print("Opening BM25 index...")
-        full_path = os.path.realpath(__file__)
-        path, filename = os.path.split(full_path)
-        file_path = path + "/bm25_index.dill"
-
-        with open(file_path, "rb") as f:
-            BM25_INDEX = dill.load(f)
-        print("BM25 index opened.")
-
-    index = BM25_INDEX if BM25_INDEX is not None else TFIDF_INDEX
-
-    query = build_terms(query)  # so that stemmed terms are matched in the index
+def search_in_corpus(algorithm, query, corpus, k=None, filters=None):
+    """
+    Search the query with the given algorithm and return the ranked pids and the (pid, score) pairs.
+    If k is given, only the k best products are returned; OR queries then use MaxScore pruning so the cost of
+    very common terms does not grow with the number of products containing them.
+    Quoted phrases ("slim fit jeans") and proximity operators ("slim jeans"~3) must be matched (see parse_query).
+    filters restricts the search to the products matching structured filters (see FilterIndex.mask).
+    """
+    query, phrases = parse_query(query)  # so that stemmed terms are matched in the index
 
-    # conjunctive query
-    if algorithm == 'tfidf' or algorithm =='bm25':
-        products = None  # start with None to handle first term properly
+    ranked_products, product_scores, total_hits = search_terms(algorithm, query, k, phrases, filters)
+    return ranked_products, product_scores
 
-        for term in query:
-            try:
-                term_products = set(index["index"][term].keys())  # products containing this term (either index is fine because they have the same keys)
 
-                if products is None:
-                    products = term_products  # initialize with first term's product
-                else:
-                    products &= term_products  # intersection with the next term’s product
+def search_terms(algorithm, query, k=None, phrases=(), filters=None):
+    """
+    Same as search_in_corpus, for a query that is already analysed (list of terms, and list of (terms, slop)
+    phrase / proximity operators).
+    Also returns the total number of products matching the query (even if only k are ranked).
 
-            except:
-                # if a term isn't in the index, then no product contains ALL terms
-                return []
-        if not products:  # catches None or empty set
-            return [], []
-        products = list(products)
+    Algorithms: 'tfidf' and 'bm25' (AND queries), 'tfidf-or' and 'bm25-or' (OR queries), 'bm25-prox', an OR
+    query ranked by BM25 plus a term proximity score (the PROXIMITY_DEPTH best BM25 products are re-ranked), and
+    'w2v' and 'd2v', dense retrieval by cosine similarity of embeddings (see dense.py), and 'our-score', an OR query
+    whose RERANK_DEPTH best BM25 products are re-ranked with their rating, discount, price and availability (see
+    reranker.py).
+    The products must match every phrase / proximity operator; with OR queries, the other terms only add to the score.
+    Filters are applied while the candidates are generated: the products they allow are one more list of the AND
+    intersection, and OR queries drop the other products from the posting lists before scoring them.
 
-    # OR query (products that contain at least 1 term of the query)
-    elif algorithm == 'tfidf-or' or algorithm == 'bm25-or':
-        products = set()  # start with None to handle first term properly
+    The base index and the segments of incremental updates (REGISTRY.parts) are searched one after the other, the
+    products hidden by tombstones being filtered out like the filters do, and their results are merged by score (ties
+    in the order of the parts, i.e. the doc id order of the index they will be merged into): segments are scored with
+    the statistics of the base index, so their scores are comparable. The dense algorithms only search the base index.
+    """
+    # the web app loads the registry at startup; scripts and notebooks get it loaded on their first search
+    if not REGISTRY.ready:
+        REGISTRY.load()
+    parts = REGISTRY.parts  # the same parts for the whole query, even if a segment is loaded meanwhile
+    if algorithm in DENSE_MODELS:
+        parts = parts[:1]
+    if len(parts) == 1:
+        return _search_part(parts[0], algorithm, query, k, phrases, filters)
 
-        for term in query:
-            try:
-                term_products = set(index["index"][term].keys())  # products containing this term (either index is fine because they have the same keys)
+    highest = combined_max_score([part.ranker('bm25') for part in parts], query) if algorithm == 'our-score' else None
+    results = [_search_part(part, algorithm, query, k, phrases, filters, highest) for part in parts]
+    # every part's results are sorted by decreasing score: merge them (a stable merge keeps the parts in order on ties)
+    product_scores = list(heapq.merge(*(scores for _, scores, _ in results), key=lambda pid_score: -pid_score[1]))[:k]
+    return [pid for pid, _ in product_scores], product_scores, sum(total for _, _, total in results)
 
-                products |= term_products
-            except:
-                # if a term isn't in the index
-                pass
-        if not products:  # catches None or empty set
-            return [], []
-        products = list(products)
+
+def _search_part(part, algorithm, query, k=None, phrases=(), filters=None, highest=None):
+    """
+    search_terms on one part of the index (IndexPart), without the products it hides. highest is the highest BM25
+    score of the query over all the parts ('our-score').
+    """
+    # candidates are generated on the shared postings (ranker.index), then ranked by the model of the algorithm
+    ranker = part.ranker('tfidf' if algorithm.startswith('tfidf') else 'bm25')
+    index = ranker.index
+    phrases = [([index.term_id(term) for term in phrase_terms], slop) for phrase_terms, slop in phrases]
+    mask = _filter_mask(part, filters)
+    allowed = np.flatnonzero(mask).astype(np.int32) if filters else None  # sorted doc ids the filters allow
+
+    if algorithm in DENSE_MODELS:
+        return _search_dense(part, algorithm, query, k, phrases, mask, allowed)
+
+    # conjunctive query
+    if algorithm == 'tfidf' or algorithm =='bm25':
+        term_ids = [index.term_id(term) for term in query]
+        if not term_ids or None in term_ids:
+            # if a term isn't in the index, then no product contains ALL terms
+            return [], [], 0
+
+        # sorted doc ids of the products containing ALL the terms, rarest term first
+        posting_lists = [index.postings(term_id)[0] for term_id in set(term_ids)]
+        if allowed is not None:
+            posting_lists.append(allowed)  # a selective filter becomes the rarest list of the intersection
+        products = intersect_postings(posting_lists)
+        if phrases:
+            # positions are only read for the products that contain all the terms
+            products = match_phrases(index, phrases, products)
+        if part.live is not None:
+            products = products[part.live[products]]
+        if len(products) == 0:
+            return [], [], 0
+
+    # OR query (products that contain at least 1 term of the query)
+    elif algorithm == 'tfidf-or' or algorithm == 'bm25-or' or algorithm == 'bm25-prox' or algorithm == 'our-score':
+        term_ids = [index.term_id(term) for term in query]
+        # terms that aren't in the index are ignored
+        postings = [index.postings(term_id)[0] for term_id in set(term_ids) if term_id is not None]
+        if not postings:
+            return [], [], 0
+
+        if phrases:
+            products = match_phrases(index, phrases, allowed)
+            if part.live is not None:
+                products = products[part.live[products]]
+            if len(products) == 0:
+                return [], [], 0
+        elif k is not None and algorithm == 'bm25-prox':
+            # re-rank the best BM25 products only
+            products = np.sort(top_k(ranker, query, max(k, PROXIMITY_DEPTH), mask)[0])
+            ranked_products, product_scores = rank_products_bm25_proximity(query, products, ranker, k)
+            return ranked_products, product_scores, union_size(postings, index.num_docs, mask)
+        elif k is not None and algorithm == 'our-score':
+            # ranking cascade: cheap first stage (MaxScore top k), then the features of these candidates only
+            doc_ids, scores = top_k(ranker, query, max(k, RERANK_DEPTH), mask)
+            ranked_products, product_scores = rank_products_ourscore(query, doc_ids, scores, ranker, _reranker(part), k, highest)
+            return ranked_products, product_scores, union_size(postings, index.num_docs, mask)
+        elif k is not None:
+            ranked_products, product_scores = top_k_products(query, ranker, k, mask)
+            return ranked_products, product_scores, union_size(postings, index.num_docs, mask)
+        else:
+            products = np.unique(np.concatenate(postings))
+            if mask is not None:
+                products = products[mask[products]]
+                if len(products) == 0:
+                    return [], [], 0
 
     if algorithm == 'tfidf' or algorithm == 'tfidf-or':
-        ranked_products, product_scores = rank_products_tfidf(query, products, TFIDF_INDEX["index"], TFIDF_INDEX["idf"], TFIDF_INDEX["tf"], TFIDF_INDEX["title_index"])
+        ranked_products, product_scores = rank_products_tfidf(query, products, ranker, k)
     elif algorithm == 'bm25' or algorithm == 'bm25-or':
-        ranked_products, product_scores = rank_products_bm25(query, products, BM25_INDEX["index"], BM25_INDEX["idf"], BM25_INDEX["tf"], BM25_INDEX["doc_len"], BM25_INDEX['L_ave'], k1=1.2, b=0.75)
+        ranked_products, product_scores = rank_products_bm25(query, products, ranker, k)
+    elif algorithm == 'bm25-prox':
+        ranked_products, product_scores = rank_products_bm25_proximity(query, products, ranker, k)
+    elif algorithm == 'our-score':
+        products = np.asarray(products, dtype=np.int32)
+        ranked_products, product_scores = rank_products_ourscore(query, products, ranker.score(query)[products], ranker,
+                                                                 _reranker(part), k, highest)
 
-    return ranked_products, product_scores
+    return ranked_products, product_scores, len(products)
+
+
+def _search_dense(part, algorithm, query, k, phrases, mask, allowed):
+    """
+    Dense retrieval part of search_terms: the k most similar products found by the IVF index of the model, restricted
+    to the products matching the filters and the phrase / proximity operators. The results of a dense search are
+    its DENSE_DEPTH best products in the probed lists (whatever k is, so the number of hits and the facets don't
+    depend on the page; a selective filter widens the probe, see IVFIndex.search).
+    """
+    doc_ids, scores, _ = _dense_top_k(part, algorithm, query, DENSE_DEPTH, phrases, mask, allowed)
+    order = np.argsort(doc_ids)  # ties in doc id order, like the other algorithms
+    ranked_products, product_scores = _sort_scores(part.index, doc_ids[order], scores[order], k)
+    return ranked_products, product_scores, len(doc_ids)
+
+
+def _dense_top_k(part, algorithm, query, k, phrases, mask, allowed):
+    """Return the doc ids and similarities of the k best products of a dense model, and the number of products scored."""
+    if part.dense is None or algorithm not in part.dense.models:
+        raise ValueError("No {} vectors: build them with build_index.py (needs gensim).".format(algorithm))
+    if phrases:
+        matches = match_phrases(part.index, phrases, allowed)
+        if part.live is not None:
+            matches = matches[part.live[matches]]
+        mask = np.zeros(part.index.num_docs, dtype=bool)
+        mask[matches] = True
+    return part.dense.models[algorithm].search(query, k, mask=mask)
+
+
+def _filter_mask(part, filters):
+    """
+    Return the boolean array (indexed by doc id) of the products of a part allowed by the filters and not hidden by a
+    tombstone, or None without filters and tombstones.
+    """
+    if not filters:
+        return part.live
+    if part.filters is None:
+        raise ValueError("Filters need the corpus store: load the registry with a corpus_path.")
+    mask = part.filters.mask(filters)
+    return mask & part.live if part.live is not None else mask
+
+
+def _reranker(part):
+    """Return the feature re-ranker of 'our-score' (it needs the product features of the corpus store)."""
+    if part.reranker is None:
+        raise ValueError("'our-score' needs the corpus store: load the registry with a corpus_path.")
+    return part.reranker
+
+
+def result_masks(algorithm, query, phrases=(), filters=None):
+    """
+    Return the boolean arrays (indexed by doc id) of all the products matching an analysed query with the given
+    algorithm and filters (the whole result set, not only the ranked top k), e.g. to count facets over it: one
+    (part, mask) pair per part of the index (see IndexRegistry.parts).
+    """
+    if not REGISTRY.ready:
+        REGISTRY.load()
+    return [(part, _result_mask(part, algorithm, query, phrases, filters)) for part in REGISTRY.parts]
+
+
+def _result_mask(part, algorithm, query, phrases=(), filters=None):
+    index = part.index
+    term_ids = [index.term_id(term) for term in query]
+    phrases = [([index.term_id(term) for term in phrase_terms], slop) for phrase_terms, slop in phrases]
+    mask = _filter_mask(part, filters)
+    matches = np.zeros(index.num_docs, dtype=bool)
+
+    if algorithm in DENSE_MODELS:
+        # the results of a dense search are its DENSE_DEPTH best products (of the base index: segments have no vectors)
+        if part.path is not None:
+            return matches
+        allowed = np.flatnonzero(mask).astype(np.int32) if filters else None
+        matches[_dense_top_k(part, algorithm, query, DENSE_DEPTH, phrases, mask, allowed)[0]] = True
+        return matches
+
+    if algorithm == 'tfidf' or algorithm == 'bm25':
+        if not term_ids or None in term_ids:
+            return matches
+        posting_lists = [index.postings(term_id)[0] for term_id in set(term_ids)]
+        if filters:
+            posting_lists.append(np.flatnonzero(mask).astype(np.int32))
+        products = intersect_postings(posting_lists)
+        if phrases:
+            products = match_phrases(index, phrases, products)
+        matches[products] = True
+    elif phrases:
+        if any(term_id is not None for term_id in term_ids):
+            matches[match_phrases(index, phrases, np.flatnonzero(mask).astype(np.int32) if filters else None)] = True
+    else:
+        # the union of the posting lists is only marked, like union_size
+        for term_id in set(term_ids):
+            if term_id is not None:
+                matches[index.postings(term_id)[0]] = True
+    if mask is not None:
+        matches &= mask
+    return matches
@@ -0,0 +1,235 @@
+import re
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+from .algorithm_functions import ANALYZER
+
+# number of suggestions returned by default (and precomputed for the prefixes with many completions)
+MAX_SUGGESTIONS = 10
+
+# prefixes with more completions than this get their best ones precomputed, so no lookup sorts more entries
+HEAVY_PREFIX = 256
+
+# number of new / updated queries kept aside before they are merged into the sorted arrays
+MERGE_THRESHOLD = 256
+
+SPACES = re.compile(r'\s+')
+
+
+class PrefixIndex:
+    """
+    Read-only prefix structure over a set of strings with a popularity each: the strings are kept as one sorted bytes
+    array (UTF-8) with their counts, so the completions of a prefix are the contiguous range found by two binary
+    searches (prefix and prefix + 0xff, a byte that never occurs in UTF-8).
+
+    The best completions of the prefixes with more than HEAVY_PREFIX entries (the first letters) are precomputed when
+    the index is built, so a lookup never ranks more than HEAVY_PREFIX entries. Ties are broken alphabetically.
+    """
+
+    def __init__(self, counts):
+        keys = np.array([key.encode() for key in counts], dtype="S") if counts else np.array([], dtype="S1")
+        popularity = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.counts = popularity[order]
+        self.heavy = {}  # prefix (bytes) -> positions of its MAX_SUGGESTIONS best completions
+        if len(self.keys) > HEAVY_PREFIX:
+            self.heavy[b""] = self._rank(0, len(self.keys), MAX_SUGGESTIONS)
+        length = 1
+        while len(self.keys) > HEAVY_PREFIX:
+            # keys are sorted, so the keys sharing the same first `length` bytes are contiguous
+            prefixes, starts, sizes = np.unique(self.keys.astype("S{}".format(length)), return_index=True, return_counts=True)
+            heavy = np.flatnonzero(sizes > HEAVY_PREFIX)
+            if len(heavy) == 0:
+                break
+            for position in heavy:
+                self.heavy[prefixes[position]] = self._rank(starts[position], starts[position] + sizes[position], MAX_SUGGESTIONS)
+            length += 1
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + self.counts.nbytes + sum(positions.nbytes for positions in self.heavy.values())
+
+    def _rank(self, start, end, n):
+        """Return the positions of the n most popular keys between start and end (sorted, so ties stay alphabetical)."""
+        order = np.argsort(-self.counts[start:end], kind="stable")[:n]
+        return start + order
+
+    def top(self, prefix, n=MAX_SUGGESTIONS):
+        """Return the (key, count) pairs of the n most popular keys starting with prefix, most popular first."""
+        key = prefix.encode()
+        if n <= MAX_SUGGESTIONS and key in self.heavy:
+            positions = self.heavy[key][:n]
+        else:
+            start = np.searchsorted(self.keys, key, side="left")
+            end = np.searchsorted(self.keys, key + b"\xff", side="left")
+            positions = self._rank(start, end, n)
+        return [(key.decode(), int(count)) for key, count in zip(self.keys[positions], self.counts[positions])]
+
+
+def surface_form_counts(corpus, index):
+    """
+    Return the number of products whose title contains each surface form (un-stemmed word) of the index vocabulary.
+    Only the words that the analyzer keeps, and whose stem is a term of the index, are counted.
+    """
+    counts = Counter()
+    data = corpus.arrays["title_data"].tobytes()
+    offsets = corpus.arrays["title_offsets"].tolist()
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        counts.update(set(ANALYZER.tokens(data[start:end].decode())))
+    stems = {word: ANALYZER.stem(word) for word in counts}
+    return {word: count for word, count in counts.items() if index.term_id(stems[word]) is not None}
+
+
+class Autocomplete:
+    """
+    Suggestions for the search box, from two prefix indexes (see PrefixIndex):
+
+    - popular queries: how many times each (normalised) query that found products was searched. The counts are those
+      of AnalyticsData (query_counts), read here and never written: this class only indexes them;
+    - the index vocabulary: the surface forms of the terms (the words as they appear in the titles, not their stems),
+      by number of products. They complete the last word of the prefix ("cotton sh" -> "cotton shirt").
+
+    Queries come first, then words, without duplicates. The queries counted since the query index was built are kept
+    aside (pending) and only merged into the sorted arrays, in a background thread, once there are MERGE_THRESHOLD of
+    them; lookups read their current count, so suggestions are always up to date and counting a query never rebuilds the arrays. The
+    vocabulary is built when the object is created (if the registry is loaded) and then again, in a background thread,
+    when the registry loads a new base index (base_generation: the words of the segments of incremental updates are
+    added when they are merged into it); until it is ready, the vocabulary of the previous one is used.
+    """
+
+    def __init__(self, registry, counts=None, merge_threshold=MERGE_THRESHOLD):
+        self.registry = registry
+        self.counts = counts if counts is not None else Counter()  # query -> searches that found products
+        self.merge_threshold = merge_threshold
+        self.queries = PrefixIndex(dict(self.counts))
+        self.pending = Counter()  # queries counted since the last merge (number of times)
+        self.words = None
+        self.generation = None
+        self.merges = 0
+        self._merging = False
+        self._building = None  # generation whose vocabulary is being built
+        self._lock = threading.Lock()
+        self._build_ms = 0.0
+        if registry.ready:
+            # built right away at startup (e.g. before the web app forks its workers, which then share it)
+            self._build_words()
+
+    def _refresh_words(self):
+        """Start building the vocabulary index in the background if the registry serves a new index."""
+        generation = self.registry.base_generation
+        if generation == self.generation:
+            return
+        with self._lock:
+            if generation == self.generation or self._building is not None:
+                return
+            self._building = generation
+        threading.Thread(target=self._build_words, name="autocomplete-words", daemon=True).start()
+
+    def _build_words(self):
+        try:
+            generation, corpus, index = self.registry.base_generation, self.registry.corpus, self.registry.index
+            start = time.perf_counter()
+            words = PrefixIndex(surface_form_counts(corpus, index))
+            with self._lock:
+                self.words, self.generation = words, generation
+                self._build_ms = (time.perf_counter() - start) * 1000
+        finally:
+            with self._lock:
+                self._building = None
+
+    def add_query(self, query):
+        """
+        Take into account a query that was just counted in counts (see AnalyticsData.log_query). Once there are
+        merge_threshold pending queries, they are merged into the query index in a background thread, so the request
+        that counted the last one does not wait for it.
+        """
+        with self._lock:
+            self.pending[query] += 1
+            if len(self.pending) < self.merge_threshold or self._merging:
+                return
+            self._merging = True
+            merged = Counter(self.pending)
+        threading.Thread(target=self._merge, args=(merged,), name="autocomplete-queries", daemon=True).start()
+
+    def _merge(self, merged):
+        # the arrays are built again without holding the lock: meanwhile lookups use the previous ones and the pending
+        # queries. The counts are copied after the pending queries, so a query counted during the merge stays pending
+        try:
+            queries = PrefixIndex(dict(self.counts))
+            with self._lock:
+                self.queries = queries
+                self.pending = self.pending - merged
+                self.merges += 1
+        finally:
+            self._merging = False
+
+    def _top_queries(self, prefix, n):
+        with self._lock:
+            queries, pending = self.queries, [query for query in self.pending if query.startswith(prefix)]
+        # a query that is not pending keeps the count it was indexed with, so it can only be in the result if it is in
+        # the top n of the query index; the pending ones are ranked with their current count
+        counts = dict(queries.top(prefix, n))
+        for query in pending:
+            counts[query] = self.counts[query]
+        return sorted(counts.items(), key=lambda query_count: (-query_count[1], query_count[0]))[:n]
+
+    def suggest(self, prefix, n=MAX_SUGGESTIONS):
+        """Return up to n suggestions for what is typed in the search box: popular queries first, then words."""
+        self._refresh_words()
+        prefix = SPACES.sub(' ', prefix.lower()).lstrip()
+        if not prefix.strip():
+            return []
+        suggestions = [query for query, _ in self._top_queries(prefix, n)]
+        head, _, last = prefix.rpartition(" ")
+        words = self.words
+        if last and len(suggestions) < n and words is not None:
+            head = head + " " if head else ""
+            for word, _ in words.top(last, n):
+                suggestion = head + word
+                if suggestion not in suggestions:
+                    suggestions.append(suggestion)
+                    if len(suggestions) == n:
+                        break
+        return suggestions
+
+    def stats(self):
+        """Size of the prefix indexes (for /healthz)."""
+        with self._lock:
+            pending = len(self.pending)
+            words = self.words
+        return {
+            "queries": len(self.counts),
+            "pending": pending,
+            "merges": self.merges,
+            "words": len(words) if words is not None else 0,
+            "words_generation": self.generation,
+            "words_build_ms": round(self._build_ms, 3),
+            "memory_bytes": self.queries.nbytes + (words.nbytes if words is not None else 0),
+        }
+
+
+if __name__ == "__main__":
+    # benchmark on the saved index and corpus store (python -m myapp.search.autocomplete): suggestions per prefix length
+    from .algorithms import REGISTRY
+
+    REGISTRY.load()
+    counts = Counter()
+    autocomplete = Autocomplete(REGISTRY, counts)
+    words = autocomplete.words.keys.astype(str)
+    for query in np.random.default_rng(0).choice(words, 2000):
+        counts[query] += 1
+        autocomplete.add_query(query)
+    print("{} words, {} queries".format(len(words), autocomplete.stats()["queries"]))
+    for length in (1, 2, 3, 5):
+        prefixes = [word[:length] for word in np.random.default_rng(length).choice(words, 500)]
+        start = time.perf_counter()
+        for prefix in prefixes:
+            autocomplete.suggest(prefix)
+        print("prefix of {} characters: {:8.1f} us".format(length, (time.perf_counter() - start) / len(prefixes) * 1e6))
@@ -1,31 +1,51 @@
-from myapp.search.load_corpus import load_corpus
-from myapp.search.algorithms import build_tfidf_index, build_bm25_index
+from myapp.search.load_corpus import iter_documents
+from myapp.search.algorithms import INDEX_FILE, build_indexes
+from myapp.search.registry import save_indexes
+from myapp.search.corpus_store import CORPUS_FILE, CorpusStoreBuilder
+from myapp.search.algorithm_functions import ANALYZER
+from myapp.search import dense
 import os
-import dill
 from dotenv import load_dotenv
 load_dotenv()  # take environment variables from .env
 
 def main():
     file_path = os.getenv("DATA_FILE_PATH")
-    corpus = load_corpus(file_path)
+    store = CorpusStoreBuilder()
 
-    tfidf_index = build_tfidf_index(corpus)
-    bm25_index = build_bm25_index(corpus)
+    def documents():
+        # the products file is streamed in chunks: each chunk goes to the corpus store and to the indexer
+        for chunk in iter_documents(file_path):
+            store.add(chunk)
+            yield from chunk
 
-    full_path = os.path.realpath(__file__)
-    save_path, filename = os.path.split(full_path)
+    # single pass: products are tokenised once (in parallel) and both models share the same postings
+    index, rankers = build_indexes(documents())
 
-    save_path_tfidf = os.path.join(save_path, "tfidf_index.dill")
-    save_path_bm25 = os.path.join(save_path, "bm25_index.dill")
+    memory = index.memory_usage()
+    print("Index memory footprint: {:.2f} MB ({})".format(
+        memory["total"] / 2**20, ", ".join(f"{part}: {size / 2**20:.2f} MB" for part, size in memory.items() if part != "total")))
 
     # Save to disk
-    with open(save_path_tfidf, "wb") as f:
-        dill.dump(tfidf_index, f)
-    print("TF-IDF index precomputed and saved to tfidf_index.dill")
+    save_indexes(INDEX_FILE, index, rankers)
+    print("TF-IDF and BM25 indexes precomputed and saved to {}".format(os.path.basename(INDEX_FILE)))
 
-    with open(save_path_bm25, "wb") as f:
-        dill.dump(bm25_index, f)
-    print("BM25 index precomputed and saved to bm25_index.dill")
+    # columnar copy of the corpus (same product order as the index), opened by the web app instead of the JSON dataset
+    corpus = store.build()
+    corpus.save(CORPUS_FILE)
+    print("Corpus store saved to {}".format(os.path.basename(CORPUS_FILE)))
+
+    # product vectors of the dense algorithms (w2v, d2v), trained on the same terms as the index (DENSE_VECTORS=0 skips them)
+    if os.getenv("DENSE_VECTORS", "1") != "0":
+        if dense.gensim is None:
+            print("gensim is not installed: the w2v and d2v algorithms will not be available")
+        else:
+            # the terms the index workers produced, read back from the positions (analysed again only without them)
+            if index.has_positions:
+                documents = dense.ProductTerms.from_index(index)
+            else:
+                documents = dense.ProductTerms.from_corpus(corpus, index, ANALYZER)
+            dense.DenseIndex.build(documents, dense.DENSE_FILE)
+            print("Dense vectors saved to {}".format(os.path.basename(dense.DENSE_FILE)))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,229 @@
+from collections import Counter
+
+import numpy as np
+
+from . import varbyte
+
+# positions skipped between two fields of a product: more than the widest phrase / proximity window (see MAX_SLOP)
+FIELD_GAP = 1000
+
+
+class CompactIndex:
+    """
+    Array-backed inverted index.
+
+    Terms are mapped to integer term ids and products to integer doc ids (the position of the product in the corpus).
+    The postings of all the terms are stored one after the other in two contiguous NumPy arrays, `doc_ids` and
+    `freqs` (raw term frequencies), so the posting list of term t is the slice offsets[t]:offsets[t + 1].
+    Doc ids inside a posting list are sorted in increasing order.
+
+    The term dictionary is a sorted array of fixed width byte strings: the term id of a term is its position in it,
+    found by binary search. Every part of the index is a flat NumPy array, so the index can be saved to and opened
+    from a memory-mapped file (see index_file.py) without rebuilding anything. idf and L_ave can be passed in when they
+    were saved with the index; otherwise they are computed.
+
+    Optionally (positional index), the positions of every term in every product are stored too: the positions of a
+    posting are delta-encoded (first position, then the gaps between consecutive ones) and varbyte coded, one posting
+    after the other in the byte array `positions`, posting i taking positions[position_offsets[i]:position_offsets[i + 1]]
+    (it holds freqs[i] positions). They are only decoded for the postings of the candidates that need them (phrase and
+    proximity queries, see positions.py).
+    """
+
+    def __init__(self, terms, pids, offsets, doc_ids, freqs, doc_len, doc_norm, idf=None, L_ave=None, positions=None,
+                 position_offsets=None):
+        self.terms = np.asarray(terms, dtype="S")  # term id -> term (sorted)
+        self.pids = np.asarray(pids, dtype="S")  # doc id -> pid (fixed width bytes, 1 byte per character)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.doc_ids = np.asarray(doc_ids, dtype=np.int32)
+        self.freqs = np.asarray(freqs, dtype=np.int32)
+        self.doc_len = np.asarray(doc_len, dtype=np.int32)  # number of terms of each product
+        self.doc_norm = np.asarray(doc_norm, dtype=np.float32)  # euclidean norm of the raw term frequencies
+
+        self.num_docs = len(self.pids)
+        self.df = np.diff(self.offsets)  # document frequency of each term
+        if idf is None:
+            idf = np.round(np.log(self.num_docs / self.df), 4)
+        self.idf = np.asarray(idf, dtype=np.float64)
+        if L_ave is None:
+            L_ave = float(self.doc_len.mean()) if self.num_docs else 0.0
+        self.L_ave = L_ave
+        self.positions = positions  # varbyte coded position deltas of every posting (None if not positional)
+        self.position_offsets = position_offsets
+
+    @property
+    def has_positions(self):
+        return self.positions is not None
+
+    @classmethod
+    def from_documents(cls, documents, positions=False):
+        """
+        Build the index from an iterable of (pid, terms) pairs, terms being the list of (stemmed) terms of the product,
+        or a tuple with the list of terms of each of its fields (e.g. title and description).
+        If positions is True, the positions of the terms (their index in the list of terms) are stored too; the
+        positions of a field start FIELD_GAP after the end of the previous field, so that a phrase or proximity
+        window never spans two fields.
+        """
+        term_ids = {}
+        pids = []
+        doc_len = []
+        doc_norm = []
+        posting_terms = []
+        posting_docs = []
+        posting_freqs = []
+        position_gaps = []  # first position and gaps of every posting, one posting after the other
+
+        for doc_id, (pid, terms) in enumerate(documents):
+            fields = terms if isinstance(terms, tuple) else (terms,)
+            if isinstance(terms, tuple):
+                terms = [term for field in fields for term in field]
+            pids.append(pid)
+            doc_len.append(len(terms))
+
+            current_product_terms = Counter(terms)
+            doc_norm.append(np.sqrt(sum(freq ** 2 for freq in current_product_terms.values())))
+
+            if positions:
+                term_positions = {}
+                start = 0
+                for field in fields:
+                    for position, term in enumerate(field, start):
+                        term_positions.setdefault(term, []).append(position)
+                    start += len(field) + FIELD_GAP
+
+            for term, freq in current_product_terms.items():
+                posting_terms.append(term_ids.setdefault(term, len(term_ids)))
+                posting_docs.append(doc_id)
+                posting_freqs.append(freq)
+                if positions:
+                    previous = 0
+                    for position in term_positions[term]:
+                        position_gaps.append(position - previous)
+                        previous = position
+
+        posting_freqs = np.asarray(posting_freqs, dtype=np.int32)
+        position_data = position_offsets = None
+        if positions:
+            position_data = varbyte.encode(position_gaps)
+            position_offsets = np.zeros(len(posting_freqs) + 1, dtype=np.int64)
+            if len(posting_freqs):
+                # bytes of every posting = sum of the code lengths of its freq positions
+                posting_bytes = np.add.reduceat(varbyte.byte_lengths(position_gaps), np.cumsum(posting_freqs) - posting_freqs)
+                np.cumsum(posting_bytes, out=position_offsets[1:])
+        return cls._from_postings(term_ids, pids, np.asarray(posting_terms, dtype=np.int32), np.asarray(posting_docs, dtype=np.int32),
+                                  posting_freqs, doc_len, doc_norm, position_data, position_offsets)
+
+    @classmethod
+    def merge(cls, parts):
+        """
+        Merge indexes built over consecutive slices of the corpus (e.g. by different worker processes) into one index.
+        The doc ids of each part are shifted by the number of products of the parts before it.
+        """
+        term_ids = {}
+        posting_terms = []
+        posting_docs = []
+        doc_offset = 0
+        for part in parts:
+            # translate the term ids of the part into the term ids of the merged dictionary
+            remap = np.array([term_ids.setdefault(term, len(term_ids)) for term in part.terms.tolist()], dtype=np.int32)
+            posting_terms.append(np.repeat(remap, part.df))
+            posting_docs.append(part.doc_ids + doc_offset)
+            doc_offset += part.num_docs
+
+        position_data = position_offsets = None
+        if parts and all(part.has_positions for part in parts):
+            position_data = np.concatenate([part.positions for part in parts])
+            shifts = np.cumsum([0] + [len(part.positions) for part in parts[:-1]])
+            position_offsets = np.concatenate([part.position_offsets[:-1] + shift for part, shift in zip(parts, shifts)] +
+                                              [np.array([len(position_data)], dtype=np.int64)])
+
+        return cls._from_postings(term_ids, np.concatenate([part.pids for part in parts]), np.concatenate(posting_terms),
+                                  np.concatenate(posting_docs), np.concatenate([part.freqs for part in parts]),
+                                  np.concatenate([part.doc_len for part in parts]), np.concatenate([part.doc_norm for part in parts]),
+                                  position_data, position_offsets)
+
+    def select(self, keep):
+        """
+        Return an index with only the products where the boolean mask `keep` (indexed by doc id) is True, renumbered
+        in the same order. Terms left without postings are dropped and the statistics (df, idf, L_ave) are recomputed.
+        """
+        if keep.all():
+            return self
+        new_doc_ids = np.cumsum(keep, dtype=np.int32) - 1  # old doc id -> new doc id (for the kept products)
+        kept = keep[self.doc_ids]
+        posting_terms = np.repeat(np.arange(len(self.terms), dtype=np.int32), self.df)[kept]
+        # term ids stay in sorted order: number the remaining terms consecutively
+        used_terms = np.unique(posting_terms)
+        term_ids = {term: i for i, term in enumerate(self.terms[used_terms].tolist())}
+        position_data = position_offsets = None
+        if self.has_positions:
+            starts = self.position_offsets[:-1][kept]
+            position_data, position_offsets = varbyte.gather_ranges(self.positions, starts, self.position_offsets[1:][kept] - starts)
+        return self._from_postings(term_ids, self.pids[keep], np.searchsorted(used_terms, posting_terms).astype(np.int32),
+                                   new_doc_ids[self.doc_ids[kept]], self.freqs[kept], self.doc_len[keep], self.doc_norm[keep],
+                                   position_data, position_offsets)
+
+    @classmethod
+    def _from_postings(cls, term_ids, pids, posting_terms, posting_docs, posting_freqs, doc_len, doc_norm,
+                       position_data=None, position_offsets=None):
+        """
+        Group (term id, doc id, freq) postings given in doc id order into the contiguous per-term layout, renumbering
+        the terms (term_ids maps term -> provisional term id) in sorted order. The coded positions of the postings, if
+        given (in the same order as the postings), are reordered the same way.
+        """
+        sorted_terms = sorted(term_ids)
+        rank = np.empty(len(term_ids), dtype=np.int32)  # provisional term id -> final term id
+        rank[[term_ids[term] for term in sorted_terms]] = np.arange(len(term_ids), dtype=np.int32)
+        terms = np.asarray(sorted_terms, dtype="S")
+        posting_terms = rank[posting_terms]
+
+        # postings come in doc id order, so a stable sort by term keeps every posting list sorted by doc id
+        order = np.argsort(posting_terms, kind="stable")
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(posting_terms, minlength=len(terms)), out=offsets[1:])
+        if position_data is not None:
+            starts = position_offsets[:-1][order]
+            position_data, position_offsets = varbyte.gather_ranges(position_data, starts, position_offsets[1:][order] - starts)
+        return cls(terms, pids, offsets, posting_docs[order], posting_freqs[order], doc_len, doc_norm,
+                   positions=position_data, position_offsets=position_offsets)
+
+    def term_id(self, term):
+        """Return the term id of a term, or None if the term is not in the index."""
+        key = term.encode()
+        term_id = int(np.searchsorted(self.terms, key))
+        if term_id < len(self.terms) and self.terms[term_id] == key:
+            return term_id
+        return None
+
+    def postings(self, term_id):
+        """Return the (doc_ids, freqs) arrays of a term. Both are views on the index arrays, not copies."""
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return self.doc_ids[start:end], self.freqs[start:end]
+
+    def pid(self, doc_id):
+        return self.pids[doc_id].decode()
+
+    def memory_usage(self):
+        """
+        Return the number of bytes used by each part of the index (and the total).
+        """
+        usage = {
+            "postings": self.doc_ids.nbytes + self.freqs.nbytes + self.offsets.nbytes,
+            "documents": self.pids.nbytes + self.doc_len.nbytes + self.doc_norm.nbytes,
+            "statistics": self.df.nbytes + self.idf.nbytes,
+            "terms": self.terms.nbytes,
+        }
+        if self.has_positions:
+            usage["positions"] = self.positions.nbytes + self.position_offsets.nbytes
+        usage["total"] = sum(usage.values())
+        return usage
+
+    def arrays(self):
+        """Return the arrays that make up the index, to save them (see index_file.py)."""
+        arrays = {"terms": self.terms, "pids": self.pids, "offsets": self.offsets, "doc_ids": self.doc_ids,
+                  "freqs": self.freqs, "doc_len": self.doc_len, "doc_norm": self.doc_norm, "idf": self.idf}
+        if self.has_positions:
+            arrays.update({"positions": self.positions, "position_offsets": self.position_offsets})
+        return arrays
+
+    def __len__(self):
+        return self.num_docs
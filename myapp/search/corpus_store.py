@@ -0,0 +1,250 @@
+import json
+import os
+from array import array
+
+import numpy as np
+
+from .index_file import read_index_file, write_index_file
+
+CORPUS_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "products_corpus.bin")
+
+
+class CorpusStore:
+    """
+    Columnar, read-only store of the corpus.
+
+    Every text field is a string table (all the values encoded in UTF-8 one after the other in one byte array, plus
+    an offsets array), the numeric fields are float64 arrays (NaN when missing) and out_of_stock is a bool array.
+    product_details and images are kept as JSON strings and only parsed when a product is displayed.
+    Row i is the product with doc id i in the index (the corpus order).
+
+    The store is built once from validated Document objects and saved with the same binary format as the index, so
+    the web app opens it with a memory map instead of parsing and validating the JSON dataset on every start.
+    It behaves like the old dict of Documents: store[pid] / store.get(pid) return a DocumentView of the product.
+    """
+
+    TEXT_FIELDS = ("pid", "title", "description", "brand", "category", "sub_category", "seller", "url")
+    JSON_FIELDS = ("product_details", "images")
+    FLOAT_FIELDS = ("selling_price", "discount", "actual_price", "average_rating")
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.num_docs = len(arrays["out_of_stock"])
+        self.out_of_stock = arrays["out_of_stock"]
+        for field in self.FLOAT_FIELDS:
+            setattr(self, field, arrays[field])
+        self.pids = arrays["pid_sorted"]  # sorted pids (bytes) and the row of each one, to find a pid by binary search
+        self.pid_rows = arrays["pid_rows"]
+
+    @classmethod
+    def from_documents(cls, documents):
+        """Build the store from an iterable of (validated) Document objects."""
+        builder = CorpusStoreBuilder()
+        builder.add(documents)
+        return builder.build()
+
+    @classmethod
+    def open(cls, path):
+        """Open a store saved with save() (memory-mapped)."""
+        arrays, _ = read_index_file(path)
+        return cls(arrays)
+
+    def save(self, path):
+        write_index_file(path, self.arrays, {"num_docs": self.num_docs})
+
+    @classmethod
+    def concat(cls, stores):
+        """Return a store with the products of the stores one after the other (same order as CompactIndex.merge)."""
+        arrays = {}
+        for field in cls.TEXT_FIELDS + cls.JSON_FIELDS:
+            offsets = [np.zeros(1, dtype=np.int64)]
+            shift = 0
+            for store in stores:
+                offsets.append(store.arrays[field + "_offsets"][1:] + shift)
+                shift += store.arrays[field + "_offsets"][-1]
+            arrays[field + "_data"] = np.concatenate([store.arrays[field + "_data"] for store in stores])
+            arrays[field + "_offsets"] = np.concatenate(offsets)
+            arrays[field + "_missing"] = np.concatenate([store.arrays[field + "_missing"] for store in stores])
+        for field in cls.FLOAT_FIELDS + ("out_of_stock",):
+            arrays[field] = np.concatenate([store.arrays[field] for store in stores])
+        arrays.update(_pid_lookup(np.concatenate([store.row_pids() for store in stores])))
+        return cls(arrays)
+
+    def select(self, keep):
+        """Return a store with only the rows where the boolean mask `keep` is True (same order as CompactIndex.select)."""
+        if keep.all():
+            return self
+        rows = np.flatnonzero(keep)
+        arrays = {}
+        for field in self.TEXT_FIELDS + self.JSON_FIELDS:
+            offsets = self.arrays[field + "_offsets"]
+            starts, lengths = offsets[rows], offsets[rows + 1] - offsets[rows]
+            new_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=new_offsets[1:])
+            # position of every byte to keep: start of its row + offset inside the row
+            positions = np.arange(new_offsets[-1]) - np.repeat(new_offsets[:-1], lengths) + np.repeat(starts, lengths)
+            arrays[field + "_data"] = self.arrays[field + "_data"][positions]
+            arrays[field + "_offsets"] = new_offsets
+            arrays[field + "_missing"] = self.arrays[field + "_missing"][rows]
+        for field in self.FLOAT_FIELDS + ("out_of_stock",):
+            arrays[field] = self.arrays[field][rows]
+        arrays.update(_pid_lookup(self.row_pids()[rows]))
+        return CorpusStore(arrays)
+
+    def row_pids(self):
+        """Return the pid (bytes) of every row, in row order."""
+        pids = np.empty_like(self.pids)
+        pids[self.pid_rows] = self.pids
+        return pids
+
+    # --- row access ---
+
+    def text(self, field, row):
+        """Return the value of a text field for a row (None if missing)."""
+        offsets = self.arrays[field + "_offsets"]
+        start, end = offsets[row], offsets[row + 1]
+        if self.arrays[field + "_missing"][row]:
+            return None
+        return self.arrays[field + "_data"][start:end].tobytes().decode()
+
+    def row(self, pid):
+        """Return the row of a pid, or None if it is not in the corpus."""
+        key = pid.encode()
+        position = int(np.searchsorted(self.pids, key))
+        if position < len(self.pids) and self.pids[position] == key:
+            return int(self.pid_rows[position])
+        return None
+
+    def rows(self, pids):
+        """Return the rows of the pids (array of bytes) that are in the corpus, by binary search."""
+        pids = np.asarray(pids, dtype="S")
+        if len(self.pids) == 0:
+            return np.zeros(0, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.pids, pids), len(self.pids) - 1)
+        return self.pid_rows[positions[self.pids[positions] == pids]].astype(np.int64)
+
+    def view(self, row):
+        return DocumentView(self, row)
+
+    # --- dict of Documents interface ---
+
+    def __getitem__(self, pid):
+        row = self.row(pid)
+        if row is None:
+            raise KeyError(pid)
+        return DocumentView(self, row)
+
+    def get(self, pid, default=None):
+        row = self.row(pid)
+        return DocumentView(self, row) if row is not None else default
+
+    def __contains__(self, pid):
+        return self.row(pid) is not None
+
+    def __len__(self):
+        return self.num_docs
+
+    def keys(self):
+        return [self.text("pid", row) for row in range(self.num_docs)]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def values(self):
+        return (DocumentView(self, row) for row in range(self.num_docs))
+
+    def items(self):
+        return ((view.pid, view) for view in self.values())
+
+
+class CorpusStoreBuilder:
+    """
+    Builds a CorpusStore from Documents added in chunks (e.g. while the products file is streamed), keeping only the
+    encoded columns in memory and not the Document objects.
+    """
+
+    def __init__(self):
+        self.text = {field: bytearray() for field in CorpusStore.TEXT_FIELDS + CorpusStore.JSON_FIELDS}
+        self.lengths = {field: array("q") for field in self.text}
+        self.missing = {field: array("b") for field in self.text}
+        self.floats = {field: array("d") for field in CorpusStore.FLOAT_FIELDS}
+        self.out_of_stock = array("b")
+        self.pids = []
+
+    def add(self, documents):
+        for doc in documents:
+            for field in self.text:
+                value = getattr(doc, field)
+                if value is not None and field in CorpusStore.JSON_FIELDS:
+                    value = json.dumps(value)
+                encoded = value.encode() if value is not None else b""
+                self.text[field] += encoded
+                self.lengths[field].append(len(encoded))
+                self.missing[field].append(value is None)
+            for field in self.floats:
+                value = getattr(doc, field)
+                self.floats[field].append(np.nan if value is None else value)
+            self.out_of_stock.append(doc.out_of_stock)
+            self.pids.append(doc.pid.encode())
+
+    def build(self):
+        arrays = {}
+        for field, data in self.text.items():
+            offsets = np.zeros(len(self.lengths[field]) + 1, dtype=np.int64)
+            np.cumsum(np.frombuffer(self.lengths[field], dtype=np.int64), out=offsets[1:])
+            arrays[field + "_data"] = np.frombuffer(bytes(data), dtype=np.uint8)
+            arrays[field + "_offsets"] = offsets
+            arrays[field + "_missing"] = np.frombuffer(self.missing[field], dtype=np.int8).astype(bool)
+        for field, values in self.floats.items():
+            arrays[field] = np.frombuffer(values, dtype=np.float64).copy()
+        arrays["out_of_stock"] = np.frombuffer(self.out_of_stock, dtype=np.int8).astype(bool)
+
+        arrays.update(_pid_lookup(np.array(self.pids, dtype="S")))
+        return CorpusStore(arrays)
+
+
+def _pid_lookup(pids):
+    """Return the sorted pids and the row of each one (the arrays used to find the row of a pid)."""
+    order = np.argsort(pids, kind="stable")
+    return {"pid_sorted": pids[order], "pid_rows": order.astype(np.int32)}
+
+
+class DocumentView:
+    """
+    Read-only view of one product of a CorpusStore, with the same attributes as Document.
+    Fields are read from the columns when they are accessed.
+    """
+
+    __slots__ = ("_store", "_row")
+
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+
+    @property
+    def doc_id(self):
+        return self._row
+
+    def __getattr__(self, name):
+        store = self._store
+        if name in CorpusStore.TEXT_FIELDS:
+            return store.text(name, self._row)
+        if name in CorpusStore.FLOAT_FIELDS:
+            value = getattr(store, name)[self._row]
+            return None if np.isnan(value) else float(value)
+        if name == "out_of_stock":
+            return bool(store.out_of_stock[self._row])
+        if name in CorpusStore.JSON_FIELDS:
+            value = store.text(name, self._row)
+            return json.loads(value) if value is not None else None
+        raise AttributeError(name)
+
+    def to_dict(self):
+        fields = CorpusStore.TEXT_FIELDS + CorpusStore.JSON_FIELDS + CorpusStore.FLOAT_FIELDS + ("out_of_stock",)
+        return {field: getattr(self, field) for field in fields}
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def __str__(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
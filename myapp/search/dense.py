@@ -0,0 +1,362 @@
+"""
+Dense (semantic) retrieval: products and queries are embedded as vectors and ranked by cosine similarity.
+
+Two embeddings, as in the Part 3 notebook: "w2v", the average of the Word2Vec vectors of the terms of a product (or
+query), and "d2v", the Doc2Vec vector of the product (queries are embedded with infer_vector). The vectors are
+trained at build time with gensim and saved, normalised to unit length, as float32 arrays in a memory-mapped file
+(same format as the index, see index_file.py). w2v queries are embedded from the word vectors saved in that file;
+d2v queries need the Doc2Vec model, so gensim is only required to build the vectors and to search with d2v.
+
+Queries are answered by an IVF (inverted file) approximate nearest neighbour index instead of a full scan: the
+vectors are clustered with k-means and stored grouped by cluster, a query is compared with the cluster centroids
+and only the vectors of the `nprobe` closest clusters are scored (one matrix-vector product over contiguous rows).
+More probed clusters means better recall and more latency (DENSE_NPROBE, 8 by default; `python -m
+myapp.search.dense` measures the recall and latency of several values).
+"""
+
+import os
+import threading
+import time
+
+import numpy as np
+
+from .index_file import read_index_file, write_index_file
+from .positions import document_terms
+
+try:
+    import gensim  # optional: only needed to train the vectors and to embed d2v queries
+except ImportError:
+    gensim = None
+
+DENSE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "products_vectors.bin")
+MODELS = ("w2v", "d2v")
+DEFAULT_NPROBE = int(os.getenv("DENSE_NPROBE", 8))
+
+
+def _normalise(vectors):
+    """Return the vectors (rows) scaled to unit length, as float32; zero vectors stay zero."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+def kmeans(vectors, num_clusters, iterations=10, seed=0, batch_size=4096):
+    """
+    Spherical k-means of unit vectors (cosine similarity). Returns the (normalised) centroids and the cluster of
+    every vector. Vectors are assigned in batches, one matrix product per batch.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), num_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.concatenate([np.argmax(vectors[start:start + batch_size] @ centroids.T, axis=1)
+                                     for start in range(0, len(vectors), batch_size)])
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        empty = np.flatnonzero(np.bincount(assignment, minlength=num_clusters) == 0)
+        sums[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]  # restart empty clusters
+        centroids = _normalise(sums)
+    assignment = np.concatenate([np.argmax(vectors[start:start + batch_size] @ centroids.T, axis=1)
+                                 for start in range(0, len(vectors), batch_size)])
+    return centroids, assignment
+
+
+class IVFIndex:
+    """
+    Inverted file index of unit vectors: the vectors of list c are vectors[list_offsets[c]:list_offsets[c + 1]],
+    the products closest to centroid c. `pids` gives the product of every row; doc_ids (set when the index is
+    opened, see DenseIndex.open) the doc id of that product in the current index, -1 if it is no longer there, and
+    doc_rows the other way round (doc id -> row, -1 for a product without a vector).
+    """
+
+    def __init__(self, centroids, list_offsets, vectors, pids):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.vectors = vectors
+        self.pids = pids
+        self.doc_ids = None
+        self.doc_rows = None
+
+    @classmethod
+    def build(cls, vectors, pids, num_lists=None):
+        """Cluster the (normalised) vectors of the products pids into num_lists lists (sqrt(n) by default)."""
+        vectors = _normalise(vectors)
+        if num_lists is None:
+            num_lists = int(np.sqrt(len(vectors)))
+        num_lists = max(1, min(num_lists, len(vectors)))
+        centroids, assignment = kmeans(vectors, num_lists)
+        order = np.argsort(assignment, kind="stable")
+        list_offsets = np.zeros(num_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=num_lists), out=list_offsets[1:])
+        return cls(centroids, list_offsets, vectors[order], np.asarray(pids, dtype="S")[order])
+
+    def arrays(self):
+        return {"centroids": self.centroids, "list_offsets": self.list_offsets, "vectors": self.vectors, "pids": self.pids}
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays().values())
+
+    def search(self, query, k, nprobe=None, mask=None):
+        """
+        Return the doc ids and cosine similarities of the (approximately) k most similar products to the unit vector
+        query, sorted by decreasing similarity, and the number of products scored. Only the nprobe lists with the
+        closest centroids are scored. If mask is given (boolean array indexed by doc id), only the products where it
+        is True are returned: when the filters allow no more products than the probed lists hold, these products are
+        scored directly (exact results); otherwise the probe is widened (nprobe doubled) until the lists hold as many
+        allowed products as an unfiltered search would return, so a selective filter does not starve the results.
+        """
+        nprobe = min(nprobe or DEFAULT_NPROBE, len(self.centroids))
+        closest = np.argsort(-(self.centroids @ query), kind="stable")
+        rows = self._rows(closest[:nprobe])
+        if mask is not None:
+            allowed = self.doc_rows[mask]
+            allowed = np.sort(allowed[allowed >= 0])
+            if len(allowed) <= len(rows):
+                return self._top_k(allowed, query, k, mask)
+            wanted = min(k, len(rows))
+            while nprobe < len(closest) and self._allowed(rows, mask) < wanted:
+                nprobe = min(2 * nprobe, len(closest))
+                rows = self._rows(closest[:nprobe])
+        return self._top_k(rows, query, k, mask)
+
+    def _rows(self, lists):
+        """Return the rows of the vectors of the given lists."""
+        starts, ends = self.list_offsets[lists], self.list_offsets[lists + 1]
+        return np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+
+    def _allowed(self, rows, mask):
+        """Return the number of rows whose product is allowed by mask."""
+        doc_ids = self.doc_ids[rows]
+        return int(np.count_nonzero(mask[doc_ids[doc_ids >= 0]]))
+
+    def exact(self, query, k, mask=None):
+        """Same as search, scoring every product (full scan): the reference to measure the recall of search."""
+        return self._top_k(np.arange(len(self.vectors)), query, k, mask)
+
+    def _top_k(self, rows, query, k, mask):
+        doc_ids = self.doc_ids[rows]
+        keep = doc_ids >= 0
+        if mask is not None:
+            keep[keep] = mask[doc_ids[keep]]
+        rows, doc_ids = rows[keep], doc_ids[keep]
+        scores = self.vectors[rows] @ query
+        if k < len(scores):
+            best = np.argpartition(-scores, k - 1)[:k]
+            doc_ids, scores = doc_ids[best], scores[best]
+        order = np.argsort(-scores, kind="stable")
+        return doc_ids[order], scores[order].astype(np.float64), len(rows)
+
+
+class ProductTerms:
+    """
+    The (pid, terms) pairs of the products, the training corpus of DenseIndex.build. gensim reads its corpus once per
+    epoch, so this is a restartable iterable and not a list: the terms of every product are kept as term ids of the
+    index vocabulary (one int32 array for the whole corpus) and only turned into strings while they are iterated.
+    """
+
+    def __init__(self, pids, vocabulary, term_ids, offsets):
+        self.pids = pids
+        self.vocabulary = vocabulary
+        self.term_ids = term_ids
+        self.offsets = offsets
+
+    @classmethod
+    def from_index(cls, index):
+        """The terms of the products of a positional index, read from its positions (no tokenisation)."""
+        term_ids, offsets = document_terms(index)
+        return cls(index.pids.astype(str).tolist(), index.terms.astype(str).tolist(), term_ids, offsets)
+
+    @classmethod
+    def from_corpus(cls, corpus, index, analyzer, batch_size=2000):
+        """
+        The terms of the products of a corpus store (same order as the index), analysed in batches, for an index
+        without positions. Terms that are not in the index are left out.
+        """
+        term_ids = []
+        lengths = []
+        for start in range(0, len(corpus), batch_size):
+            rows = range(start, min(start + batch_size, len(corpus)))
+            titles = analyzer.analyze_many([corpus.text("title", row) for row in rows])
+            descriptions = analyzer.analyze_many([corpus.text("description", row) for row in rows])
+            for title, description in zip(titles, descriptions):
+                keys = np.asarray([term.encode() for term in title + description], dtype="S")
+                positions = np.minimum(np.searchsorted(index.terms, keys), max(len(index.terms) - 1, 0))
+                found = positions[index.terms[positions] == keys] if len(keys) else positions
+                term_ids.append(found.astype(np.int32))
+                lengths.append(len(found))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        term_ids = np.concatenate(term_ids) if term_ids else np.zeros(0, dtype=np.int32)
+        return cls(index.pids.astype(str).tolist(), index.terms.astype(str).tolist(), term_ids, offsets)
+
+    def __len__(self):
+        return len(self.pids)
+
+    def __iter__(self):
+        vocabulary, offsets = self.vocabulary, self.offsets.tolist()
+        for doc_id, pid in enumerate(self.pids):
+            yield pid, [vocabulary[term_id] for term_id in self.term_ids[offsets[doc_id]:offsets[doc_id + 1]].tolist()]
+
+
+class _Corpus:
+    """Restartable iterable over the items built by a function from every (pid, terms) pair of documents."""
+
+    def __init__(self, documents, function):
+        self.documents = documents
+        self.function = function
+
+    def __iter__(self):
+        return (self.function(pid, terms) for pid, terms in self.documents)
+
+
+class DenseModel:
+    """One embedding (w2v or d2v): its IVF index of product vectors and the way to embed a query."""
+
+    def __init__(self, name, ivf, words=None, word_vectors=None, model_path=None):
+        self.name = name
+        self.ivf = ivf
+        self.words = words  # w2v: sorted vocabulary and the vector of every word
+        self.word_vectors = word_vectors
+        self.model_path = model_path  # d2v: gensim model used to infer query vectors (loaded on first use)
+        self._model = None
+        self._lock = threading.Lock()
+
+    def embed(self, terms):
+        """Return the unit vector of a query (list of analysed terms), or None if it has no known term."""
+        if self.name == "w2v":
+            keys = np.asarray([term.encode() for term in terms], dtype="S")
+            positions = np.searchsorted(self.words, keys)
+            found = positions < len(self.words)
+            found[found] = self.words[positions[found]] == keys[found]
+            if not found.any():
+                return None
+            vector = self.word_vectors[positions[found]].mean(axis=0)
+        else:
+            with self._lock:
+                model = self.model
+                terms = [term for term in terms if term in model.wv.key_to_index]
+                if not terms:
+                    return None
+                # inference is randomised: the same seed every time, so a query always gets the same vector
+                model.random = np.random.RandomState(model.seed)
+                vector = model.infer_vector(terms)
+        vector = _normalise(vector)
+        return vector if vector.any() else None
+
+    @property
+    def model(self):
+        # called with self._lock held
+        if self._model is None:
+            if gensim is None:
+                raise ImportError("d2v queries need gensim (pip install gensim)")
+            self._model = gensim.models.doc2vec.Doc2Vec.load(self.model_path)
+        return self._model
+
+    def search(self, terms, k, nprobe=None, mask=None):
+        """Return the doc ids and similarities of the k most similar products to the query, and the number scored."""
+        query = self.embed(terms)
+        if query is None:
+            return np.zeros(0, dtype=np.int32), np.zeros(0), 0
+        return self.ivf.search(query, k, nprobe, mask)
+
+    @property
+    def nbytes(self):
+        return self.ivf.nbytes + (self.words.nbytes + self.word_vectors.nbytes if self.words is not None else 0)
+
+
+class DenseIndex:
+    """The dense models saved in a vectors file (name -> DenseModel)."""
+
+    def __init__(self, models):
+        self.models = models
+
+    @classmethod
+    def open(cls, path, index_pids):
+        """
+        Open a vectors file (memory-mapped). The products are matched by pid with the doc ids of the index being served
+        (index_pids: doc id -> pid), so products deleted since the vectors were built are left out; products added
+        since then are only found by the lexical algorithms until the vectors are built again.
+        """
+        arrays, metadata = read_index_file(path)
+        order = np.argsort(index_pids, kind="stable")
+        sorted_pids = index_pids[order]
+        models = {}
+        for name in metadata["models"]:
+            ivf = IVFIndex(arrays[f"{name}_centroids"], arrays[f"{name}_list_offsets"], arrays[f"{name}_vectors"], arrays[f"{name}_pids"])
+            positions = np.minimum(np.searchsorted(sorted_pids, ivf.pids), max(len(sorted_pids) - 1, 0))
+            found = sorted_pids[positions] == ivf.pids if len(sorted_pids) else np.zeros(len(ivf.pids), dtype=bool)
+            ivf.doc_ids = np.where(found, order[positions], -1).astype(np.int32)
+            ivf.doc_rows = np.full(len(index_pids), -1, dtype=np.int64)
+            ivf.doc_rows[ivf.doc_ids[found]] = np.flatnonzero(found)
+            model_path = os.path.join(os.path.dirname(path), metadata["d2v_model"]) if name == "d2v" else None
+            models[name] = DenseModel(name, ivf, words=arrays.get(f"{name}_words"), word_vectors=arrays.get(f"{name}_word_vectors"),
+                                      model_path=model_path)
+        return cls(models)
+
+    @staticmethod
+    def build(documents, path, vector_size=100, epochs=40, workers=None):
+        """
+        Train the w2v and d2v embeddings of the products with gensim and save their vectors and IVF indexes in path
+        (the Doc2Vec model next to it). documents is a list of (pid, terms) pairs, terms being the analysed terms of the
+        title and description, like the index, or a restartable iterable of them such as ProductTerms: it is read once
+        per epoch, never copied into a list.
+        """
+        if gensim is None:
+            raise ImportError("Building the dense vectors needs gensim (pip install gensim)")
+        from gensim.models import Word2Vec
+        from gensim.models.doc2vec import Doc2Vec, TaggedDocument
+
+        workers = workers or os.cpu_count() or 1
+        pids = [pid for pid, _ in documents]
+        sentences = _Corpus(documents, lambda pid, terms: terms)
+        arrays = {}
+
+        start = time.perf_counter()
+        w2v = Word2Vec(sentences=sentences, vector_size=vector_size, window=10, min_count=1, workers=workers)
+        words = np.asarray(sorted(w2v.wv.key_to_index), dtype="S")
+        word_vectors = np.asarray([w2v.wv[word] for word in words.astype(str)], dtype=np.float32)
+        product_vectors = np.zeros((len(pids), vector_size), dtype=np.float32)
+        for i, terms in enumerate(sentences):
+            if terms:
+                product_vectors[i] = w2v.wv[terms].mean(axis=0)
+        arrays.update({f"w2v_{name}": array for name, array in IVFIndex.build(product_vectors, pids).arrays().items()})
+        arrays.update({"w2v_words": words, "w2v_word_vectors": word_vectors})
+        print("w2v vectors trained in {:.1f} s".format(time.perf_counter() - start))
+
+        start = time.perf_counter()
+        d2v = Doc2Vec(vector_size=vector_size, min_count=1, epochs=epochs, workers=workers)
+        tagged = _Corpus(documents, lambda pid, terms: TaggedDocument(terms, [pid]))
+        d2v.build_vocab(tagged)
+        d2v.train(tagged, total_examples=d2v.corpus_count, epochs=d2v.epochs)
+        product_vectors = np.asarray([d2v.dv[pid] for pid in pids], dtype=np.float32)
+        arrays.update({f"d2v_{name}": array for name, array in IVFIndex.build(product_vectors, pids).arrays().items()})
+        print("d2v vectors trained in {:.1f} s".format(time.perf_counter() - start))
+
+        model_file = os.path.splitext(os.path.basename(path))[0] + "_d2v.model"
+        temporary = os.path.join(os.path.dirname(path), model_file + ".tmp")
+        d2v.save(temporary, separately=[])  # a single file, so it can be renamed
+        os.replace(temporary, os.path.join(os.path.dirname(path), model_file))
+        write_index_file(path, arrays, {"models": list(MODELS), "d2v_model": model_file, "vector_size": vector_size})
+
+
+if __name__ == "__main__":
+    # recall@20 and latency of the IVF search for several nprobe, against a full scan (python -m myapp.search.dense)
+    from .algorithms import REGISTRY
+
+    REGISTRY.load()
+    queries = [REGISTRY.index.terms[np.random.default_rng(seed).choice(len(REGISTRY.index.terms), 2)].astype(str).tolist()
+               for seed in range(100)]
+    for name, model in REGISTRY.dense.models.items():
+        vectors = [vector for vector in (model.embed(terms) for terms in queries) if vector is not None]
+        exact = [set(model.ivf.exact(vector, 20)[0].tolist()) for vector in vectors]
+        print("{}: {} vectors in {} lists, {:.1f} MB".format(name, len(model.ivf.vectors), len(model.ivf.centroids), model.nbytes / 2**20))
+        start = time.perf_counter()
+        for vector in vectors:
+            model.ivf.exact(vector, 20)
+        print("  full scan            {:8.1f} us".format((time.perf_counter() - start) / len(vectors) * 1e6))
+        for nprobe in (1, 2, 4, 8, 16, 32):
+            start = time.perf_counter()
+            found = [model.ivf.search(vector, 20, nprobe)[0] for vector in vectors]
+            elapsed = (time.perf_counter() - start) / len(vectors)
+            recall = np.mean([len(expected & set(doc_ids.tolist())) / max(len(expected), 1) for expected, doc_ids in zip(exact, found)])
+            print("  nprobe {:<3} recall {:.3f} {:8.1f} us".format(nprobe, recall, elapsed * 1e6))
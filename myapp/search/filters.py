@@ -0,0 +1,172 @@
+import numpy as np
+
+from .corpus_store import CorpusStore
+
+CATEGORICAL_FIELDS = ("brand", "category", "sub_category", "seller")
+NUMERIC_FIELDS = CorpusStore.FLOAT_FIELDS
+
+# request parameter -> (numeric field, bound)
+RANGE_PARAMETERS = {
+    "min_price": ("selling_price", 0), "max_price": ("selling_price", 1),
+    "min_discount": ("discount", 0), "max_discount": ("discount", 1),
+    "min_rating": ("average_rating", 0), "max_rating": ("average_rating", 1),
+}
+
+
+class FilterIndex:
+    """
+    Precomputed structures to restrict a search to the products matching structured filters, indexed by doc id (the
+    rows of the corpus store).
+
+    Every categorical field (brand, category, sub_category, seller) is kept as its sorted distinct values and one
+    int32 code per product (the position of its value, -1 when it is missing), so a value is found by binary search
+    and the products with some values are the codes in a small lookup table. Numeric fields (selling_price,
+    discount, actual_price, average_rating) are kept as the doc ids sorted by value with the sorted values, so a range
+    is two binary searches and a slice. Products with a missing value never match a filter on that field.
+
+    Filters are given as a dict: field -> list of accepted values (categorical), field -> [low, high] (numeric, either
+    bound may be None) and "in_stock" -> True. mask() combines them into one boolean array, which the search uses
+    while generating the candidates (see search_terms), so filtered out products are never scored.
+    """
+
+    def __init__(self, corpus):
+        self.num_docs = len(corpus)
+        self.values = {}  # field -> sorted values (bytes)
+        self.codes = {}  # field -> int32 array: position of the value of every product in values, -1 if missing
+        for field in CATEGORICAL_FIELDS:
+            column, missing = _text_column(corpus, field)
+            rows = np.flatnonzero(~missing)
+            values, codes = np.unique(column[rows], return_inverse=True)
+            self.values[field] = values
+            self.codes[field] = np.full(self.num_docs, -1, dtype=np.int32)
+            self.codes[field][rows] = codes
+
+        self.sorted_values = {}  # field -> values in increasing order (without the missing ones)
+        self.sorted_rows = {}  # field -> doc id of each of them
+        for field in NUMERIC_FIELDS:
+            column = getattr(corpus, field)
+            rows = np.flatnonzero(~np.isnan(column))
+            order = np.argsort(column[rows], kind="stable")
+            self.sorted_values[field] = column[rows][order]
+            self.sorted_rows[field] = rows[order].astype(np.int32)
+        self.in_stock = ~np.asarray(corpus.out_of_stock, dtype=bool)
+
+    @property
+    def nbytes(self):
+        arrays = list(self.values.values()) + list(self.codes.values()) + list(self.sorted_values.values()) + \
+            list(self.sorted_rows.values()) + [self.in_stock]
+        return sum(array.nbytes for array in arrays)
+
+    def value_mask(self, field, values):
+        """Return the boolean array (indexed by doc id) of the products whose field has one of the values."""
+        keys = np.asarray([value.encode() for value in values], dtype="S")
+        positions = np.searchsorted(self.values[field], keys)
+        found = positions < len(self.values[field])
+        found[found] = self.values[field][positions[found]] == keys[found]
+        # lookup table of the accepted codes, with one more entry (last, False) for the missing values (-1)
+        accepted = np.zeros(len(self.values[field]) + 1, dtype=bool)
+        accepted[positions[found]] = True
+        return accepted[self.codes[field]]
+
+    def range_doc_ids(self, field, low=None, high=None):
+        """Return the doc ids (not sorted) of the products whose field is between low and high (included)."""
+        values = self.sorted_values[field]
+        start = np.searchsorted(values, low, side="left") if low is not None else 0
+        end = np.searchsorted(values, high, side="right") if high is not None else len(values)
+        return self.sorted_rows[field][start:end]
+
+    def facet_counts(self, mask, fields=CATEGORICAL_FIELDS, size=10):
+        """
+        Return the facets of a result set (boolean array indexed by doc id): for every field, the (value, number of
+        results) pairs of its `size` most frequent values in the results (all of them if size is None), most frequent
+        first. The codes of the results are counted with one bincount per field.
+        """
+        facets = {}
+        for field in fields:
+            codes = self.codes[field][mask]
+            counts = np.bincount(codes[codes >= 0], minlength=len(self.values[field]))
+            present = np.flatnonzero(counts)
+            # values are sorted, so a stable sort by decreasing count breaks ties alphabetically
+            top = present[np.argsort(-counts[present], kind="stable")[:size]]
+            facets[field] = [(value.decode(), int(count)) for value, count in zip(self.values[field][top], counts[top])]
+        return facets
+
+    def mask(self, filters):
+        """Return the boolean array (indexed by doc id) of the products matching every filter, or None if there are none."""
+        if not filters:
+            return None
+        mask = np.ones(self.num_docs, dtype=bool)
+        for field, value in filters.items():
+            if field in CATEGORICAL_FIELDS:
+                mask &= self.value_mask(field, value)
+            elif field in NUMERIC_FIELDS:
+                in_range = np.zeros(self.num_docs, dtype=bool)
+                in_range[self.range_doc_ids(field, *value)] = True
+                mask &= in_range
+            elif field == "in_stock":
+                if value:
+                    mask &= self.in_stock
+            else:
+                raise ValueError("Unknown filter: {}".format(field))
+        return mask
+
+
+def merge_facets(facets, size=10):
+    """
+    Add up the facets of several result sets (counted by facet_counts with size=None, e.g. on the base index and on
+    each segment) and keep the `size` most frequent values of every field, ties in alphabetical order like facet_counts.
+    """
+    merged = {}
+    for part in facets:
+        for field, counts in part.items():
+            totals = merged.setdefault(field, {})
+            for value, count in counts:
+                totals[value] = totals.get(value, 0) + count
+    return {field: sorted(totals.items(), key=lambda value_count: (-value_count[1], value_count[0]))[:size]
+            for field, totals in merged.items()}
+
+
+def _text_column(corpus, field):
+    """Return the values of a text field of the corpus store as a fixed width bytes array, and the missing mask."""
+    data = corpus.arrays[field + "_data"]
+    offsets = corpus.arrays[field + "_offsets"].tolist()
+    column = np.array([data[start:end].tobytes() for start, end in zip(offsets[:-1], offsets[1:])], dtype="S")
+    return column, np.asarray(corpus.arrays[field + "_missing"], dtype=bool)
+
+
+def parse_filters(params):
+    """
+    Return the filters of the parameters of a search request (a Flask MultiDict such as request.form or
+    request.args): brand, category, sub_category and seller (repeatable), min_price / max_price, min_discount /
+    max_discount, min_rating / max_rating and in_stock. Empty and invalid parameters are ignored.
+    """
+    filters = {}
+    for field in CATEGORICAL_FIELDS:
+        values = sorted({value.strip() for value in params.getlist(field) if value.strip()})
+        if values:
+            filters[field] = values
+    for parameter, (field, bound) in RANGE_PARAMETERS.items():
+        try:
+            value = float(params.get(parameter, ""))
+        except ValueError:
+            continue
+        filters.setdefault(field, [None, None])[bound] = value
+    if params.get("in_stock") in ("1", "on", "true"):
+        filters["in_stock"] = True
+    return filters
+
+
+def filter_params(filters):
+    """Return the request parameters of the filters (the inverse of parse_filters), e.g. to build links."""
+    params = {field: list(values) for field, values in filters.items() if field in CATEGORICAL_FIELDS}
+    for parameter, (field, bound) in RANGE_PARAMETERS.items():
+        if field in filters and filters[field][bound] is not None:
+            params[parameter] = filters[field][bound]
+    if filters.get("in_stock"):
+        params["in_stock"] = "1"
+    return params
+
+
+def filters_key(filters):
+    """Hashable form of the filters (for cache keys)."""
+    return tuple(sorted((field, tuple(value) if isinstance(value, list) else value) for field, value in (filters or {}).items()))
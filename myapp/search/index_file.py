@@ -0,0 +1,80 @@
+"""
+Binary index file format (version 1)
+
+    magic        8 bytes   b"IRWAIDX\\0"
+    version      uint32    little endian
+    header_size  uint32    little endian
+    header       JSON      {"metadata": {...}, "arrays": {name: {"dtype", "shape", "offset"}}}
+    arrays       raw little endian array data, each one starting at a multiple of 64 bytes
+
+The whole file is opened with a single read-only mmap and every array is a NumPy view on it, so opening an index
+only parses the header: pages are read from disk when they are first used, and processes that open the same file
+share its pages through the OS page cache.
+"""
+
+import json
+import mmap
+import os
+
+import numpy as np
+
+MAGIC = b"IRWAIDX\0"
+VERSION = 1
+ALIGNMENT = 64
+
+
+def _align(position):
+    return (position + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_index_file(path, arrays, metadata):
+    """
+    Write a dict of 1-D NumPy arrays and a JSON-serialisable metadata dict to path.
+    The file is written next to path and renamed over it, so readers never see a half written index.
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    arrays = {name: array.astype(array.dtype.newbyteorder("<"), copy=False) for name, array in arrays.items()}
+
+    # the header size depends on the offsets, which depend on the header size: reserve room for the offsets first
+    entries = {name: {"dtype": array.dtype.str, "shape": list(array.shape), "offset": 0} for name, array in arrays.items()}
+    header_size = len(json.dumps({"metadata": metadata, "arrays": entries}).encode()) + 20 * len(arrays)
+    position = _align(len(MAGIC) + 8 + header_size)
+    for name, array in arrays.items():
+        entries[name]["offset"] = position
+        position = _align(position + array.nbytes)
+    header = json.dumps({"metadata": metadata, "arrays": entries}).encode().ljust(header_size)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.array([VERSION, header_size], dtype="<u4").tobytes())
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(entries[name]["offset"])
+            f.write(array.tobytes())
+        f.truncate(position)
+    os.replace(tmp_path, path)
+
+
+def read_index_file(path):
+    """
+    Open an index file written by write_index_file and return (arrays, metadata), arrays being read-only NumPy views
+    on the memory-mapped file.
+    """
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)  # the mapping stays valid after closing the file
+
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not an index file")
+    version, header_size = np.frombuffer(buffer, dtype="<u4", count=2, offset=len(MAGIC))
+    if version != VERSION:
+        raise ValueError(f"{path} has index format version {version}, expected {VERSION}. Rebuild the index.")
+    header_start = len(MAGIC) + 8
+    header = json.loads(bytes(buffer[header_start:header_start + header_size]))
+
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"]))
+        arrays[name] = np.frombuffer(buffer, dtype=dtype, count=count, offset=entry["offset"]).reshape(entry["shape"])
+    return arrays, header["metadata"]
@@ -1,29 +1,132 @@
-import pandas as pd
+import hashlib
+import json
+import os
+
+import numpy as np
 
 from myapp.search.objects import Document
-from typing import List, Dict
+from typing import Dict, Iterator, List
+
+READ_BLOCK_SIZE = 1 << 20  # bytes read from the products file at a time
+
+# longest product (in characters) the parser waits for: a product still unparsed past this is malformed
+MAX_PRODUCT_SIZE = 64 << 20
 
 
-def load_corpus(path) -> List[Document]:
+def load_corpus(path) -> Dict[str, Document]:
     """
     Load file and transform to dictionary with each document as an object for easier treatment when needed for displaying
      in results, stats, etc.
+    The whole corpus is kept in memory: to process a large products file use iter_documents instead.
     :param path:
     :return:
     """
-    df = pd.read_json(path)
-    corpus = _build_corpus(df)
+    corpus = {}
+    for chunk in iter_documents(path):
+        for doc in chunk:
+            corpus[doc.pid] = doc
     return corpus
 
-def _build_corpus(df: pd.DataFrame) -> Dict[str, Document]:
+
+def iter_products(path) -> Iterator[dict]:
     """
-    Build corpus from dataframe
-    :param df:
+    Parse the products file incrementally and yield the raw product dicts one by one.
+    The file can be a JSON array of products or JSON lines (one product per line); only one block of the file and the
+    product being parsed are in memory at a time. A product that does not parse raises a JSONDecodeError with its
+    offset in the file, at the end of the file (truncated file) or once MAX_PRODUCT_SIZE characters were read past its
+    start (malformed product), so a bad record never loads the rest of the file.
+    :param path:
     :return:
     """
-    corpus = {}
-    for _, row in df.iterrows():
-        doc = Document(**row.to_dict())
-        corpus[doc.pid] = doc
-    return corpus
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buffer = f.read(READ_BLOCK_SIZE)
+        position = _skip(buffer, 0, " \t\r\n\ufeff")  # also skip a byte order mark
+        in_array = buffer[position:position + 1] == "["
+        if in_array:
+            position += 1
+        eof = False
+        offset = 0  # characters of the file before the buffer
+        while True:
+            position = _skip(buffer, position, " \t\r\n,")
+            if position == len(buffer) or (in_array and buffer[position] == "]"):
+                if eof or (in_array and position < len(buffer)):
+                    return
+                offset += position
+                buffer, position, eof = _read_more(f, buffer, position)
+                continue
+            try:
+                product, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as e:
+                if eof or len(buffer) - position > MAX_PRODUCT_SIZE:
+                    raise json.JSONDecodeError("{} (product at character {} of {})".format(e.msg, offset + position, path),
+                                               e.doc, e.pos) from None
+                # the product continues in the next block
+                offset += position
+                buffer, position, eof = _read_more(f, buffer, position)
+                continue
+            position = end
+            yield product
+
+
+def _skip(buffer, position, characters):
+    while position < len(buffer) and buffer[position] in characters:
+        position += 1
+    return position
 
+
+def _read_more(f, buffer, position):
+    """Drop the parsed part of the buffer and append the next block of the file. Returns (buffer, 0, eof)."""
+    block = f.read(READ_BLOCK_SIZE)
+    return buffer[position:] + block, 0, block == ""
+
+
+def _superseded_positions(path):
+    """Return the sorted positions (in the file) of the products whose pid appears again later."""
+    digests = bytearray()
+    for product in iter_products(path):
+        digests += hashlib.blake2b(str(product.get("pid")).encode(), digest_size=16).digest()
+    keys = np.frombuffer(bytes(digests), dtype=np.uint64).reshape(-1, 2)
+    positions = np.arange(len(keys))
+    order = np.lexsort((positions, keys[:, 1], keys[:, 0]))  # by digest, then by position
+    keys = keys[order]
+    same_as_next = np.all(keys[:-1] == keys[1:], axis=1)
+    return np.sort(order[:-1][same_as_next])
+
+
+def iter_documents(path, chunk_size=1000, progress=True) -> Iterator[List[Document]]:
+    """
+    Stream the products file as chunks (lists) of validated Document objects, so the products in memory do not depend
+    on the size of the corpus. A pid identifies one product: when it appears several times, the last occurrence is
+    kept (its content replaces the earlier ones, as in the dictionary of load_corpus, but it is yielded at its own
+    position). To know which occurrence is the last, the file is read twice: a first pass only parses the products
+    and keeps a 128-bit digest of every pid (16 bytes per product, in one array: 160 MB for 10 million products,
+    against more than 100 bytes per product for a dict of the pids), from which the positions of the earlier
+    occurrences are found. Two different pids with the same digest are not a practical concern (about 10^-24 for 10
+    million products). If progress is True, the number of products read so far is printed after every chunk.
+    :param path:
+    :param chunk_size:
+    :param progress:
+    :return:
+    """
+    superseded = _superseded_positions(path)
+    duplicates = 0
+    read = 0
+    chunk = []
+    for position, product in enumerate(iter_products(path)):
+        if duplicates < len(superseded) and superseded[duplicates] == position:
+            duplicates += 1  # replaced by a later occurrence of the pid
+            continue
+        chunk.append(Document(**product))
+        if len(chunk) == chunk_size:
+            read += len(chunk)
+            if progress:
+                print("Read {} products".format(read))
+            yield chunk
+            chunk = []
+    if chunk:
+        read += len(chunk)
+        yield chunk
+    if progress:
+        print("Read {} products from {}{}".format(read, os.path.basename(path),
+                                                  " ({} earlier occurrences of duplicated pids skipped)".format(duplicates) if duplicates else ""))
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, field_validator
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 from datetime import datetime
 import re
 
@@ -113,3 +113,26 @@ class ResultItem(BaseModel):
     
     def to_json(self):
         return self.model_dump_json()
+
+
+class ResultPage(BaseModel):
+    """
+    One page of the ranked results of a search: only the products of the page are built as ResultItem,
+    total_hits is the number of products matching the query and facets the most frequent brands, categories,
+    sub-categories and sellers among all of them (field -> list of (value, count)).
+    """
+    results: List[ResultItem]
+    page: int
+    page_size: int
+    total_hits: int
+    facets: Dict[str, List[Tuple[str, int]]] = {}
+
+    @property
+    def num_pages(self) -> int:
+        return max(1, -(-self.total_hits // self.page_size))
+
+    def __str__(self) -> str:
+        return self.model_dump_json(indent=2)
+
+    def to_json(self):
+        return self.model_dump_json()
@@ -0,0 +1,160 @@
+import numpy as np
+
+from . import varbyte
+from .postings import intersect_postings
+
+KEY_SHIFT = 32  # keys combining a candidate number and a position: candidate << KEY_SHIFT | position
+
+
+def term_positions(index, term_id, doc_ids):
+    """
+    Decode the positions of a term in the candidate products doc_ids (sorted), reading only the postings of the
+    candidates that contain the term. Returns (owner, positions): for every position, the number (index in doc_ids)
+    of the candidate it belongs to; positions are sorted for every candidate.
+    """
+    posting_docs = index.postings(term_id)[0]
+    found_at = np.searchsorted(posting_docs, doc_ids)
+    found = found_at < len(posting_docs)
+    found[found] = posting_docs[found_at[found]] == doc_ids[found]
+    postings = index.offsets[term_id] + found_at[found]  # position of the postings in the whole index
+
+    starts = index.position_offsets[postings]
+    data, _ = varbyte.gather_ranges(index.positions, starts, index.position_offsets[postings + 1] - starts)
+    gaps = varbyte.decode(data)
+    counts = index.freqs[postings]
+    # undo the delta coding inside every posting: running sum minus the sum of the previous postings
+    sums = np.cumsum(gaps)
+    first = np.cumsum(counts) - counts
+    return np.repeat(np.flatnonzero(found), counts), sums - np.repeat(sums[first] - gaps[first], counts)
+
+
+def _phrase(index, term_ids, doc_ids):
+    """Return the candidates where the terms appear one right after the other."""
+    matches = None
+    for i, term_id in enumerate(term_ids):
+        owner, positions = term_positions(index, term_id, doc_ids)
+        start = positions - i  # where the phrase would start
+        keys = np.unique((owner[start >= 0] << KEY_SHIFT) | start[start >= 0])
+        matches = keys if matches is None else np.intersect1d(matches, keys, assume_unique=True)
+        if len(matches) == 0:
+            break
+    return doc_ids[np.unique(matches >> KEY_SHIFT)]
+
+
+def _window(index, term_ids, doc_ids, slop):
+    """
+    Return the candidates where an occurrence of every term fits in a window of len(terms) + slop positions
+    (terms in any order).
+    """
+    distinct = list(dict.fromkeys(term_ids))
+    owners, positions, terms = [], [], []
+    for i, term_id in enumerate(distinct):
+        owner, term_pos = term_positions(index, term_id, doc_ids)
+        owners.append(owner)
+        positions.append(term_pos)
+        terms.append(np.full(len(owner), i))
+    owners, positions, terms = np.concatenate(owners), np.concatenate(positions), np.concatenate(terms)
+    order = np.lexsort((positions, owners))
+    owners, positions, terms = owners[order], positions[order], terms[order]
+
+    width = len(term_ids) + slop - 1  # largest distance between the first and the last term
+    bounds = np.flatnonzero(np.diff(owners)) + 1
+    matched = [owners[start] for start, end in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(owners)])))
+               if _covers(positions[start:end], terms[start:end], len(distinct), width)]
+    return doc_ids[np.asarray(matched, dtype=np.int64)]
+
+
+def _covers(positions, terms, num_terms, width):
+    """
+    Return True if a window of at most `width` positions contains every one of the num_terms terms (positions sorted,
+    terms[i] being the term at positions[i]): the left edge of the window slides while it still covers all of them.
+    """
+    counts = [0] * num_terms
+    covered = 0
+    left = 0
+    for right in range(len(positions)):
+        counts[terms[right]] += 1
+        covered += counts[terms[right]] == 1
+        while covered == num_terms:
+            if positions[right] - positions[left] <= width:
+                return True
+            counts[terms[left]] -= 1
+            covered -= counts[terms[left]] == 0
+            left += 1
+    return False
+
+
+def match_phrases(index, phrases, candidates=None):
+    """
+    Return the sorted doc ids of the products matching every phrase / proximity operator of a query.
+
+    phrases is a list of (term ids, slop): slop 0 is a phrase ("slim fit jeans"), otherwise the terms must appear
+    within len(terms) + slop positions of each other, in any order ("slim jeans"~2). The products containing all the
+    terms are found first with the normal posting intersection (restricted to `candidates`, if given), and positions
+    are only decoded for them. Without positions in the index, the operators only require all the terms.
+    """
+    for term_ids, slop in phrases:
+        if None in term_ids:
+            return np.zeros(0, dtype=np.int32)
+        posting_lists = [index.postings(term_id)[0] for term_id in set(term_ids)]
+        if candidates is not None:
+            posting_lists.append(candidates)
+        candidates = intersect_postings(posting_lists)
+        if len(candidates) == 0 or len(term_ids) < 2 or not index.has_positions:
+            continue
+        candidates = _phrase(index, term_ids, candidates) if slop == 0 else _window(index, term_ids, candidates, slop)
+    return candidates if candidates is not None else np.zeros(0, dtype=np.int32)
+
+
+def proximity_scores(index, term_weights, doc_ids):
+    """
+    Return a proximity score for every candidate (doc_ids, sorted): for every pair of distinct query terms present in
+    the product, min(weight a, weight b) / d ** 2, d being the smallest distance between an occurrence of a and an
+    occurrence of b. Products where query terms appear close together get the highest scores.
+    """
+    scores = np.zeros(len(doc_ids))
+    if not index.has_positions or len(doc_ids) == 0:
+        return scores
+    keys = {}
+    for term_id, _ in term_weights:
+        owner, positions = term_positions(index, term_id, doc_ids)
+        keys[term_id] = (owner << KEY_SHIFT) | positions  # sorted
+
+    for i, (term_a, weight_a) in enumerate(term_weights):
+        for term_b, weight_b in term_weights[i + 1:]:
+            keys_a, keys_b = keys[term_a], keys[term_b]
+            if len(keys_a) == 0 or len(keys_b) == 0:
+                continue
+            # nearest occurrence of b (before or after) of every occurrence of a, in the same product
+            after = np.minimum(np.searchsorted(keys_b, keys_a), len(keys_b) - 1)
+            before = np.maximum(after - 1, 0)
+            distance = np.full(len(keys_a), np.inf)
+            for nearest in (after, before):
+                same_doc = (keys_b[nearest] >> KEY_SHIFT) == (keys_a >> KEY_SHIFT)
+                distance[same_doc] = np.minimum(distance[same_doc], np.abs(keys_b[nearest] - keys_a)[same_doc])
+            owners = keys_a >> KEY_SHIFT
+            min_distance = np.full(len(doc_ids), np.inf)
+            np.minimum.at(min_distance, owners, distance)
+            close = np.isfinite(min_distance) & (min_distance > 0)
+            scores[close] += min(weight_a, weight_b) / min_distance[close] ** 2
+    return scores
+
+
+def document_terms(index):
+    """
+    Return the terms of every product in the order they appear in it (title, then description), rebuilt from the
+    positions of the index instead of tokenising the corpus again: the term ids of all the products one after the
+    other, and the offsets of every product in them (product d is term_ids[offsets[d]:offsets[d + 1]]).
+    The index must have positions.
+    """
+    counts = index.freqs
+    gaps = varbyte.decode(index.positions)
+    sums = np.cumsum(gaps)
+    first = np.cumsum(counts) - counts
+    positions = sums - np.repeat(sums[first] - gaps[first], counts) if len(gaps) else gaps
+    owners = np.repeat(index.doc_ids, counts)
+    term_ids = np.repeat(np.repeat(np.arange(len(index.terms), dtype=np.int32), index.df), counts)
+    order = np.lexsort((positions, owners))
+    offsets = np.zeros(index.num_docs + 1, dtype=np.int64)
+    np.cumsum(index.doc_len, out=offsets[1:])
+    return term_ids[order], offsets
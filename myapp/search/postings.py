@@ -0,0 +1,49 @@
+import numpy as np
+
+
+def _probe(doc_ids, postings):
+    """Return the doc ids (sorted) that are also in the sorted postings array, using a binary search per doc id."""
+    positions = np.searchsorted(postings, doc_ids)
+    found = positions < len(postings)
+    found[found] = postings[positions[found]] == doc_ids[found]
+    return doc_ids[found]
+
+
+def intersect_postings(posting_lists):
+    """
+    Return the sorted doc ids present in every one of the sorted posting lists (AND query).
+
+    Lists are processed from the rarest (shortest) term to the most common one, so the running intersection is
+    never longer than the rarest posting list and usually shrinks quickly. Each following list is first cut down to
+    the range [first, last] of the running intersection (two binary searches skip everything before and after it),
+    then the remaining candidates are located in it with binary searches (np.searchsorted over the sorted
+    candidates), which costs O(candidates * log(list length)) instead of a scan of the whole longer list.
+    The loop stops as soon as the intersection is empty.
+    """
+    if not posting_lists:
+        return np.zeros(0, dtype=np.int32)
+    posting_lists = sorted(posting_lists, key=len)
+
+    result = posting_lists[0]
+    for postings in posting_lists[1:]:
+        if len(result) == 0:
+            break
+        # skip the parts of the longer list that are before the first / after the last candidate
+        start = np.searchsorted(postings, result[0], side="left")
+        end = np.searchsorted(postings, result[-1], side="right")
+        result = _probe(result, postings[start:end])
+    return result
+
+
+def union_size(posting_lists, num_docs, mask=None):
+    """
+    Return the number of products in at least one of the posting lists (number of hits of an OR query) without
+    building the union: the doc ids are only marked in a boolean array. If mask is given (boolean array indexed by
+    doc id), only the products where it is True are counted.
+    """
+    hits = np.zeros(num_docs, dtype=bool)
+    for postings in posting_lists:
+        hits[postings] = True
+    if mask is not None:
+        hits &= mask
+    return int(np.count_nonzero(hits))
@@ -0,0 +1,251 @@
+import collections
+
+import numpy as np
+from numpy import linalg as la
+
+from .sparse import SparseMatrix
+
+
+def _max_per_term(index, contributions):
+    """Return the maximum of the per-posting contributions of every term (its score upper bound)."""
+    if len(contributions) == 0:
+        return np.zeros(len(index.terms))
+    return np.maximum.reduceat(contributions, index.offsets[:-1])
+
+
+def select_top_k(doc_ids, scores, k=None):
+    """
+    Return the doc ids and scores of the k best products (all of them if k is None) sorted by decreasing score, ties
+    in doc id order. doc_ids must be sorted. The k best are found with argpartition, so only they are fully sorted.
+    """
+    if k is not None and k < len(scores):
+        # the k-th best score and everything above it, so ties at the boundary are resolved by doc id like a full sort
+        kth_score = -np.partition(-scores, k - 1)[k - 1]
+        selected = np.flatnonzero(scores >= kth_score)
+        doc_ids, scores = doc_ids[selected], scores[selected]
+    order = np.argsort(-scores, kind="stable")[:k]
+    return doc_ids[order], scores[order]
+
+
+class BM25Ranker:
+    """
+    Term-at-a-time BM25 scorer over a CompactIndex.
+
+    The length normalisation of every product, k1 * ((1 - b) + b * doc_len / L_ave), does not depend on the query,
+    so it is computed once when the ranker is built. Scoring a query then walks the posting list of each query term
+    and accumulates idf * (k1 + 1) * tf / (length_norm + tf) into a score array indexed by doc id.
+    length_norm and upper_bounds can be passed in when they were saved with the index.
+    """
+
+    def __init__(self, index, k1=1.2, b=0.75, length_norm=None, upper_bounds=None):
+        self.index = index
+        self.k1 = k1
+        self.b = b
+        if length_norm is None:
+            length_norm = k1 * ((1 - b) + b * (index.doc_len / index.L_ave))
+        self.length_norm = length_norm
+
+        # highest contribution of each term to any product, used to prune the top-k search
+        if upper_bounds is None:
+            idf = np.repeat(index.idf, index.df)
+            upper_bounds = _max_per_term(index, idf * (k1 + 1) * index.freqs / (length_norm[index.doc_ids] + index.freqs))
+        self.upper_bounds = upper_bounds
+
+    def arrays(self):
+        """Return the precomputed arrays of the ranker, to save them with the index."""
+        return {"length_norm": self.length_norm, "upper_bounds": self.upper_bounds}
+
+    @property
+    def nbytes(self):
+        """Memory of the BM25 statistics (the postings belong to the shared index)."""
+        return self.length_norm.nbytes + self.upper_bounds.nbytes
+
+    def query_weights(self, terms):
+        """
+        Return the (term id, weight) pairs of the query: repeated query terms count once per occurrence and terms that
+        are not in the index are ignored.
+        """
+        query_terms_count = collections.Counter(terms)
+        term_ids = ((self.index.term_id(term), count) for term, count in query_terms_count.items())
+        return [(term_id, count) for term_id, count in term_ids if term_id is not None]
+
+    def term_scores(self, term_id, positions=None):
+        """
+        Return the doc ids of the postings of a term and the BM25 contribution of the term to each of them.
+        If positions is given, only those entries of the posting list are scored.
+        """
+        posting_docs, posting_freqs = self.index.postings(term_id)
+        if positions is not None:
+            posting_docs, posting_freqs = posting_docs[positions], posting_freqs[positions]
+        contributions = self.index.idf[term_id] * (self.k1 + 1) * posting_freqs / (self.length_norm[posting_docs] + posting_freqs)
+        return posting_docs, contributions
+
+    def score(self, terms):
+        """Return the BM25 score of every product for the query terms (an array indexed by doc id)."""
+        scores = np.zeros(self.index.num_docs)
+        for term_id, weight in self.query_weights(terms):
+            posting_docs, contributions = self.term_scores(term_id)
+            scores[posting_docs] += weight * contributions  # doc ids are unique inside a posting list
+        return scores
+
+
+class TfidfRanker:
+    """
+    TF-IDF scorer over a CompactIndex.
+
+    The weight of a term in a product is tf * idf, tf being the raw frequency divided by the norm of the product
+    (rounded to 4 decimals, as the original index did). These weights are computed once and stored as a
+    products x terms CSC sparse matrix that shares the doc ids and offsets of the index, so scoring a query is a
+    single sparse matrix-vector product and scoring a batch of queries a single matrix-matrix product.
+    weights and upper_bounds can be passed in when they were saved with the index.
+    """
+
+    def __init__(self, index, weights=None, upper_bounds=None):
+        self.index = index
+
+        if weights is None:
+            idf = np.repeat(index.idf, index.df)
+            weights = (np.round(index.freqs / index.doc_norm[index.doc_ids], 4) * idf).astype(np.float32)
+        self.matrix = SparseMatrix(index.offsets, index.doc_ids, weights, (index.num_docs, len(index.terms)))
+        if upper_bounds is None:
+            upper_bounds = _max_per_term(index, weights)
+        self.upper_bounds = upper_bounds
+
+    def arrays(self):
+        """Return the precomputed arrays of the ranker, to save them with the index."""
+        return {"weights": self.matrix.data, "upper_bounds": self.upper_bounds}
+
+    @property
+    def nbytes(self):
+        """Memory of the tf-idf statistics (the doc ids and offsets of the matrix belong to the shared index)."""
+        return self.matrix.data.nbytes + self.upper_bounds.nbytes
+
+    def query_weights(self, terms):
+        """
+        Return the (term id, weight) pairs of the query. The weight of a term is its tf-idf weight in the (normalised)
+        query vector, multiplied by its number of occurrences since every occurrence adds a dimension to the dot product.
+        """
+        query_terms_count = collections.Counter(terms)  # get the frequency of each term in the query.
+        query_norm = la.norm(list(query_terms_count.values()))
+
+        weights = []
+        for term, count in query_terms_count.items():
+            term_id = self.index.term_id(term)
+            if term_id is None:
+                continue
+            weights.append((term_id, count * count / query_norm * self.index.idf[term_id]))
+        return weights
+
+    def term_scores(self, term_id, positions=None):
+        """
+        Return the doc ids of the postings of a term and the tf-idf weight of the term in each of them.
+        If positions is given, only those entries of the posting list are returned.
+        """
+        posting_docs, weights = self.matrix.column(term_id)
+        if positions is not None:
+            posting_docs, weights = posting_docs[positions], weights[positions]
+        return posting_docs, weights
+
+    def score(self, terms):
+        """Return the tf-idf score (dot product with the query vector) of every product (an array indexed by doc id)."""
+        weights = self.query_weights(terms)
+        return self.matrix.matvec([term_id for term_id, _ in weights], [weight for _, weight in weights])
+
+    def score_batch(self, queries):
+        """
+        Return the tf-idf scores of every product for a batch of queries (lists of terms), as a
+        (number of products x number of queries) array.
+        """
+        batch_weights = [dict(self.query_weights(terms)) for terms in queries]
+        term_ids = sorted(set().union(*batch_weights))
+        query_matrix = np.zeros((len(term_ids), len(queries)))
+        for j, weights in enumerate(batch_weights):
+            for i, term_id in enumerate(term_ids):
+                query_matrix[i, j] = weights.get(term_id, 0.0)
+        return self.matrix.matmat(term_ids, query_matrix)
+
+    def top_k_batch(self, queries, k):
+        """
+        Return, for every query of the batch, the doc ids and scores of its k best products (products with a score of
+        0 don't contain any query term and are left out), sorted by decreasing score.
+        """
+        scores = self.score_batch(queries)
+        results = []
+        for j in range(len(queries)):
+            doc_ids = np.flatnonzero(scores[:, j] > 0)
+            results.append(select_top_k(doc_ids, scores[doc_ids, j], k))
+        return results
+
+
+def max_score(ranker, terms):
+    """
+    Return the highest score any product can get for the query terms: the sum of the (weighted) score upper bounds of
+    its terms. It only depends on the query and the index, not on which products are scored.
+    """
+    return float(sum(weight * ranker.upper_bounds[term_id] for term_id, weight in ranker.query_weights(terms)))
+
+
+def combined_max_score(rankers, terms):
+    """
+    max_score over the products of several indexes searched together (the base index and its segments, see
+    IndexRegistry): the sum, over the query terms, of the largest (weighted) upper bound the term has in any of them.
+    """
+    bounds = {}
+    for ranker in rankers:
+        for term_id, weight in ranker.query_weights(terms):
+            term = ranker.index.terms[term_id]
+            bounds[term] = max(bounds.get(term, 0.0), weight * ranker.upper_bounds[term_id])
+    return float(sum(bounds.values()))
+
+
+def top_k(ranker, terms, k, mask=None):
+    """
+    Return the doc ids and scores of the k best products containing at least one query term (OR semantics).
+
+    Term-at-a-time MaxScore: terms are processed by decreasing score upper bound while keeping the scores of the
+    candidates seen so far. Once the sum of the upper bounds of the remaining terms cannot beat the current k-th best
+    score, products that have not been seen yet cannot enter the top k, so the posting lists of the remaining
+    (usually very common, low idf) terms are only probed for the candidates that can still make it, instead of being
+    scanned completely. Candidates that can no longer reach the k-th best score are dropped along the way.
+
+    If mask is given (boolean array indexed by doc id, see filters.py), only the products where it is True are
+    candidates: the others are dropped from the posting lists before they are scored.
+
+    The doc ids are returned in increasing order; the caller sorts by score.
+    """
+    weights = ranker.query_weights(terms)
+    weights.sort(key=lambda term_weight: term_weight[1] * ranker.upper_bounds[term_weight[0]], reverse=True)
+    bounds = np.array([weight * ranker.upper_bounds[term_id] for term_id, weight in weights])
+    remaining = np.append(np.cumsum(bounds[::-1])[::-1], 0.0)  # remaining[i] = sum of the bounds of terms i, i+1, ...
+
+    doc_ids = np.zeros(0, dtype=np.int32)
+    scores = np.zeros(0)
+    threshold = -np.inf  # k-th best score so far (only grows)
+
+    for i, (term_id, weight) in enumerate(weights):
+        if remaining[i] >= threshold:
+            # new products can still enter the top k: add the whole posting list
+            posting_docs, contributions = ranker.term_scores(term_id)
+            if mask is not None:
+                allowed = mask[posting_docs]
+                posting_docs, contributions = posting_docs[allowed], contributions[allowed]
+            all_docs = np.concatenate([doc_ids, posting_docs])
+            doc_ids, inverse = np.unique(all_docs, return_inverse=True)
+            new_scores = np.zeros(len(doc_ids))
+            new_scores[inverse[:len(scores)]] = scores
+            new_scores[inverse[len(scores):]] += weight * contributions
+            scores = new_scores
+        else:
+            # only the current candidates can make it: look them up in the (sorted) posting list
+            posting_docs = ranker.index.postings(term_id)[0]
+            positions = np.searchsorted(posting_docs, doc_ids)
+            found = positions < len(posting_docs)
+            found[found] = posting_docs[positions[found]] == doc_ids[found]
+            scores[found] += weight * ranker.term_scores(term_id, positions[found])[1]
+
+        if len(scores) >= k:
+            threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+            alive = scores + remaining[i + 1] >= threshold
+            doc_ids, scores = doc_ids[alive], scores[alive]
+
+    return doc_ids, scores
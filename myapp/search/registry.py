@@ -0,0 +1,407 @@
+import collections
+import copy
+import glob
+import os
+import threading
+import time
+
+import numpy as np
+
+from .compact_index import CompactIndex
+from .corpus_store import CorpusStore
+from .dense import DenseIndex
+from .filters import FilterIndex
+from .index_file import read_index_file, write_index_file
+from .rankers import BM25Ranker, TfidfRanker
+from .reranker import FeatureReranker
+
+
+def save_indexes(path, index, rankers):
+    """
+    Save the compact index and the precomputed arrays of the ranking models (dict name -> ranker) in one binary
+    index file. The corpus itself is not saved: the index only needs the pids.
+    """
+    arrays = index.arrays()
+    for name, ranker in rankers.items():
+        arrays.update({f"{name}_{array_name}": array for array_name, array in ranker.arrays().items()})
+    metadata = {
+        "num_docs": index.num_docs,
+        "L_ave": index.L_ave,
+        "k1": rankers["bm25"].k1,
+        "b": rankers["bm25"].b,
+    }
+    write_index_file(path, arrays, metadata)
+
+
+class IndexPart:
+    """
+    One of the indexes searched together by the registry: the base index, or a segment of incremental updates (see
+    segments.py). Its doc ids are the rows of its own corpus store, and `live` (boolean array indexed by doc id, None
+    when every product is live) hides the products deleted or replaced by the segments written after it.
+    """
+
+    def __init__(self, index, models, corpus=None, filters=None, reranker=None, dense=None, path=None, tombstones=None):
+        self.index = index
+        self.models = models
+        self.corpus = corpus
+        self.filters = filters
+        self.reranker = reranker
+        self.dense = dense
+        self.path = path  # segment file (None for the base index)
+        self.tombstones = tombstones if tombstones is not None else np.zeros(0, dtype="S")  # pids it hides in older parts
+        self.new_terms = None  # terms of a segment that the base index does not know (boolean array by term id)
+        self.live = None
+
+    def ranker(self, name):
+        return self.models[name]
+
+    def with_tombstones(self, tombstones):
+        """Return the part with the products whose pid is in tombstones (added to those already hidden) hidden."""
+        rows = self.corpus.rows(tombstones) if self.corpus is not None else np.flatnonzero(np.isin(self.index.pids, tombstones))
+        if len(rows) == 0:
+            return self
+        part = copy.copy(self)
+        part.live = np.ones(self.index.num_docs, dtype=bool) if self.live is None else self.live.copy()
+        part.live[rows] = False
+        return part
+
+    @property
+    def num_live(self):
+        return self.index.num_docs if self.live is None else int(np.count_nonzero(self.live))
+
+
+class LiveCorpus:
+    """
+    The products served by the registry, looked up by pid in its parts (newest first) with the same dict interface
+    as CorpusStore: a product is found in the part that holds its live version.
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def get(self, pid, default=None):
+        for part in reversed(self.parts):
+            row = part.corpus.row(pid)
+            if row is not None and (part.live is None or part.live[row]):
+                return part.corpus.view(row)
+        return default
+
+    def __getitem__(self, pid):
+        product = self.get(pid)
+        if product is None:
+            raise KeyError(pid)
+        return product
+
+    def __contains__(self, pid):
+        return self.get(pid) is not None
+
+    def __len__(self):
+        return sum(part.num_live for part in self.parts)
+
+    def values(self):
+        for part in self.parts:
+            for row in range(len(part.corpus)):
+                if part.live is None or part.live[row]:
+                    yield part.corpus.view(row)
+
+    def keys(self):
+        return [product.pid for product in self.values()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        return ((product.pid, product) for product in self.values())
+
+
+class IndexRegistry:
+    """
+    Holds the index used to answer queries: one shared compact index (postings, term dictionary, pids) and, on top
+    of it, one ranker per ranking model that only keeps the statistics of its model (tf-idf weights for TF-IDF,
+    length normalisation for BM25, and the score upper bounds of each).
+
+    If corpus_path is given, the corpus store saved with the index is loaded with it (`corpus`), so the rows of the
+    corpus always match the doc ids of the index being served, and the structured filters of the search are
+    precomputed from it (`filters`, see filters.py), as well as the product features of the 'our-score' re-ranking
+    (`reranker`, see reranker.py). If dense_path is given and the file exists, the product vectors
+    of the dense algorithms are opened too (`dense`, see dense.py); without it, only the lexical algorithms are
+    available.
+
+    With a corpus store, the segments of incremental updates found in segments_dir (see segments.py) are searched
+    together with this base index: `parts` is the base index followed by one IndexPart per segment, oldest first, and
+    every part hides (`live`) the products tombstoned by the segments written after it. A segment is small, so opening
+    it (load_segments) only costs its own size: it is scored with the statistics of the base index (idf of the terms
+    the base knows, L_ave, BM25 parameters, feature ranges of 'our-score'), so that its scores compare with those of
+    the base, and these statistics are only recomputed when the segments are merged into the base index. `documents`
+    looks the products up by pid in the parts (the live version of each). index, corpus, filters, reranker and dense
+    are those of the base index; dense vectors only exist for it.
+
+    The web app loads it at startup, before serving traffic, and status() reports whether it is ready together with
+    the load time and memory of the index and of each model (for a /healthz endpoint). Every load, of the base index or
+    of new segments, increments `generation`, so caches of search results can tell when the products they were computed
+    on have changed; `base_generation` only counts the loads of the base index.
+    """
+
+    def __init__(self, path, corpus_path=None, dense_path=None, segments_dir=None):
+        self.path = path
+        self.corpus_path = corpus_path
+        self.dense_path = dense_path
+        self.segments_dir = segments_dir or os.path.join(os.path.dirname(path), "segments")
+        self.index = None
+        self.corpus = None
+        self.filters = None
+        self.reranker = None
+        self.dense = None
+        self.models = {}
+        self.parts = ()
+        self.documents = None
+        self.generation = 0
+        self.base_generation = 0
+        self._file_id = None  # (inode, modification time) of the index file that was loaded
+        self._segments_id = None  # modification time of the segments directory when its segments were listed
+        self._base = None  # IndexPart of the base index, without the tombstones of the segments
+        self._segments = {}  # path -> (file id, IndexPart) of the segments opened on the current base index
+        self._load_ms = {}
+        self._lock = threading.Lock()
+        if hasattr(os, "register_at_fork"):
+            # a forked server worker must not inherit the lock in the state another thread of the parent left it
+            os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.index is not None
+
+    def load(self):
+        """(Re)load the index file and the segments. Queries keep using the previous index until the new one is complete."""
+        with self._lock:
+            load_ms = {}
+            file_id = self._stat()
+
+            start = time.perf_counter()
+            arrays, metadata = read_index_file(self.path)
+            index = CompactIndex(arrays["terms"], arrays["pids"], arrays["offsets"], arrays["doc_ids"], arrays["freqs"],
+                                 arrays["doc_len"], arrays["doc_norm"], idf=arrays["idf"], L_ave=metadata["L_ave"],
+                                 positions=arrays.get("positions"), position_offsets=arrays.get("position_offsets"))
+            load_ms["index"] = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            tfidf = TfidfRanker(index, weights=arrays["tfidf_weights"], upper_bounds=arrays["tfidf_upper_bounds"])
+            load_ms["tfidf"] = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            bm25 = BM25Ranker(index, k1=metadata["k1"], b=metadata["b"], length_norm=arrays["bm25_length_norm"],
+                              upper_bounds=arrays["bm25_upper_bounds"])
+            load_ms["bm25"] = (time.perf_counter() - start) * 1000
+
+            corpus = filters = reranker = None
+            if self.corpus_path is not None:
+                start = time.perf_counter()
+                corpus = CorpusStore.open(self.corpus_path)
+                load_ms["corpus"] = (time.perf_counter() - start) * 1000
+                if len(corpus) != index.num_docs:
+                    raise ValueError("{} has {} products but the index has {}. Rebuild the index.".format(
+                        self.corpus_path, len(corpus), index.num_docs))
+                start = time.perf_counter()
+                filters = FilterIndex(corpus)
+                load_ms["filters"] = (time.perf_counter() - start) * 1000
+                start = time.perf_counter()
+                reranker = FeatureReranker(corpus)
+                load_ms["reranker"] = (time.perf_counter() - start) * 1000
+
+            dense = None
+            if self.dense_path is not None and os.path.exists(self.dense_path):
+                start = time.perf_counter()
+                dense = DenseIndex.open(self.dense_path, index.pids)
+                load_ms["dense"] = (time.perf_counter() - start) * 1000
+
+            base = IndexPart(index, {"tfidf": tfidf, "bm25": bm25}, corpus, filters, reranker, dense)
+            start = time.perf_counter()
+            segments_id, segments, parts = self._open_segments(base, {})
+            load_ms["segments"] = (time.perf_counter() - start) * 1000
+
+            # swap everything at once
+            self.models = base.models
+            self.index = index
+            self.corpus = corpus
+            self.filters = filters
+            self.reranker = reranker
+            self.dense = dense
+            self._file_id = file_id
+            self._load_ms = load_ms
+            self._base = base
+            self._set_parts(segments_id, segments, parts)
+            self.base_generation += 1
+            print("Index loaded in {:.1f} ms (generation {}, {} segments).".format(sum(load_ms.values()), self.generation,
+                                                                                 len(segments)))
+
+    def load_segments(self):
+        """
+        Open the segments written since the last load (the others are kept open) and apply their tombstones, without
+        reloading the base index: changes are searchable as soon as their segment is written.
+        """
+        with self._lock:
+            if not self.ready:
+                return
+            segments_id, segments, parts = self._open_segments(self._base, self._segments)
+            if [part.path for part in parts] != [part.path for part in self.parts] or \
+                    any(segments[path][0] != self._segments[path][0] for path in segments):
+                self._set_parts(segments_id, segments, parts)
+            else:
+                self._segments_id = segments_id
+
+    def segment_paths(self):
+        """Return the paths of the segment files, oldest first (they are named by creation time)."""
+        return sorted(glob.glob(os.path.join(self.segments_dir, "segment_*.bin")))
+
+    def _open_segments(self, base, opened):
+        """
+        Return the modification time of the segments directory, the segments (path -> (file id, IndexPart)) and the
+        parts to search: the base index and the segments, with the tombstones applied. Segments already in `opened`
+        (opened on the same base index) are not read again.
+        """
+        segments_id = self._stat_segments()  # before listing: a segment written meanwhile is seen by the next refresh
+        segments = {}
+        if self.corpus_path is not None:
+            for path in self.segment_paths():
+                try:
+                    file_id = _file_id(path)
+                    if path in opened and opened[path][0] == file_id:
+                        segments[path] = opened[path]
+                    else:
+                        segments[path] = (file_id, self._open_segment(path, base))
+                except FileNotFoundError:
+                    pass  # merged in the meantime (by another process): its products are in the base or a later segment
+
+            # document frequency, in all the segments, of the terms that the base index does not know
+            df = collections.Counter()
+            for _, part in segments.values():
+                df.update(dict(zip(part.index.terms[part.new_terms].tolist(), part.index.df[part.new_terms].tolist())))
+            num_docs = base.index.num_docs + sum(part.index.num_docs for _, part in segments.values())
+            segments = {path: (file_id, self._score_segment(part, base, df, num_docs)) for path, (file_id, part) in segments.items()}
+
+        # every part loses the products tombstoned by the segments written after it
+        parts = [base] + [part for _, part in segments.values()]
+        later = []
+        for i in range(len(parts) - 1, -1, -1):
+            if later:
+                parts[i] = parts[i].with_tombstones(np.concatenate(later))
+            later.append(parts[i].tombstones)
+        return segments_id, segments, tuple(parts)
+
+    def _open_segment(self, path, base):
+        """
+        Open a segment file as an IndexPart. Its index takes the idf of the base index for the terms the base knows and
+        L_ave of the base; its rankers are made by _score_segment, once the idf of its other terms is known.
+        """
+        arrays, _ = read_index_file(path)
+        index = CompactIndex(arrays["index_terms"], arrays["index_pids"], arrays["index_offsets"], arrays["index_doc_ids"],
+                             arrays["index_freqs"], arrays["index_doc_len"], arrays["index_doc_norm"], idf=arrays["index_idf"],
+                             L_ave=base.index.L_ave, positions=arrays.get("index_positions"),
+                             position_offsets=arrays.get("index_position_offsets"))
+        corpus = CorpusStore({name[len("corpus_"):]: array for name, array in arrays.items() if name.startswith("corpus_")})
+        if base.index.has_positions and not index.has_positions:
+            # written without positions (by an older version): index its products again so phrases match in it too
+            from .algorithms import index_documents
+            rebuilt = index_documents([corpus[pid] for pid in corpus.row_pids().astype(str)], positions=True)
+            index = CompactIndex(rebuilt.terms, rebuilt.pids, rebuilt.offsets, rebuilt.doc_ids, rebuilt.freqs, rebuilt.doc_len,
+                                 rebuilt.doc_norm, idf=rebuilt.idf, L_ave=base.index.L_ave, positions=rebuilt.positions,
+                                 position_offsets=rebuilt.position_offsets)
+
+        # position in the base dictionary of the terms of the segment, and whether the base has them
+        positions = np.minimum(np.searchsorted(base.index.terms, index.terms), max(len(base.index.terms) - 1, 0))
+        known = base.index.terms[positions] == index.terms if len(base.index.terms) else np.zeros(len(index.terms), dtype=bool)
+        index.idf = np.where(known, base.index.idf[positions] if len(base.index.terms) else 0.0, 0.0)
+        reranker = FeatureReranker(corpus, weights=base.reranker.weights, ranges=base.reranker.ranges)
+        part = IndexPart(index, None, corpus, FilterIndex(corpus), reranker, path=path, tombstones=arrays["tombstones"])
+        part.new_terms = ~known
+        return part
+
+    @staticmethod
+    def _score_segment(part, base, df, num_docs):
+        """
+        Return the segment with its rankers: the terms that the base index does not know get the idf log(N / df), df
+        being their document frequency in all the segments and N the number of products of the base and the segments,
+        so that a new term has the same idf in every segment. The rankers are only made again when this idf changed.
+        """
+        new = part.new_terms
+        idf = part.index.idf.copy()
+        idf[new] = np.round(np.log(num_docs / np.array([df[term] for term in part.index.terms[new].tolist()], dtype=np.float64)), 4)
+        if part.models is not None and np.array_equal(idf, part.index.idf):
+            return part
+        part = copy.copy(part)
+        part.index = copy.copy(part.index)
+        part.index.idf = idf
+        bm25 = base.ranker("bm25")
+        part.models = {"tfidf": TfidfRanker(part.index), "bm25": BM25Ranker(part.index, k1=bm25.k1, b=bm25.b)}
+        return part
+
+    def _set_parts(self, segments_id, segments, parts):
+        self.parts = parts
+        self.documents = LiveCorpus(parts) if self.corpus_path is not None else None
+        self._segments = segments
+        self._segments_id = segments_id
+        self.generation += 1
+
+    def _stat(self):
+        return _file_id(self.path)
+
+    def _stat_segments(self):
+        try:
+            return os.stat(self.segments_dir).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def refresh(self):
+        """
+        Load the index again if the index file was replaced since it was loaded (e.g. by a merge of incremental updates
+        in another process), or only the new segments if the segments directory changed (segments written or merged by
+        another process). Costs two stat() when nothing changed.
+        """
+        if not self.ready:
+            return
+        if self._stat() != self._file_id:
+            self.load()
+        elif self._stat_segments() != self._segments_id:
+            self.load_segments()
+
+    def ranker(self, name):
+        """Return the ranker of a model ("tfidf" or "bm25") on the base index."""
+        return self.models[name]
+
+    def status(self):
+        """Return the readiness of the registry and the load time (ms) and memory (bytes) of the index and each model."""
+        if not self.ready:
+            return {"ready": False, "generation": self.generation}
+        status = {
+            "ready": True,
+            "generation": self.generation,
+            "num_docs": self.index.num_docs,
+            "index": {"load_ms": round(self._load_ms["index"], 3), "memory_bytes": self.index.memory_usage()["total"]},
+            "models": {},
+        }
+        for name, ranker in self.models.items():
+            status["models"][name] = {"load_ms": round(self._load_ms[name], 3), "memory_bytes": ranker.nbytes}
+        if self.corpus is not None:
+            status["corpus"] = {"load_ms": round(self._load_ms["corpus"], 3), "num_docs": len(self.corpus)}
+            status["filters"] = {"load_ms": round(self._load_ms["filters"], 3), "memory_bytes": self.filters.nbytes}
+            # latency of the re-ranking stage alone (the first stage is the BM25 top k)
+            status["reranker"] = {"load_ms": round(self._load_ms["reranker"], 3), "memory_bytes": self.reranker.nbytes,
+                                  **self.reranker.stats()}
+            parts = self.parts
+            status["num_docs"] = len(self.documents)
+            # products of the segments, and products of any part hidden by the tombstones of a later segment
+            status["segments"] = {"count": len(parts) - 1, "num_docs": sum(part.index.num_docs for part in parts[1:]),
+                                  "hidden": sum(part.index.num_docs - part.num_live for part in parts)}
+        if self.dense is not None:
+            status["dense"] = {"load_ms": round(self._load_ms["dense"], 3),
+                               "models": {name: {"memory_bytes": model.nbytes} for name, model in self.dense.models.items()}}
+        return status
+
+
+def _file_id(path):
+    """(inode, modification time) of a file: it changes when the file is replaced."""
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns
@@ -0,0 +1,137 @@
+import os
+import time
+
+import numpy as np
+
+# weight of the BM25 score and of each product feature in "our score" (alpha, beta, gamma, delta, epsilon)
+WEIGHT_NAMES = ("bm25", "rating", "discount", "price", "in_stock")
+DEFAULT_WEIGHTS = (0.65, 0.05, 0.05, 0.10, 0.15)
+
+
+def parse_weights(text):
+    """Return the weights of a comma separated list of 5 numbers (e.g. the OUR_SCORE_WEIGHTS environment variable)."""
+    weights = [float(weight) for weight in text.split(",")]
+    if len(weights) != len(WEIGHT_NAMES):
+        raise ValueError("Expected {} weights ({}), got {}".format(len(WEIGHT_NAMES), ", ".join(WEIGHT_NAMES), text))
+    return weights
+
+
+FEATURE_FIELDS = ("average_rating", "discount", "selling_price")
+
+
+def _range(column):
+    """Return the (min, max) of a column, ignoring the missing values ((nan, nan) if there are none)."""
+    present = column[~np.isnan(column)]
+    if len(present) == 0:
+        return np.nan, np.nan
+    return float(present.min()), float(present.max())
+
+
+def _min_max(column, low, high):
+    """Scale a column to [0, 1] over the range [low, high] (0 for a missing value or a constant column)."""
+    if not high > low:
+        return np.zeros(len(column))
+    return np.nan_to_num(np.clip((column - low) / (high - low), 0.0, 1.0), nan=0.0)
+
+
+class FeatureReranker:
+    """
+    Second stage of the "our score" ranking: re-scores the candidates of a cheap first stage (the best BM25 products,
+    see search_terms) with
+
+        our_score = alpha * bm25 + beta * rating + gamma * discount + delta * (1 - price) + epsilon * (1 - out_of_stock)
+
+    where bm25 is the BM25 score divided by the highest score a product can get for the query (the sum of the score
+    upper bounds of its terms, see rankers.max_score) and the features are min-max scaled over the whole corpus, so the
+    score of a product does not depend on the other candidates (nor on how many were re-ranked). The features are
+    precomputed once from the corpus store into one (products x 4) float32 array indexed by doc id, so re-ranking k
+    candidates is one gather and one matrix-vector product instead of a lookup of every product in a DataFrame.
+    A missing feature contributes 0. The ranges of the features can be given (`ranges`, field -> (min, max)), e.g. those
+    of the base index for the products of a segment (see IndexRegistry), so that both are scaled the same way; values
+    outside them are clipped.
+
+    The weights are given to the constructor or by the OUR_SCORE_WEIGHTS environment variable ("0.65,0.05,0.05,0.10,0.15"
+    by default). The time spent re-ranking is measured apart from the first stage and reported by stats().
+    """
+
+    def __init__(self, corpus, weights=None, ranges=None):
+        if weights is None:
+            weights = parse_weights(os.getenv("OUR_SCORE_WEIGHTS", ",".join(str(weight) for weight in DEFAULT_WEIGHTS)))
+        self.weights = np.asarray(weights, dtype=np.float64)
+        if ranges is None:
+            ranges = {field: _range(getattr(corpus, field)) for field in FEATURE_FIELDS}
+        self.ranges = ranges
+        self.features = np.column_stack([
+            _min_max(corpus.average_rating, *ranges["average_rating"]),
+            _min_max(corpus.discount, *ranges["discount"]),
+            np.where(np.isnan(corpus.selling_price), 0.0, 1.0 - _min_max(corpus.selling_price, *ranges["selling_price"])),
+            ~np.asarray(corpus.out_of_stock, dtype=bool),
+        ]).astype(np.float32)
+        self.calls = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    @property
+    def nbytes(self):
+        return self.features.nbytes
+
+    def rerank(self, doc_ids, scores, max_score):
+        """
+        Return the "our score" of the candidates (doc ids and their BM25 scores), in the same order. max_score is the
+        highest BM25 score of the query (see rankers.max_score).
+        """
+        start = time.perf_counter()
+        scores = np.asarray(scores, dtype=np.float32)
+        scores = np.clip(scores / max_score, 0.0, 1.0) if max_score > 0 else np.zeros_like(scores)
+        our_scores = self.weights[0] * scores + self.features[doc_ids] @ self.weights[1:]
+        elapsed = (time.perf_counter() - start) * 1000
+        self.calls += 1
+        self.total_ms += elapsed
+        self.max_ms = max(self.max_ms, elapsed)
+        return our_scores
+
+    def stats(self):
+        """Weights and latency of the re-ranking stage (for /healthz)."""
+        return {
+            "weights": dict(zip(WEIGHT_NAMES, self.weights.tolist())),
+            "calls": self.calls,
+            "mean_ms": round(self.total_ms / self.calls, 4) if self.calls else 0.0,
+            "max_ms": round(self.max_ms, 4),
+        }
+
+
+if __name__ == "__main__":
+    # benchmark on the saved index and corpus store (python -m myapp.search.reranker): latency of the first stage
+    # (MaxScore top k) and of the re-ranking, against re-ranking with a per-product lookup in the corpus store
+    from .algorithms import RERANK_DEPTH, REGISTRY
+    from .rankers import max_score, top_k
+
+    REGISTRY.load()
+    index, bm25, corpus, reranker = REGISTRY.index, REGISTRY.ranker("bm25"), REGISTRY.corpus, REGISTRY.reranker
+    queries = [index.terms[term_ids].astype(str).tolist() for term_ids in
+               np.random.default_rng(0).choice(np.argsort(-index.df)[:100], (200, 2))]
+
+    def scaled(product, field):
+        value, (low, high) = getattr(product, field), reranker.ranges[field]
+        return (value - low) / (high - low) if value is not None else None
+
+    def lookup(doc_ids, scores, highest):
+        # the way the notebook computes it: every candidate is looked up and scored one at a time
+        alpha, beta, gamma, delta, epsilon = reranker.weights.tolist()
+        result = []
+        for doc_id, score in zip(doc_ids.tolist(), scores.tolist()):
+            product = corpus[index.pid(doc_id)]
+            rating, discount, price = (scaled(product, field) for field in ("average_rating", "discount", "selling_price"))
+            result.append(alpha * min(score / highest, 1.0) + beta * (rating or 0.0) +
+                          gamma * (discount or 0.0) + delta * (1 - price if price is not None else 0.0) +
+                          epsilon * (not product.out_of_stock))
+        return result
+
+    first_stage = [top_k(bm25, query, RERANK_DEPTH) + (max_score(bm25, query),) for query in queries]
+    for label, function in (("first stage: BM25 top {}".format(RERANK_DEPTH), lambda run: top_k(bm25, queries[run], RERANK_DEPTH)),
+                            ("re-rank (feature arrays)", lambda run: reranker.rerank(*first_stage[run])),
+                            ("re-rank (product lookup)", lambda run: lookup(*first_stage[run]))):
+        start = time.perf_counter()
+        for run in range(len(queries)):
+            function(run)
+        print("{:<40} {:8.1f} us".format(label, (time.perf_counter() - start) / len(queries) * 1e6))
@@ -1,8 +1,24 @@
+import os
 import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 import numpy as np
 
-from myapp.search.objects import Document, ResultItem
-from myapp.search.algorithms import search_in_corpus
+from myapp.core.cache import LRUCache
+from myapp.search.objects import Document, ResultItem, ResultPage
+from myapp.search.algorithm_functions import parse_query
+from myapp.search.algorithms import REGISTRY, result_masks, search_in_corpus, search_terms
+from myapp.search.filters import filters_key, merge_facets
+
+# approximate memory of one cached (pid, score) pair: tuple + 16 character str + float
+RESULT_PAIR_BYTES = 64 + 65 + 24
+
+# branches of the 'hybrid' algorithm (lexical, dense), the number of results taken from each and the RRF constant
+HYBRID_BRANCHES = ("bm25-or", os.getenv("HYBRID_DENSE", "w2v"))
+HYBRID_DEPTH = 200
+RRF_K = 60
 
 def dummy_search(corpus: dict, search_id, num_results=20):
     """
@@ -21,9 +37,18 @@ def dummy_search(corpus: dict, search_id, num_results=20):
                             url="doc_details?pid={}&search_id={}&param2=2".format(doc.pid, search_id), ranking=random.random()))
     return res
 
-def algorithm_search(algorithm, search_query, search_id, corpus):
+def algorithm_search(algorithm, search_query, search_id, corpus, k=None, filters=None):
+    """
+    Search with the given algorithm and build a ResultItem for each of the (k best, if k is given) results
+    """
+    ranked_pids, scores = search_in_corpus(algorithm, search_query, corpus, k=k, filters=filters)
+    return _result_items(scores, search_id, corpus)
 
-    ranked_pids, scores = search_in_corpus(algorithm, search_query, corpus)
+
+def _result_items(scores, search_id, corpus):
+    """
+    Build the ResultItem of each (pid, score) pair
+    """
     results = []
     for pid, score in scores:
         doc = corpus[pid]
@@ -43,15 +68,224 @@ def algorithm_search(algorithm, search_query, search_id, corpus):
     return results
 
 
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """
+    Merge ranked lists of pids with reciprocal rank fusion: every product scores the sum of 1 / (k + rank) over the
+    lists it appears in (rank from 1). Returns the (pid, fused score) pairs by decreasing score (ties keep the order
+    in which the products were first seen).
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, pid in enumerate(ranking, start=1):
+            fused[pid] = fused.get(pid, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda pid_score: -pid_score[1])
+
+
+def _results_size(cached):
+    """Approximate memory of a cached (list of (pid, score) pairs, number of hits, depth)"""
+    scores, _, _ = cached
+    return sys.getsizeof(scores) + len(scores) * RESULT_PAIR_BYTES
+
+
 class SearchEngine:
-    """Class that implements the search engine logic"""
+    """
+    Class that implements the search engine logic
+
+    Searches are paginated: only the products of the requested page are built as ResultItem, and the number of
+    hits comes from the candidate count. Ranked results are kept in an LRU cache keyed on the analysed query terms,
+    the filters and the algorithm, together with the depth they were ranked to (the end of the deepest page asked
+    so far), so repeated queries and moving back to earlier pages are slices of the cached ranking; only a page past
+    that depth ranks the query again, deeper, and the products ranked before keep their ranks, so paging never
+    repeats or skips a product. The cache is bounded by entries (and bytes if cache_max_bytes is
+    given), entries expire after cache_ttl seconds (if given), and it is emptied when the index registry loads a new
+    index generation.
+
+    The 'hybrid' algorithm runs a lexical (BM25, OR query) and a dense (w2v by default, HYBRID_DENSE) search at the
+    same time in a thread pool and merges their HYBRID_DEPTH best products with reciprocal rank fusion, so its
+    latency is close to the slower branch instead of the sum of both. A branch that takes longer than hybrid_timeout
+    seconds (or fails, e.g. no dense vectors) is left out of the fusion; such partial results are not cached.
+    A branch that timed out keeps running in the pool, so the runs in flight are tracked: a query whose branch is
+    still running for the same query waits for that run instead of submitting another one, a run still queued when
+    its query times out is cancelled, and a branch with hybrid_in_flight runs still going after their query timed out
+    (half the pool by default) is left out of the next queries until one of them ends, so it cannot fill the pool.
+
+    The facets of the whole result set are counted (see FilterIndex.facet_counts) when the corpus
+    store is loaded, and cached the same way (without k: they don't depend on the page).
+    """
+
+    def __init__(self, cache_entries=1000, cache_max_bytes=None, cache_ttl=None, hybrid_timeout=None, hybrid_workers=None,
+                 hybrid_in_flight=None):
+        self.cache = LRUCache(max_entries=cache_entries, max_bytes=cache_max_bytes, ttl=cache_ttl, sizeof=_results_size)
+        self.facet_cache = LRUCache(max_entries=cache_entries, ttl=cache_ttl)
+        self.cache_generation = None
+        self.deepened = 0  # cached rankings that were not deep enough for the requested page
+        self.hybrid_timeout = hybrid_timeout if hybrid_timeout is not None else float(os.getenv("HYBRID_TIMEOUT", 1.0))
+        workers = hybrid_workers or int(os.getenv("HYBRID_WORKERS", 4))
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hybrid")
+        self.hybrid_in_flight = hybrid_in_flight or max(1, workers // len(HYBRID_BRANCHES))
+        self.hybrid_running = {}  # (branch, query key) -> future of the run of the branch in flight
+        self.hybrid_overdue = set()  # (branch, query key) of the runs still going after their query timed out
+        self.hybrid_lock = threading.Lock()
+        # branches left out of the fusion: too slow, failed, or not submitted (hybrid_in_flight overdue runs)
+        self.hybrid_timeouts = {branch: 0 for branch in HYBRID_BRANCHES}
+        self.hybrid_failures = {branch: 0 for branch in HYBRID_BRANCHES}
+        self.hybrid_skipped = {branch: 0 for branch in HYBRID_BRANCHES}
+
+    def ranked_results(self, algorithm, terms, k=None, phrases=(), filters=None):
+        """
+        Return the (pid, score) pairs (at least the k best ones, all of them if k is None) and the number of hits of
+        an analysed query, from the cache when it was already ranked at least that deep.
+        """
+        if not REGISTRY.ready:
+            REGISTRY.load()
+        if REGISTRY.generation != self.cache_generation:
+            # results computed on a previous index are no longer valid
+            self.cache.clear()
+            self.facet_cache.clear()
+            self.cache_generation = REGISTRY.generation
+
+        if algorithm == 'hybrid':
+            k = None  # the fused results don't depend on k: every page shares them
+        # scores don't depend on the order of the terms (repeated terms do count)
+        key = (algorithm, tuple(sorted(terms)), tuple(phrases), filters_key(filters), REGISTRY.generation)
+        cached = self.cache.get(key)
+        served = None
+        if cached is not None:
+            scores, total_hits, depth = cached
+            # depth None: every result is ranked; fewer results than the depth: there are no more
+            if depth is None or len(scores) < depth or (k is not None and k <= depth):
+                return scores, total_hits
+            self.deepened += 1
+            served = scores
+
+        complete = True
+        if algorithm == 'hybrid':
+            scores, complete = self.hybrid_results(terms, phrases, filters)
+            total_hits = len(scores)
+        else:
+            _, scores, total_hits = search_terms(algorithm, terms, k, phrases, filters)
+            if served is not None:
+                # a cascade ('our-score', 'bm25-prox') ranked deeper re-ranks more first-stage candidates, which can
+                # move some of them above products already served: these keep their ranks and the new ones follow
+                seen = {pid for pid, _ in served}
+                scores = served + [pair for pair in scores if pair[0] not in seen]
+        if complete:
+            self.cache.put(key, (scores, total_hits, k))
+        return scores, total_hits
+
+    def hybrid_results(self, terms, phrases=(), filters=None):
+        """
+        Return the fused (pid, score) pairs of the 'hybrid' algorithm (the union of the HYBRID_DEPTH best products of
+        each branch) and whether every branch answered in time.
+        """
+        deadline = time.monotonic() + self.hybrid_timeout
+        key = (tuple(sorted(terms)), tuple(phrases), filters_key(filters), REGISTRY.generation)
+        futures = {branch: self._submit_branch(branch, key, terms, phrases, filters) for branch in HYBRID_BRANCHES}
+        rankings = []
+        for branch, future in futures.items():
+            if future is None:
+                print("Hybrid search: {} has {} runs past the timeout, left out".format(branch, self.hybrid_in_flight))
+                self.hybrid_skipped[branch] += 1
+                continue
+            try:
+                ranked_pids, _, _ = future.result(timeout=max(deadline - time.monotonic(), 0))
+                rankings.append(ranked_pids)
+            except TimeoutError:
+                if not future.cancel():  # a run that has not started yet is cancelled, a running one is overdue
+                    with self.hybrid_lock:
+                        if self.hybrid_running.get((branch, key)) is future:
+                            self.hybrid_overdue.add((branch, key))
+                print("Hybrid search: {} took more than {} s, left out".format(branch, self.hybrid_timeout))
+                self.hybrid_timeouts[branch] += 1
+            except Exception as e:
+                print("Hybrid search: {} failed, left out: {}".format(branch, e))
+                self.hybrid_failures[branch] += 1
+        return reciprocal_rank_fusion(rankings), len(rankings) == len(futures)
+
+    def _submit_branch(self, branch, key, terms, phrases, filters):
+        """
+        Return the future of a branch for a query: the run in flight for the same query if there is one, else a new
+        run, or None if the branch already has hybrid_in_flight overdue runs.
+        """
+        with self.hybrid_lock:
+            future = self.hybrid_running.get((branch, key))
+            if future is not None:
+                return future
+            if sum(1 for overdue, _ in self.hybrid_overdue if overdue == branch) >= self.hybrid_in_flight:
+                return None
+            future = self.executor.submit(search_terms, branch, terms, HYBRID_DEPTH, phrases, filters)
+            self.hybrid_running[(branch, key)] = future
+        # outside the lock: the callback runs right away (and takes the lock) if the run is already over
+        future.add_done_callback(lambda done: self._branch_done(branch, key, done))
+        return future
+
+    def _branch_done(self, branch, key, future):
+        with self.hybrid_lock:
+            if self.hybrid_running.get((branch, key)) is future:
+                del self.hybrid_running[(branch, key)]
+                self.hybrid_overdue.discard((branch, key))
+
+    def stats(self):
+        """Query cache counters, hybrid branches left out and hybrid runs in flight / overdue (for /healthz)."""
+        stats = self.cache.stats()
+        # a cached ranking that had to be ranked deeper was found, but did not answer the request
+        stats["hits"] -= self.deepened
+        stats["misses"] += self.deepened
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["deepened"] = self.deepened
+        stats["hybrid_timeouts"] = dict(self.hybrid_timeouts)
+        stats["hybrid_failures"] = dict(self.hybrid_failures)
+        stats["hybrid_skipped"] = dict(self.hybrid_skipped)
+        with self.hybrid_lock:
+            stats["hybrid_in_flight"] = {branch: sum(1 for running, _ in self.hybrid_running if running == branch)
+                                         for branch in HYBRID_BRANCHES}
+            stats["hybrid_overdue"] = {branch: sum(1 for overdue, _ in self.hybrid_overdue if overdue == branch)
+                                       for branch in HYBRID_BRANCHES}
+        return stats
+
+    def facets(self, algorithm, terms, phrases=(), filters=None):
+        """
+        Return the facet counts of all the results of an analysed query (empty without a corpus store). For 'hybrid',
+        the results are the fused products: a search filtered on a value takes the best products of each branch among
+        that value only, so it can find more of them than the facet counted. The same goes for the dense algorithms,
+        whose filtered searches probe more lists (see IVFIndex.search).
+        """
+        if REGISTRY.filters is None:
+            return {}
+        key = (algorithm, tuple(sorted(terms)), tuple(phrases), filters_key(filters), REGISTRY.generation)
+        facets = self.facet_cache.get(key)
+        if facets is None:
+            if algorithm == 'hybrid':
+                # the results are the fused products (cached by ranked_results), found in the part that holds them
+                scores, _ = self.ranked_results(algorithm, terms, None, phrases, filters)
+                pids = np.array([pid.encode() for pid, _ in scores], dtype="S")
+                masks = []
+                for part in REGISTRY.parts:
+                    mask = np.zeros(len(part.corpus), dtype=bool)
+                    mask[part.corpus.rows(pids)] = True
+                    masks.append((part, mask & part.live if part.live is not None else mask))
+            else:
+                masks = result_masks(algorithm, terms, phrases, filters)
+            # counted on the base index and on every segment, then added up
+            facets = merge_facets(part.filters.facet_counts(mask, size=None) for part, mask in masks)
+            self.facet_cache.put(key, facets)
+        return facets
 
-    def search(self, algorithm, search_query, search_id, corpus):
+    def search(self, algorithm, search_query, search_id, corpus, page=1, page_size=20, filters=None):
+        """
+        Return the requested page (numbered from 1) of the results as a ResultPage, restricted to the products
+        matching the filters, if given (see filters.py)
+        """
         print("Search query:", search_query)
 
-        results = []
         ### You should implement your search logic here:
-        results = algorithm_search(algorithm, search_query, search_id, corpus)
+        # so that stemmed terms are matched in the index (and in the cache)
+        terms, phrases = parse_query(search_query)
+        # only rank as deep as the end of the requested page
+        scores, total_hits = self.ranked_results(algorithm, terms, k=page * page_size, phrases=phrases, filters=filters)
+        start = (page - 1) * page_size
+        results = _result_items(scores[start:start + page_size], search_id, corpus)
+        facets = self.facets(algorithm, terms, phrases, filters)
 
-        # results = search_in_corpus(search_query)
-        return results
+        return ResultPage(results=results, page=page, page_size=page_size, total_hits=total_hits, facets=facets)
@@ -0,0 +1,199 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+from .algorithms import index_documents
+from .compact_index import CompactIndex
+from .corpus_store import CorpusStore
+from .index_file import write_index_file
+from .rankers import BM25Ranker, TfidfRanker
+from .registry import save_indexes
+
+
+class IndexWriter:
+    """
+    Incremental updates of the index served by an IndexRegistry, without rebuilding it from the products file.
+
+    add / update / delete write a small segment file in the segments directory of the registry: the compact index and
+    the corpus store columns of the added (or updated) products, and the tombstones, i.e. the pids whose previous version
+    is removed (the deleted products, and the updated ones, whose new version is in the segment). Nothing is
+    re-tokenised except the products of the segment. The registry opens the segment right away and searches it together
+    with the base index, the tombstones hiding the previous versions at query time (see IndexRegistry), so a change only
+    costs the indexing of its own products and is searchable as soon as the call returns. The other server processes
+    open it on their next IndexRegistry.refresh().
+
+    Every segment is one more part to search for every query, and the products it replaces stay in the base index,
+    hidden, so the segments are merged by a size policy, applied by the background thread started by start() shortly
+    after the changes (maybe_merge):
+
+    - when there are more than max_segments segments, the merge_factor adjacent ones with the fewest products (plus
+      tombstones) are merged into one segment (merge_segments). This costs the size of these segments, not of the
+      corpus, and a merged segment is larger, so it is rarely picked again: segments form tiers of similar sizes;
+    - when the segments hold more than merge_ratio times the products of the base index (with the base products they
+      hide), they are merged into the base index (merge): df, idf and L_ave are recomputed on the merged postings, the
+      TF-IDF and BM25 statistics from them, and the new index and corpus files replace the old ones atomically before
+      the registry loads them. This costs O(corpus), since it writes the whole files again and every server process then
+      loads them and rebuilds what it derives from them (filters, re-ranking features, autocomplete vocabulary), so it
+      only happens once a fraction of the corpus has changed.
+
+    Queries keep being answered from the previous parts until a merge is loaded, so there is no downtime. Only adjacent
+    segments are merged, so the tombstones of a segment keep applying to the older ones only. Segments left by a
+    previous run are opened with the index and go through the same policy. Applying a segment twice gives the same
+    result, so a merge interrupted after writing its files is safe to redo.
+    """
+
+    def __init__(self, registry, max_segments=8, merge_factor=4, merge_ratio=0.1, merge_delay=1.0, poll_interval=5.0):
+        self.registry = registry
+        self.max_segments = max_segments
+        self.merge_factor = merge_factor  # number of adjacent segments merged together
+        self.merge_ratio = merge_ratio  # products of the segments (and hidden by them) / products of the base index
+        self.merge_delay = merge_delay  # seconds to wait for more changes before applying the merge policy
+        self.poll_interval = poll_interval  # seconds between checks for segments written by other processes
+        self.merges = 0
+        self.segment_merges = 0
+        self.last_merge_ms = None
+        self._merge_lock = threading.Lock()
+        self._changed = threading.Event()
+        self._thread = None
+        os.makedirs(self.registry.segments_dir, exist_ok=True)
+
+    # --- updates ---
+
+    def add(self, documents):
+        """Add (or replace) products, given as Document objects. Returns the path of the segment written."""
+        documents = list(documents)
+        return self._write_segment(documents, [doc.pid for doc in documents])
+
+    def update(self, documents):
+        """Replace the products with the pids of the given Documents by these new versions."""
+        return self.add(documents)
+
+    def delete(self, pids):
+        """Delete the products with the given pids."""
+        return self._write_segment([], list(pids))
+
+    def _write_segment(self, documents, tombstones):
+        if not self.registry.ready:
+            self.registry.load()
+        # a segment indexes positions exactly when the base index does, so phrases match in every part
+        index = index_documents(documents, positions=self.registry.index.has_positions)
+        # named by creation time (and process, since several server processes can write segments) so they sort in order
+        path = os.path.join(self.registry.segments_dir, "segment_{:020d}_{}.bin".format(time.time_ns(), os.getpid()))
+        _save_segment(path, index, CorpusStore.from_documents(documents), np.array([pid.encode() for pid in tombstones], dtype="S"))
+        self.registry.load_segments()
+        self._changed.set()
+        return path
+
+    def segments(self):
+        """Return the paths of the segments not merged into the base index yet, oldest first."""
+        return self.registry.segment_paths()
+
+    # --- merging ---
+
+    def maybe_merge(self):
+        """Apply the merge policy to the segments being searched. Returns the number of segments merged."""
+        if not self.registry.ready:
+            self.registry.load()
+        parts = self.registry.parts
+        base, segments = parts[0], parts[1:]
+        changed = sum(part.index.num_docs for part in segments) + base.index.num_docs - base.num_live
+        if segments and changed > self.merge_ratio * base.index.num_docs:
+            return self.merge()
+        if len(segments) > self.max_segments:
+            sizes = [part.index.num_docs + len(part.tombstones) for part in segments]
+            count = min(self.merge_factor, len(segments))
+            first = min(range(len(segments) - count + 1), key=lambda i: sum(sizes[i:i + count]))
+            return self.merge_segments([part.path for part in segments[first:first + count]])
+        return 0
+
+    def merge_segments(self, paths):
+        """
+        Merge adjacent segments (paths, oldest first) into one segment, written in place of the newest of them, and
+        open it. Their products hidden by tombstones are dropped and their tombstones are kept for the older parts.
+        Returns the number of segments merged.
+        """
+        with self._merge_lock:
+            self.registry.load_segments()
+            parts = [part for part in self.registry.parts[1:] if part.path in paths]
+            if len(parts) < 2:
+                return 0
+            start = time.perf_counter()
+            index = CompactIndex.merge([_live(part.index, part) for part in parts])
+            corpus = CorpusStore.concat([_live(part.corpus, part) for part in parts])
+            tombstones = np.unique(np.concatenate([part.tombstones for part in parts]))
+            # the newest segment is replaced last: until then, the products of the older ones are hidden by its tombstones
+            _save_segment(parts[-1].path, index, corpus, tombstones)
+            for part in parts[:-1]:
+                os.remove(part.path)
+            self.registry.load_segments()
+
+            self.segment_merges += 1
+            self.last_merge_ms = (time.perf_counter() - start) * 1000
+            print("Merged {} segments into one in {:.1f} ms ({} products).".format(len(parts), self.last_merge_ms, index.num_docs))
+            return len(parts)
+
+    def merge(self):
+        """Merge all the segments into the index and corpus files and load the result. Returns the number merged."""
+        with self._merge_lock:
+            if not self.registry.ready:
+                self.registry.load()
+            self.registry.load_segments()  # with the segments written by other processes
+            parts = self.registry.parts
+            if len(parts) == 1:
+                return 0
+            start = time.perf_counter()
+            # every part without the products tombstoned by the segments written after it
+            index = CompactIndex.merge([_live(part.index, part) for part in parts])  # df, idf and L_ave of the merged postings
+            corpus = CorpusStore.concat([_live(part.corpus, part) for part in parts])
+
+            bm25 = self.registry.ranker("bm25")
+            rankers = {"tfidf": TfidfRanker(index), "bm25": BM25Ranker(index, k1=bm25.k1, b=bm25.b)}
+            # the corpus first: other processes reload when the index file changes (see IndexRegistry.refresh)
+            corpus.save(self.registry.corpus_path)
+            save_indexes(self.registry.path, index, rankers)
+            for part in parts[1:]:
+                os.remove(part.path)
+            self.registry.load()
+
+            self.merges += 1
+            self.last_merge_ms = (time.perf_counter() - start) * 1000
+            print("Merged {} segments into the index in {:.1f} ms ({} products).".format(len(parts) - 1, self.last_merge_ms, index.num_docs))
+            return len(parts) - 1
+
+    def start(self):
+        """Apply the merge policy to the segments left from a previous run and start applying it in a background thread."""
+        self.maybe_merge()
+        self._thread = threading.Thread(target=self._merge_loop, name="index-merger", daemon=True)
+        self._thread.start()
+
+    def _merge_loop(self):
+        while True:
+            # segments can also be written by other processes (the workers of a multi-process server)
+            if self._changed.wait(self.poll_interval):
+                time.sleep(self.merge_delay)  # group the changes that arrive close together
+                self._changed.clear()
+            try:
+                self.registry.refresh()
+                while self.maybe_merge():
+                    pass
+            except Exception as e:
+                print("Error merging index segments:", e)
+
+    def status(self):
+        return {"pending_segments": len(self.registry.parts) - 1, "merges": self.merges, "segment_merges": self.segment_merges,
+                "last_merge_ms": round(self.last_merge_ms, 3) if self.last_merge_ms is not None else None}
+
+
+def _live(data, part):
+    """The index or corpus store of a part without the products hidden by tombstones."""
+    return data if part.live is None else data.select(part.live)
+
+
+def _save_segment(path, index, corpus, tombstones):
+    """Write a segment: its compact index, its corpus store columns and its tombstones (pids, bytes)."""
+    arrays = {f"index_{name}": array for name, array in index.arrays().items()}
+    arrays.update({f"corpus_{name}": array for name, array in corpus.arrays.items()})
+    arrays["tombstones"] = tombstones
+    write_index_file(path, arrays, {"added": index.num_docs, "tombstones": len(tombstones)})
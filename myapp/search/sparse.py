@@ -0,0 +1,59 @@
+import numpy as np
+
+
+class SparseMatrix:
+    """
+    Minimal NumPy-only CSC (compressed sparse column) matrix.
+
+    Column j holds the non-zero entries indices[indptr[j]:indptr[j + 1]] (row numbers, sorted) with values
+    data[indptr[j]:indptr[j + 1]]. In the search engine the rows are products and the columns are terms, which is
+    exactly the layout of the posting lists of the compact index, so the index arrays are shared, not copied.
+    """
+
+    def __init__(self, indptr, indices, data, shape):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.shape = shape
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
+
+    def column(self, j):
+        """Return the (row numbers, values) of the non-zero entries of column j."""
+        start, end = self.indptr[j], self.indptr[j + 1]
+        return self.indices[start:end], self.data[start:end]
+
+    def _gather(self, columns):
+        """
+        Return the row numbers and values of the non-zero entries of several columns, and for every entry the position
+        (in `columns`) of the column it comes from.
+        """
+        columns = np.asarray(columns, dtype=np.int64)
+        starts, ends = self.indptr[columns], self.indptr[columns + 1]
+        lengths = ends - starts
+        owner = np.repeat(np.arange(len(columns)), lengths)
+        # position of every entry inside the data/indices arrays: start of its column + offset inside the column
+        entry = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+        return self.indices[entry], self.data[entry], owner
+
+    def matvec(self, columns, values):
+        """
+        Multiply the matrix by a sparse vector given by its non-zero (columns, values) and return a dense vector.
+        """
+        rows, data, owner = self._gather(columns)
+        return np.bincount(rows, weights=data * np.asarray(values)[owner], minlength=self.shape[0])
+
+    def matmat(self, columns, values):
+        """
+        Multiply the matrix by a sparse matrix with few non-zero rows: `columns` are the non-zero rows of the right hand
+        matrix and `values` its (len(columns) x n) dense block. Return the dense (shape[0] x n) product.
+        The columns used by any query of the batch are gathered only once.
+        """
+        values = np.asarray(values)
+        rows, data, owner = self._gather(columns)
+        result = np.empty((self.shape[0], values.shape[1]))
+        for j in range(values.shape[1]):
+            result[:, j] = np.bincount(rows, weights=data * values[owner, j], minlength=self.shape[0])
+        return result
@@ -0,0 +1,61 @@
+"""
+Variable byte (varbyte) coding of non-negative integers, vectorised with NumPy.
+
+Every integer is written in groups of 7 bits, least significant group first, one group per byte; the high bit of a
+byte is set when more bytes of the same integer follow. Small integers (e.g. the gaps between sorted positions or
+doc ids) take a single byte.
+"""
+
+import numpy as np
+
+MAX_BYTES = 10  # enough for any 64 bit integer
+
+
+def byte_lengths(values):
+    """Return the number of bytes of the varbyte code of every value."""
+    values = np.asarray(values, dtype=np.int64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for j in range(1, MAX_BYTES):
+        lengths += values >= (1 << (7 * j))
+    return lengths
+
+
+def encode(values):
+    """Return the varbyte code (uint8 array) of an array of non-negative integers, one after the other."""
+    values = np.asarray(values, dtype=np.int64)
+    lengths = byte_lengths(values)
+    starts = np.cumsum(lengths) - lengths
+    data = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for j in range(int(lengths.max()) if len(values) else 0):
+        has_byte = lengths > j
+        group = (values[has_byte] >> (7 * j)) & 127
+        more = lengths[has_byte] > j + 1
+        data[starts[has_byte] + j] = group | (more << 7)
+    return data
+
+
+def decode(data):
+    """Return the integers (int64 array) of a sequence of varbyte codes."""
+    data = np.asarray(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+    last_bytes = np.flatnonzero(data < 128)  # last byte of every integer
+    starts = np.concatenate(([0], last_bytes[:-1] + 1))
+    lengths = last_bytes + 1 - starts
+    byte_in_value = np.arange(len(data)) - np.repeat(starts, lengths)
+    groups = (data & 127).astype(np.int64) << (7 * byte_in_value)
+    return np.add.reduceat(groups, starts)
+
+
+def gather_ranges(data, starts, lengths):
+    """
+    Return the concatenation of the slices data[start:start + length] (as one array) and the offsets of the slices
+    in it, without a Python loop.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    # position of every element to keep: start of its slice + offset inside the slice
+    positions = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths) + np.repeat(starts, lengths)
+    return data[positions], offsets
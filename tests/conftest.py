@@ -0,0 +1,85 @@
+import math
+import random
+from collections import Counter
+
+import pytest
+
+from myapp.search.compact_index import FIELD_GAP, CompactIndex
+
+# a few very common terms and a long tail of rare ones, like product titles
+WORDS = ["shirt", "cotton", "men", "women", "black", "slim", "fit", "jean", "round", "neck", "blue", "print", "solid",
+         "casual", "regular", "sleev", "polo", "stretch", "denim", "white"]
+WEIGHTS = [40, 25, 20, 20, 15, 10, 10, 8, 6, 6, 5, 4, 3, 3, 2, 2, 1, 1, 1, 1]
+
+
+def random_documents(num_docs=300, seed=0, prefix="P"):
+    """(pid, (title terms, description terms)) pairs of a random corpus of analysed products."""
+    rng = random.Random(seed)
+    documents = []
+    for i in range(num_docs):
+        title = rng.choices(WORDS, WEIGHTS, k=rng.randint(1, 6))
+        description = rng.choices(WORDS, WEIGHTS, k=rng.randint(0, 20))
+        documents.append(("{}{:06d}".format(prefix, i), (title, description)))
+    return documents
+
+
+class DictIndex:
+    """
+    Reference for the compact index and the rankers: the dict-based inverted index the search started from
+    (term -> {pid: positions}) and the TF-IDF and BM25 scores computed from it one query term occurrence at a time.
+    """
+
+    def __init__(self, documents):
+        self.pids = [pid for pid, _ in documents]
+        self.postings = {}
+        self.doc_len = {}
+        self.doc_norm = {}
+        for pid, fields in documents:
+            start = 0
+            for field in fields:
+                for position, term in enumerate(field, start):
+                    self.postings.setdefault(term, {}).setdefault(pid, []).append(position)
+                start += len(field) + FIELD_GAP
+            terms = [term for field in fields for term in field]
+            self.doc_len[pid] = len(terms)
+            self.doc_norm[pid] = math.sqrt(sum(count ** 2 for count in Counter(terms).values()))
+        self.idf = {term: round(math.log(len(self.pids) / len(postings)), 4) for term, postings in self.postings.items()}
+        self.L_ave = sum(self.doc_len.values()) / len(self.pids)
+
+    def tf(self, term, pid):
+        return len(self.postings.get(term, {}).get(pid, []))
+
+    def bm25(self, terms, k1=1.2, b=0.75):
+        scores = {}
+        for term in terms:
+            for pid, positions in self.postings.get(term, {}).items():
+                tf = len(positions)
+                length_norm = k1 * ((1 - b) + b * self.doc_len[pid] / self.L_ave)
+                scores[pid] = scores.get(pid, 0.0) + self.idf[term] * (k1 + 1) * tf / (length_norm + tf)
+        return scores
+
+    def tfidf(self, terms):
+        counts = Counter(terms)
+        query_norm = math.sqrt(sum(count ** 2 for count in counts.values()))
+        scores = {}
+        for term in terms:
+            query_weight = counts[term] / query_norm * self.idf.get(term, 0.0)
+            for pid, positions in self.postings.get(term, {}).items():
+                weight = round(len(positions) / self.doc_norm[pid], 4) * self.idf[term]
+                scores[pid] = scores.get(pid, 0.0) + query_weight * weight
+        return scores
+
+
+@pytest.fixture(scope="session")
+def documents():
+    return random_documents()
+
+
+@pytest.fixture(scope="session")
+def reference(documents):
+    return DictIndex(documents)
+
+
+@pytest.fixture(scope="session")
+def index(documents):
+    return CompactIndex.from_documents(documents, positions=True)
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from myapp.search import varbyte
+from myapp.search.compact_index import CompactIndex
+from myapp.search.positions import document_terms, term_positions
+
+from .conftest import random_documents
+
+
+def _assert_same_index(index, expected):
+    for name, array in expected.arrays().items():
+        np.testing.assert_array_equal(index.arrays()[name], array, err_msg=name)
+    assert index.L_ave == pytest.approx(expected.L_ave)
+
+
+def test_postings_match_dict_index(index, reference):
+    assert index.terms.astype(str).tolist() == sorted(reference.postings)
+    assert index.pids.astype(str).tolist() == reference.pids
+    for term, postings in reference.postings.items():
+        term_id = index.term_id(term)
+        doc_ids, freqs = index.postings(term_id)
+        assert [index.pid(doc_id) for doc_id in doc_ids] == sorted(postings, key=reference.pids.index)
+        assert freqs.tolist() == [len(postings[index.pid(doc_id)]) for doc_id in doc_ids]
+        assert index.df[term_id] == len(postings)
+        assert index.idf[term_id] == reference.idf[term]
+    assert index.term_id("unknown") is None
+    assert index.doc_len.tolist() == [reference.doc_len[pid] for pid in reference.pids]
+    np.testing.assert_allclose(index.doc_norm, [reference.doc_norm[pid] for pid in reference.pids], rtol=1e-6)
+    assert index.L_ave == pytest.approx(reference.L_ave)
+
+
+def test_positions_match_dict_index(index, reference):
+    for term, postings in reference.postings.items():
+        term_id = index.term_id(term)
+        doc_ids = np.arange(index.num_docs, dtype=np.int32)
+        owner, positions = term_positions(index, term_id, doc_ids)
+        decoded = {}
+        for doc_id, position in zip(owner.tolist(), positions.tolist()):
+            decoded.setdefault(index.pid(doc_id), []).append(position)
+        assert decoded == postings
+
+
+def test_document_terms_rebuild_the_products(documents, index):
+    term_ids, offsets = document_terms(index)
+    for doc_id, (_, fields) in enumerate(documents):
+        terms = index.terms[term_ids[offsets[doc_id]:offsets[doc_id + 1]]].astype(str).tolist()
+        assert terms == [term for field in fields for term in field]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 100])
+def test_merge_of_chunks_equals_full_build(documents, index, chunk_size):
+    parts = [CompactIndex.from_documents(documents[start:start + chunk_size], positions=True)
+             for start in range(0, len(documents), chunk_size)]
+    _assert_same_index(CompactIndex.merge(parts), index)
+
+
+def test_select_equals_build_of_kept_products(documents, index):
+    keep = np.random.default_rng(0).random(len(documents)) < 0.7
+    expected = CompactIndex.from_documents([doc for doc, kept in zip(documents, keep) if kept], positions=True)
+    _assert_same_index(index.select(keep), expected)
+
+
+def test_merge_after_select_equals_rebuild(documents):
+    # what a merge of incremental updates does: the base without the replaced products, then the new ones
+    base, updates = documents, random_documents(50, seed=1, prefix="Q") + random_documents(20, seed=2)[:10]
+    replaced = {pid for pid, _ in updates}
+    keep = np.array([pid not in replaced for pid, _ in base])
+    merged = CompactIndex.merge([CompactIndex.from_documents(base, positions=True).select(keep),
+                                 CompactIndex.from_documents(updates, positions=True)])
+    expected = CompactIndex.from_documents([doc for doc in base if doc[0] not in replaced] + updates, positions=True)
+    _assert_same_index(merged, expected)
+
+
+def test_varbyte_round_trip():
+    rng = np.random.default_rng(0)
+    values = np.concatenate([[0, 1, 127, 128, 16383, 16384, 2 ** 21, 2 ** 35, 2 ** 62 - 1],
+                             rng.integers(0, 300, 1000), rng.integers(0, 2 ** 40, 100)])
+    data = varbyte.encode(values)
+    assert len(data) == varbyte.byte_lengths(values).sum()
+    np.testing.assert_array_equal(varbyte.decode(data), values)
+    assert varbyte.encode([]).tolist() == [] and varbyte.decode([]).tolist() == []
+
+
+def test_gather_ranges():
+    data = np.arange(100)
+    starts, lengths = [5, 50, 0, 99], [3, 0, 2, 1]
+    gathered, offsets = varbyte.gather_ranges(data, starts, lengths)
+    assert gathered.tolist() == [5, 6, 7, 0, 1, 99]
+    assert offsets.tolist() == [0, 3, 3, 5, 6]
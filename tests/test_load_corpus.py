@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from myapp.search import load_corpus
+from myapp.search.load_corpus import iter_documents, iter_products
+
+
+def _product(pid, title):
+    return {"pid": pid, "title": title, "description": "a product", "selling_price": "1,299", "discount": "10% off"}
+
+
+PRODUCTS = [_product("P1", "first"), _product("P2", "second"), _product("P1", "first again"), _product("P3", "third"),
+            _product("P2", "second again"), _product("P1", "first last")]
+
+
+def _write(path, products, jsonl):
+    with open(path, "w", encoding="utf-8") as f:
+        if jsonl:
+            f.writelines(json.dumps(product) + "\n" for product in products)
+        else:
+            json.dump(products, f)
+    return str(path)
+
+
+@pytest.mark.parametrize("jsonl", [False, True])
+def test_iter_products_small_blocks(tmp_path, monkeypatch, jsonl):
+    # products spanning several blocks are parsed like a whole-file json.load
+    monkeypatch.setattr(load_corpus, "READ_BLOCK_SIZE", 7)
+    path = _write(tmp_path / "products", PRODUCTS, jsonl)
+    assert list(iter_products(path)) == PRODUCTS
+
+
+@pytest.mark.parametrize("jsonl", [False, True])
+def test_duplicate_pids_keep_last_occurrence(tmp_path, jsonl):
+    path = _write(tmp_path / "products", PRODUCTS, jsonl)
+    documents = [doc for chunk in iter_documents(path, chunk_size=2, progress=False) for doc in chunk]
+    # each pid once, at the position of its last occurrence, with its content
+    assert [(doc.pid, doc.title) for doc in documents] == [("P3", "third"), ("P2", "second again"), ("P1", "first last")]
+    assert documents[1].selling_price == 1299.0
+
+
+def test_empty_array(tmp_path):
+    path = _write(tmp_path / "products", [], jsonl=False)
+    assert list(iter_documents(path, progress=False)) == []
+
+
+def test_truncated_file_raises_with_offset(tmp_path):
+    text = json.dumps(PRODUCTS)
+    cut = text.index('{"pid": "P3"') + 10
+    path = tmp_path / "products.json"
+    path.write_text(text[:cut], encoding="utf-8")
+    with pytest.raises(json.JSONDecodeError, match="product at character {} ".format(text.index('{"pid": "P3"'))):
+        list(iter_products(str(path)))
+
+
+def test_malformed_product_does_not_read_the_rest_of_the_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(load_corpus, "READ_BLOCK_SIZE", 64)
+    monkeypatch.setattr(load_corpus, "MAX_PRODUCT_SIZE", 256)
+    reads = []
+    read_more = load_corpus._read_more
+
+    def counting_read_more(f, buffer, position):
+        reads.append(len(buffer) - position)
+        return read_more(f, buffer, position)
+
+    monkeypatch.setattr(load_corpus, "_read_more", counting_read_more)
+    lines = [json.dumps(_product("P0", "fine")), '{"pid": "P1", "title": oops}'] + \
+            [json.dumps(_product("P{}".format(i), "x" * 50)) for i in range(2, 2000)]
+    path = tmp_path / "products.jsonl"
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    with pytest.raises(json.JSONDecodeError, match="product at character {} ".format(len(lines[0]) + 1)):
+        list(iter_products(str(path)))
+    # gave up after about MAX_PRODUCT_SIZE characters, not at the end of the (~150 KB) file
+    assert max(reads) <= 256 + 64
@@ -0,0 +1,67 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from myapp.search.compact_index import CompactIndex
+from myapp.search.positions import match_phrases, proximity_scores
+
+PHRASES = [["cotton", "shirt"], ["slim", "fit"], ["shirt", "shirt"], ["round", "neck", "shirt"], ["black", "women", "polo"],
+           ["white", "denim"]]
+
+
+def _brute_force(reference, terms, slop):
+    """pids of the products where the terms appear in order (slop 0) or all within len(terms) + slop positions."""
+    matches = []
+    for pid in reference.pids:
+        positions = [reference.postings.get(term, {}).get(pid, []) for term in terms]
+        if slop == 0:
+            if any(all(start + i in positions[i] for i in range(len(terms))) for start in positions[0]):
+                matches.append(pid)
+        else:
+            distinct = [reference.postings.get(term, {}).get(pid, []) for term in dict.fromkeys(terms)]
+            if any(max(window) - min(window) <= len(terms) + slop - 1 for window in itertools.product(*distinct)):
+                matches.append(pid)
+    return matches
+
+
+@pytest.mark.parametrize("terms", PHRASES)
+@pytest.mark.parametrize("slop", [0, 1, 3])
+def test_match_phrases_equals_brute_force(index, reference, terms, slop):
+    term_ids = [index.term_id(term) for term in terms]
+    matches = match_phrases(index, [(term_ids, slop)])
+    assert [index.pid(doc_id) for doc_id in matches] == _brute_force(reference, terms, slop)
+
+
+def test_match_phrases_within_candidates(index, reference):
+    candidates = np.flatnonzero(np.random.default_rng(0).random(index.num_docs) < 0.5).astype(np.int32)
+    phrases = [([index.term_id(term) for term in ["cotton", "shirt"]], 0), ([index.term_id(term) for term in ["men", "black"]], 2)]
+    expected = set(_brute_force(reference, ["cotton", "shirt"], 0)) & set(_brute_force(reference, ["men", "black"], 2))
+    expected &= {index.pid(doc_id) for doc_id in candidates}
+    assert [index.pid(doc_id) for doc_id in match_phrases(index, phrases, candidates)] == sorted(expected, key=reference.pids.index)
+
+
+def test_phrases_do_not_span_fields():
+    index = CompactIndex.from_documents([("A", (["blue", "shirt"], [])), ("B", (["blue"], ["shirt"]))], positions=True)
+    phrase = [([index.term_id("blue"), index.term_id("shirt")], 0)]
+    assert [index.pid(doc_id) for doc_id in match_phrases(index, phrase)] == ["A"]
+    assert [index.pid(doc_id) for doc_id in match_phrases(index, [(phrase[0][0], 5)])] == ["A"]
+
+
+def test_unknown_term_matches_nothing(index):
+    assert match_phrases(index, [([index.term_id("shirt"), None], 0)]).tolist() == []
+
+
+def test_proximity_scores_equal_brute_force(index, reference):
+    terms = ["cotton", "shirt", "slim"]
+    term_weights = [(index.term_id(term), index.idf[index.term_id(term)]) for term in terms]
+    doc_ids = np.arange(index.num_docs, dtype=np.int32)
+    scores = proximity_scores(index, term_weights, doc_ids)
+    for doc_id, pid in enumerate(reference.pids):
+        expected = 0.0
+        for (a, weight_a), (b, weight_b) in itertools.combinations(zip(terms, [weight for _, weight in term_weights]), 2):
+            positions_a, positions_b = reference.postings[a].get(pid, []), reference.postings[b].get(pid, [])
+            distances = [abs(x - y) for x in positions_a for y in positions_b if x != y]
+            if distances:
+                expected += min(weight_a, weight_b) / min(distances) ** 2
+        assert scores[doc_id] == pytest.approx(expected), pid
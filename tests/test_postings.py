@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from myapp.search.postings import intersect_postings, union_size
+
+
+def _posting_lists(seed, num_lists, num_docs=2000):
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(0, num_docs, num_lists)
+    return [np.sort(rng.choice(num_docs, size, replace=False)).astype(np.int32) for size in sizes]
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("num_lists", [1, 2, 3, 5])
+def test_intersection_equals_set_intersection(seed, num_lists):
+    posting_lists = _posting_lists(seed, num_lists)
+    expected = sorted(set.intersection(*(set(postings.tolist()) for postings in posting_lists)))
+    assert intersect_postings(posting_lists).tolist() == expected
+
+
+def test_intersection_edge_cases():
+    assert intersect_postings([]).tolist() == []
+    assert intersect_postings([np.array([1, 5, 9], dtype=np.int32), np.zeros(0, dtype=np.int32)]).tolist() == []
+    # disjoint ranges are cut down before probing
+    assert intersect_postings([np.arange(0, 10, dtype=np.int32), np.arange(10, 20, dtype=np.int32)]).tolist() == []
+    assert intersect_postings([np.array([3], dtype=np.int32), np.arange(10, dtype=np.int32)]).tolist() == [3]
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_union_size_equals_set_union(seed):
+    posting_lists = _posting_lists(seed, 4)
+    mask = np.random.default_rng(seed).random(2000) < 0.5
+    union = set().union(*(set(postings.tolist()) for postings in posting_lists))
+    assert union_size(posting_lists, 2000) == len(union)
+    assert union_size(posting_lists, 2000, mask) == len([doc_id for doc_id in union if mask[doc_id]])
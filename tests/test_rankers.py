@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from myapp.search.rankers import BM25Ranker, TfidfRanker, combined_max_score, max_score, select_top_k, top_k
+
+from .conftest import WORDS
+
+QUERIES = [["shirt"], ["white"], ["cotton", "shirt"], ["slim", "fit", "jean"], ["shirt", "shirt", "polo"],
+           ["black", "women", "denim", "white", "casual"], ["unknown"], ["unknown", "polo"]]
+
+
+@pytest.fixture(scope="module")
+def rankers(index):
+    return {"bm25": BM25Ranker(index), "tfidf": TfidfRanker(index)}
+
+
+def _full_ranking(ranker, terms, mask=None):
+    """Every product containing a query term (and allowed by mask), sorted by decreasing score."""
+    scores = ranker.score(terms)
+    doc_ids = np.flatnonzero(scores > 0).astype(np.int32)
+    if mask is not None:
+        doc_ids = doc_ids[mask[doc_ids]]
+    return select_top_k(doc_ids, scores[doc_ids])
+
+
+@pytest.mark.parametrize("terms", QUERIES)
+def test_bm25_matches_dict_scores(index, reference, rankers, terms):
+    expected = reference.bm25(terms)
+    scores = rankers["bm25"].score(terms)
+    np.testing.assert_allclose(scores, [expected.get(pid, 0.0) for pid in reference.pids], rtol=1e-9)
+
+
+@pytest.mark.parametrize("terms", QUERIES)
+def test_tfidf_matches_dict_scores(index, reference, rankers, terms):
+    expected = reference.tfidf(terms)
+    scores = rankers["tfidf"].score(terms)
+    # the tf-idf weights are stored as float32
+    np.testing.assert_allclose(scores, [expected.get(pid, 0.0) for pid in reference.pids], rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("model", ["bm25", "tfidf"])
+@pytest.mark.parametrize("terms", QUERIES)
+@pytest.mark.parametrize("k", [1, 5, 20, 1000])
+@pytest.mark.parametrize("filtered", [False, True])
+def test_top_k_equals_full_ranking(index, rankers, model, terms, k, filtered):
+    ranker = rankers[model]
+    mask = np.random.default_rng(k).random(index.num_docs) < 0.3 if filtered else None
+    expected_ids, expected_scores = _full_ranking(ranker, terms, mask)
+    doc_ids, scores = select_top_k(*top_k(ranker, terms, k, mask), k)
+
+    assert len(doc_ids) == min(k, len(expected_ids))
+    np.testing.assert_allclose(scores, expected_scores[:k], rtol=1e-6)
+    # the products returned have the scores of the full ranking (ties at the k-th score may be any of the tied ones)
+    full_scores = ranker.score(terms)
+    np.testing.assert_allclose(scores, full_scores[doc_ids], rtol=1e-6)
+    if mask is not None:
+        assert mask[doc_ids].all()
+    if len(scores):
+        # above the k-th score, the same products in the same order
+        above = scores > expected_scores[len(scores) - 1] + 1e-9
+        assert doc_ids[above].tolist() == expected_ids[:k][above].tolist()
+
+
+def test_select_top_k_breaks_ties_by_doc_id():
+    doc_ids = np.arange(10, dtype=np.int32)
+    scores = np.array([1.0, 3.0, 2.0, 3.0, 1.0, 2.0, 3.0, 0.5, 2.0, 1.0])
+    for k in (None, 1, 3, 4, 6, 10, 20):
+        selected, selected_scores = select_top_k(doc_ids, scores, k)
+        expected = sorted(range(10), key=lambda doc_id: (-scores[doc_id], doc_id))[:k]
+        assert selected.tolist() == expected
+        assert selected_scores.tolist() == scores[expected].tolist()
+
+
+@pytest.mark.parametrize("model", ["bm25", "tfidf"])
+def test_max_score_bounds_every_score(index, rankers, model):
+    ranker = rankers[model]
+    for terms in QUERIES + [[word] for word in WORDS]:
+        assert ranker.score(terms).max(initial=0.0) <= max_score(ranker, terms) + 1e-9
+        assert combined_max_score([ranker], terms) == pytest.approx(max_score(ranker, terms))
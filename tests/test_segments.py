@@ -0,0 +1,154 @@
+import random
+
+import numpy as np
+import pytest
+
+from myapp.search import algorithms
+from myapp.search.algorithms import build_indexes, search_terms
+from myapp.search.corpus_store import CorpusStore
+from myapp.search.objects import Document
+from myapp.search.registry import IndexRegistry, save_indexes
+from myapp.search.segments import IndexWriter
+
+from .conftest import WEIGHTS, WORDS
+
+QUERIES = [["shirt"], ["cotton", "shirt"], ["slim", "fit"], ["white", "polo"], ["zebra"], ["zebra", "shirt"]]
+ALGORITHMS = ["tfidf", "bm25", "tfidf-or", "bm25-or", "bm25-prox", "our-score"]
+
+
+def _documents(num_docs, seed, prefix="P", extra=()):
+    rng = random.Random(seed)
+    words = WORDS + list(extra)
+    weights = WEIGHTS + [5] * len(extra)
+    return [Document(pid="{}{:06d}".format(prefix, i), title=" ".join(rng.choices(words, weights, k=rng.randint(1, 6))),
+                     description=" ".join(rng.choices(words, weights, k=rng.randint(0, 15))),
+                     brand=rng.choice(["acme", "zeta", None]), selling_price=rng.randint(100, 2000),
+                     average_rating=rng.choice([None, 2.5, 3.9, 4.4]), discount=rng.randint(0, 60))
+            for i in range(num_docs)]
+
+
+def _registry(path, documents):
+    """Build and save the index and corpus store of the documents in path, and load them in a registry."""
+    index, rankers = build_indexes(documents, workers=1, positions=True)
+    save_indexes(str(path / "index.bin"), index, rankers)
+    CorpusStore.from_documents(documents).save(str(path / "corpus.bin"))
+    registry = IndexRegistry(str(path / "index.bin"), str(path / "corpus.bin"))
+    registry.load()
+    return registry
+
+
+def _results(registry, monkeypatch):
+    monkeypatch.setattr(algorithms, "REGISTRY", registry)
+    results = {}
+    for terms in QUERIES:
+        for algorithm in ALGORITHMS:
+            _, scores, total = search_terms(algorithm, terms)
+            results[(tuple(terms), algorithm)] = scores, total
+        results[(tuple(terms), "filtered")] = search_terms("bm25-or", terms, 10, filters={"brand": ["acme"]})[1:]
+    return results
+
+
+@pytest.fixture
+def changes():
+    """The base catalogue and the batches of changes applied to it: (added or updated products, deleted pids)."""
+    base = _documents(200, seed=0)
+    batches = [(_documents(5, seed=1, prefix="N", extra=["zebra"]), []),
+               (_documents(8, seed=2), []),  # new versions of P000000..P000007
+               ([], ["P000010", "P000011", "N000001"]),
+               (_documents(3, seed=3, prefix="M"), ["P000003"])]
+    return base, batches
+
+
+def _final(base, batches):
+    """The catalogue once every change is applied, in the order a merge keeps: surviving base products, then segments."""
+    products = [[doc for doc in base]]
+    for added, deleted in batches:
+        gone = {doc.pid for doc in added} | set(deleted)
+        products = [[doc for doc in part if doc.pid not in gone] for part in products] + [list(added)]
+    return [doc for part in products for doc in part]
+
+
+def _apply(writer, batches):
+    for added, deleted in batches:
+        if added:
+            writer.add(added)
+        if deleted:
+            writer.delete(deleted)
+
+
+def test_segments_are_searched_before_any_merge(tmp_path, monkeypatch, changes):
+    base, batches = changes
+    (tmp_path / "live").mkdir()
+    (tmp_path / "rebuilt").mkdir()
+    registry = _registry(tmp_path / "live", base)
+    _apply(IndexWriter(registry, max_segments=100, merge_ratio=1.0), batches)
+    assert len(registry.parts) == 1 + len(batches) + 1  # one segment per add and per delete
+
+    final = _final(base, batches)
+    assert len(registry.documents) == len(final)
+    assert "P000010" not in registry.documents
+    assert registry.documents["P000000"].title == batches[1][0][0].title  # the updated version
+    live = _results(registry, monkeypatch)
+    rebuilt = _results(_registry(tmp_path / "rebuilt", final), monkeypatch)
+    for key, (scores, total) in rebuilt.items():
+        # the same products (scores differ: the segments are scored with the statistics of the base index)
+        assert total == live[key][1], key
+        if key[1] != "filtered":
+            assert {pid for pid, _ in live[key][0]} == {pid for pid, _ in scores}, key
+
+
+def test_merge_equals_full_rebuild(tmp_path, monkeypatch, changes):
+    base, batches = changes
+    (tmp_path / "live").mkdir()
+    (tmp_path / "rebuilt").mkdir()
+    registry = _registry(tmp_path / "live", base)
+    writer = IndexWriter(registry, max_segments=100, merge_ratio=1.0)
+    _apply(writer, batches)
+    assert writer.merge() == len(batches) + 1  # one segment per add and per delete
+    assert len(registry.parts) == 1 and registry.segment_paths() == []
+
+    expected = _registry(tmp_path / "rebuilt", _final(base, batches))
+    for name, array in expected.index.arrays().items():
+        np.testing.assert_array_equal(registry.index.arrays()[name], array, err_msg=name)
+    assert registry.corpus.row_pids().tolist() == expected.corpus.row_pids().tolist()
+    for model in ("tfidf", "bm25"):
+        for name, array in expected.ranker(model).arrays().items():
+            np.testing.assert_allclose(registry.ranker(model).arrays()[name], array, err_msg=name)
+    assert _results(registry, monkeypatch) == _results(expected, monkeypatch)
+
+
+def test_merging_segments_keeps_the_results(tmp_path, monkeypatch, changes):
+    base, batches = changes
+    registry = _registry(tmp_path, base)
+    writer = IndexWriter(registry, max_segments=2, merge_factor=2, merge_ratio=1.0)
+    _apply(writer, batches)
+    before = _results(registry, monkeypatch)
+
+    while writer.maybe_merge():
+        pass
+    assert len(registry.parts) == 1 + 2 and writer.segment_merges == 3
+    assert _results(registry, monkeypatch) == before
+
+
+def test_merge_policy_merges_into_the_base_past_the_ratio(tmp_path, changes):
+    base, batches = changes
+    registry = _registry(tmp_path, base)
+    writer = IndexWriter(registry, merge_ratio=0.05)
+    writer.add(batches[0][0])
+    assert writer.maybe_merge() == 0  # 5 products: below 5% of 200
+    writer.add(batches[1][0])
+    assert writer.maybe_merge() == 2
+    assert len(registry.parts) == 1 and registry.index.num_docs == 205 and writer.merges == 1
+
+
+def test_segments_written_by_another_process_are_found_on_refresh(tmp_path, changes):
+    base, batches = changes
+    registry = _registry(tmp_path, base)
+    other = IndexRegistry(registry.path, registry.corpus_path)
+    other.load()
+    IndexWriter(registry).add(batches[0][0])
+    generation = other.generation
+    other.refresh()
+    assert other.generation == generation + 1 and "N000000" in other.documents
+    other.refresh()
+    assert other.generation == generation + 1
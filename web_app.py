@@ -2,15 +2,20 @@ import os
 from json import JSONEncoder
 
 import httpagentparser  # for getting the user agent as json
-from flask import Flask, render_template, session
+import psutil
+from flask import Flask, jsonify, render_template, session, url_for
 from flask import request
 
 from myapp.analytics.analytics_data import AnalyticsData, ClickedDoc
-from myapp.search.load_corpus import load_corpus
-from myapp.search.objects import Document, StatsDocument, ResultItem
+from myapp.search.segments import IndexWriter
+from myapp.search.objects import Document, StatsDocument
 from myapp.search.search_engine import SearchEngine
 from myapp.search.build_index import main
+from myapp.search.algorithms import REGISTRY
+from myapp.search.autocomplete import Autocomplete, MAX_SUGGESTIONS
+from myapp.search.filters import filter_params, parse_filters
 from myapp.generation.rag import RAGGenerator
+from myapp.core.prefork import serve
 from dotenv import load_dotenv
 load_dotenv()  # take environment variables from .env
 
@@ -20,17 +25,26 @@ import geoip2.database
 
 geo_reader = geoip2.database.Reader('geo2ip/GeoLite2-City.mmdb') # for ips
 
-TFIDF_PATH = "myapp/search/tfidf_index.dill"
-BM25_PATH = "myapp/search/bm25_index.dill"
+INDEX_PATH = "myapp/search/products_index.bin"
+CORPUS_PATH = "myapp/search/products_corpus.bin"
 
-# execute code to create index and store in search/ as .dill only if they don't exist already
-if not (os.path.exists(TFIDF_PATH) and os.path.exists(BM25_PATH)):
+# execute code to create index and corpus store in search/ as binary files only if they don't exist already
+if not os.path.exists(INDEX_PATH) or not os.path.exists(CORPUS_PATH):
     print("Indexes not found. Building index...")
     main()
     print("Indexes built!")
 else:
     print("Indexes already exist. Skipping build.")
 
+# load the index (shared postings + TF-IDF and BM25 models) and the corpus store before serving any request
+REGISTRY.load()
+# incremental updates of the catalogue: changes are written as segments, searched with the index right away and
+# merged into it in the background (see IndexWriter)
+index_writer = IndexWriter(REGISTRY, merge_delay=float(os.getenv("INDEX_MERGE_DELAY", 1.0)))
+index_writer.start()
+# token required by the /index/products endpoints (disabled if not set)
+INDEX_API_TOKEN = os.getenv("INDEX_API_TOKEN")
+
 # *** for using method to_json in objects ***
 def _default(self, obj):
     return getattr(obj.__class__, "to_json", _default.default)(obj)
@@ -46,20 +60,34 @@ app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY")
 # open browser dev tool to see the cookies
 app.session_cookie_name = os.getenv("SESSION_COOKIE_NAME")
-# instantiate our search engine
-search_engine = SearchEngine()
+# instantiate our search engine (with a cache of the ranked results of repeated queries)
+search_engine = SearchEngine(
+    cache_entries=int(os.getenv("QUERY_CACHE_ENTRIES", 1000)),
+    cache_max_bytes=int(float(os.getenv("QUERY_CACHE_MAX_MB")) * 2**20) if os.getenv("QUERY_CACHE_MAX_MB") else None,
+    cache_ttl=float(os.getenv("QUERY_CACHE_TTL")) if os.getenv("QUERY_CACHE_TTL") else None,
+)
+# number of results per page (the RAG uses the first page)
+RESULTS_PAGE_SIZE = int(os.getenv("RESULTS_PAGE_SIZE", 20))
+# longest ?wait= of /rag/<job_id>: request handlers are not threaded, so a waiting request blocks its process. Only
+# allowed (briefly) with pre-forked workers; the single process server never waits
+RAG_MAX_WAIT = float(os.getenv("RAG_MAX_WAIT", 2)) if int(os.getenv("WEB_WORKERS", 1)) > 1 else 0.0
 # instantiate our in memory persistence
 analytics_data = AnalyticsData()
+# suggestions of the search box: popular queries (updated as they are searched) and the index vocabulary
+autocomplete = Autocomplete(REGISTRY, analytics_data.query_counts)
 # instantiate RAG generator
 rag_generator = RAGGenerator()
 
-# load documents corpus into memory.
-full_path = os.path.realpath(__file__)
-path, filename = os.path.split(full_path)
-file_path = path + "/" + os.getenv("DATA_FILE_PATH")
-corpus = load_corpus(file_path)
+# the documents corpus is REGISTRY.documents: the products of the base corpus store (memory-mapped columnar store,
+# products are read on access) and of the segments of incremental updates, looked up by pid in the part that holds them
 # Log first element of corpus to verify it loaded correctly:
-#print("\nCorpus is loaded... \n First element:\n", list(corpus.values())[0])
+#print("\nCorpus is loaded... \n First element:\n", list(REGISTRY.documents.values())[0])
+
+
+@app.before_request
+def refresh_index():
+    # with several worker processes, incremental updates can be written and merged in another process
+    REGISTRY.refresh()
 
 
 # Home URL "/"
@@ -105,6 +133,16 @@ def index():
     return render_template('index.html', page_title="Welcome")
 
 
+def _facet_links(facets, filters):
+    """(value, count, url) of every facet value: the url shows the results restricted to that value."""
+    params = filter_params(filters)
+    links = {}
+    for field, counts in facets.items():
+        links[field] = [(value, count, url_for('search_form_post', filter=1, **dict(params, **{field: [value]})))
+                        for value, count in counts]
+    return links
+
+
 @app.route('/search', methods=['POST', 'GET'])
 def search_form_post():
 
@@ -114,56 +152,88 @@ def search_form_post():
     if request.method == 'POST':
         search_query = request.form['search-query']
         search_algorithm = request.form['search-algorithm']
+        filters = parse_filters(request.form)
 
         session['last_search_query'] = search_query
         session['last_search_algorithm'] = search_algorithm
+        session['last_filters'] = filters
         search_id = analytics_data.save_query_terms(search_query)
 
-        results = search_engine.search(search_algorithm, search_query, search_id, corpus)
-
-        # generate RAG response based on user query and retrieved results
-        rag_response = rag_generator.generate_response(search_query, results)
-        print("RAG response:", rag_response)
-
-        found_count = len(results)
-
-        session['last_result_pids'] = [doc.pid for doc in results[:20]] # just the top bc session would get too large
-        session['last_scores'] = [doc.ranking for doc in results[:20]] 
-        session['last_rag'] = rag_response
+        # first page of results: only its products are built from the corpus
+        result_page = search_engine.search(search_algorithm, search_query, search_id, REGISTRY.documents, page=1, page_size=RESULTS_PAGE_SIZE,
+                                           filters=filters)
+        counted = analytics_data.log_query(search_query, result_page.total_hits)
+        if counted is not None:
+            autocomplete.add_query(counted)  # zero-hit queries are never suggested
+
+        # generate the RAG response in the background: the page is returned right away and polls /rag/<job_id>
+        session['last_rag_job'] = rag_generator.submit(search_query, result_page.results)
+        session['last_rag_pids'] = [doc.pid for doc in result_page.results]
+        session.pop('last_rag', None)
         session['last_search_id'] = search_id
-        session['last_found_count'] = found_count
 
-    else: # from doc_details
+    else: # other page, or back from doc_details
         if 'last_search_query' in session:
             search_query = session['last_search_query']
             #search_id = analytics_data.save_query_terms(search_query)
-            rag_response = session['last_rag']
-            found_count = session['last_found_count']
-            
-            pids = session['last_result_pids']
-            scores = session['last_scores']
-            results = []
-
-            for pid, score in zip(pids, scores):
-                doc = corpus[pid]
-                results.append(ResultItem(
-                    pid=doc.pid,
-                    title=doc.title,
-                    description=doc.description,
-                    url=f"doc_details?pid={doc.pid}&search_id={session['last_search_id']}",
-                    ranking=score,
-                    selling_price =doc.selling_price,
-                    discount=doc.discount,
-                    average_rating=doc.average_rating,
-                    product_url = doc.url
-                ))
+            page = request.args.get('page', session.get('last_page', 1), type=int)
+            if request.args.get('filter'):
+                # filters changed on the results page: back to the first page
+                session['last_filters'] = parse_filters(request.args)
+                page = 1
+
+            # the ranked results of the query are cached, so this only builds the products of the page
+            result_page = search_engine.search(session['last_search_algorithm'], search_query, session['last_search_id'],
+                                               REGISTRY.documents, page=max(page, 1), page_size=RESULTS_PAGE_SIZE,
+                                               filters=session.get('last_filters'))
+
+    results = result_page.results
+    found_count = result_page.total_hits
+    rag_response = session.get('last_rag')  # None while the summary is being generated
+    session['last_page'] = result_page.page
+    session['last_result_pids'] = [doc.pid for doc in results] # just the page bc session would get too large
 
     # after user comes back from doc_details:
     # call update dwell time. not sure how to handle click_id TODO
     if 'last_clicked_doc_id' in session:
         analytics_data.update_dwell_time(session['last_clicked_doc_id'])
 
-    return render_template('results.html', results_list=results, page_title="Results", found_counter=found_count, rag_response=rag_response)
+    return render_template('results.html', results_list=results, page_title="Results", found_counter=found_count, rag_response=rag_response,
+                           rag_job=session.get('last_rag_job'), page=result_page.page, page_size=result_page.page_size, num_pages=result_page.num_pages,
+                           filters=session.get('last_filters') or {},
+                           facets=_facet_links(result_page.facets, session.get('last_filters') or {}))
+
+
+@app.route('/autocomplete', methods=['GET'])
+def autocomplete_suggestions():
+    """
+    Suggestions for the search box: ?q=<what is typed so far>&n=<number of suggestions, 10 by default>.
+    Not logged as a request: it is called on every key stroke.
+    """
+    prefix = request.args.get('q', '')
+    n = min(max(request.args.get('n', MAX_SUGGESTIONS, type=int), 1), 50)
+    return jsonify({"query": prefix, "suggestions": autocomplete.suggest(prefix, n)})
+
+
+@app.route('/rag/<job_id>', methods=['GET'])
+def rag_summary(job_id):
+    """
+    State of the AI summary of a search: {"status": "pending"} or {"status": "done", "response": ...}.
+    ?wait=<seconds> waits (up to RAG_MAX_WAIT seconds, not at all with a single server process) for the summary
+    instead of answering right away.
+    """
+    wait = max(min(request.args.get('wait', 0, type=float), RAG_MAX_WAIT), 0)
+    state = rag_generator.poll(job_id, wait=wait)
+    if state is None:
+        # unknown in this process (started by another worker, or expired): generate it again from the session
+        if session.get('last_rag_job') != job_id:
+            return jsonify({"status": "unknown"}), 404
+        products = [REGISTRY.documents.get(pid) for pid in session.get('last_rag_pids', [])]
+        rag_generator.submit(session['last_search_query'], [doc for doc in products if doc is not None])
+        state = rag_generator.poll(job_id, wait=wait) or {"status": "pending"}
+    if state["status"] == "done" and session.get('last_rag_job') == job_id and state["response"] != rag_generator.DEFAULT_ANSWER:
+        session['last_rag'] = state["response"]  # shown directly when coming back to the results (not a failure)
+    return jsonify(state)
 
 
 @app.route('/doc_details', methods=['GET'])
@@ -209,7 +279,7 @@ def doc_details():
         rank=request.args['rank']
     )
 
-    doc = corpus.get(clicked_doc_id)
+    doc = REGISTRY.documents.get(clicked_doc_id)
     if doc is None:
         return "Document not found", 404
     
@@ -227,7 +297,9 @@ def stats():
 
     docs = []
     for doc_id in analytics_data.fact_clicks:
-        row: Document = corpus[doc_id]
+        row = REGISTRY.documents.get(doc_id)
+        if row is None:  # deleted from the catalogue
+            continue
         count = analytics_data.fact_clicks[doc_id]
         doc = StatsDocument(pid=row.pid, title=row.title, description=row.description, url=row.url, count=count)
         docs.append(doc)
@@ -277,7 +349,9 @@ def dashboard():
 
     visited_docs = []
     for doc_id in analytics_data.fact_clicks.keys():
-        d: Document = corpus[doc_id]
+        d = REGISTRY.documents.get(doc_id)
+        if d is None:  # deleted from the catalogue
+            continue
         doc = ClickedDoc(doc_id, d.description, analytics_data.fact_clicks[doc_id])
         visited_docs.append(doc)
 
@@ -288,6 +362,51 @@ def dashboard():
     return render_template('dashboard.html', visited_docs=visited_docs)
 
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """
+    Readiness check for the load balancer: 200 once the index is loaded (503 before), with the load time and
+    memory of the index and of each ranking model, and the query cache counters.
+    """
+    status = REGISTRY.status()
+    status["query_cache"] = search_engine.stats()  # hits/misses to size the cache, hybrid branches left out
+    status["index_updates"] = index_writer.status()
+    status["rag"] = rag_generator.stats()  # response cache hit rate and LLM calls
+    status["autocomplete"] = autocomplete.stats()
+    # memory of this worker: rss counts the shared index pages, uss only what this process alone uses
+    memory = psutil.Process().memory_full_info()
+    status["process"] = {"pid": os.getpid(), "rss_bytes": memory.rss, "uss_bytes": memory.uss}
+    return jsonify(status), 200 if status["ready"] else 503
+
+
+def _index_api_allowed():
+    return INDEX_API_TOKEN is not None and request.headers.get("Authorization") == "Bearer " + INDEX_API_TOKEN
+
+
+@app.route('/index/products', methods=['POST'])
+def index_products():
+    """
+    Add or update products (JSON list of products, same fields as the products file). They are searchable as soon as
+    their segment is written (see IndexWriter).
+    """
+    if not _index_api_allowed():
+        return jsonify({"error": "forbidden"}), 403
+    try:
+        documents = [Document(**product) for product in request.get_json()]
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    index_writer.add(documents)
+    return jsonify({"accepted": len(documents)}), 202
+
+
+@app.route('/index/products/<pid>', methods=['DELETE'])
+def delete_product(pid):
+    if not _index_api_allowed():
+        return jsonify({"error": "forbidden"}), 403
+    index_writer.delete([pid])
+    return jsonify({"deleted": pid}), 202
+
+
 # New route added for generating an examples of basic Altair plot (used for dashboard)
 @app.route('/plot_number_of_views', methods=['GET'])
 def plot_number_of_views():
@@ -349,4 +468,9 @@ def plot_ip_country_distribution():
     return analytics_data.plot_ip_country_distribution()
 
 if __name__ == "__main__":
-    app.run(port=8088, host="0.0.0.0", threaded=False, debug=os.getenv("DEBUG"))
+    # WEB_WORKERS > 1: pre-forked worker processes sharing the index and corpus loaded above (Unix only)
+    workers = int(os.getenv("WEB_WORKERS", 1))
+    if workers > 1:
+        serve(app, host="0.0.0.0", port=8088, workers=workers)
+    else:
+        app.run(port=8088, host="0.0.0.0", threaded=False, debug=os.getenv("DEBUG"))